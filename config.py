@@ -17,4 +17,86 @@ class Config():
     FIREBASE_AUTH_PROVIDER_X509_CERT_URL: str = os.getenv("FIREBASE_AUTH_PROVIDER_X509_CERT_URL", "")
     FIREBASE_CLIENT_X509_CERT_URL: str = os.getenv("FIREBASE_CLIENT_X509_CERT_URL", "")
     FIREBASE_API_KEY: str = os.getenv("FIREBASE_API_KEY", "")
-    GOOGLEMAPS_API_KEY: str = os.getenv("GOOGLEMAPS_API_KEY", "")
\ No newline at end of file
+    GOOGLEMAPS_API_KEY: str = os.getenv("GOOGLEMAPS_API_KEY", "")
+    # Geocoding cache, ttl in seconds
+    GEOCODE_CACHE_TTL: int = int(os.getenv("GEOCODE_CACHE_TTL", "2592000"))
+    GEOCODE_CACHE_SIZE: int = int(os.getenv("GEOCODE_CACHE_SIZE", "2048"))
+    # Leg cache (distance, duration, fuel and polyline between 2 points), ttl in seconds
+    LEG_CACHE_TTL: int = int(os.getenv("LEG_CACHE_TTL", "604800"))
+    LEG_CACHE_SIZE: int = int(os.getenv("LEG_CACHE_SIZE", "20000"))
+    LEG_CACHE_MAX_DOCUMENTS: int = int(os.getenv("LEG_CACHE_MAX_DOCUMENTS", "500000"))
+    LEG_CACHE_PRECISION: int = int(os.getenv("LEG_CACHE_PRECISION", "5"))
+    # Waypoints ordering, 'local' (no requests, no waypoints limit) or 'google' (directions with optimize_waypoints)
+    ORDERING_ENGINE: str = os.getenv("ORDERING_ENGINE", "local")
+    # Improvement passes of waypoints ordering, same input gives same order, time budget in seconds only stops very big inputs
+    TSP_MAX_PASSES: int = int(os.getenv("TSP_MAX_PASSES", "20"))
+    TSP_TIME_BUDGET: float = float(os.getenv("TSP_TIME_BUDGET", "10"))
+    # Priorities in local ordering, 'hard' (all 3s before 2s before 1s) or 'soft' (going back to higher priority costs penalty km per level)
+    PRIORITY_MODE: str = os.getenv("PRIORITY_MODE", "hard")
+    PRIORITY_PENALTY: float = float(os.getenv("PRIORITY_PENALTY", "5"))
+    # Number of cheapest positions priced with google when kept location is inserted into remaining routes
+    INSERTION_ATTEMPTS: int = int(os.getenv("INSERTION_ATTEMPTS", "3"))
+    # Distances used to assign clusters to semi depots, 'google' (one batched distance matrix) or 'local' (haversine)
+    SEMI_DEPOT_MATRIX: str = os.getenv("SEMI_DEPOT_MATRIX", "google")
+    # Candidate plans scored locally before the best one is sent to google, routes of candidates get few improvement passes
+    # (time budget in seconds is only a safety limit)
+    PLAN_CANDIDATE_SEEDS: int = int(os.getenv("PLAN_CANDIDATE_SEEDS", "3"))
+    PLAN_CANDIDATES: int = int(os.getenv("PLAN_CANDIDATES", "8"))
+    CANDIDATE_TSP_MAX_PASSES: int = int(os.getenv("CANDIDATE_TSP_MAX_PASSES", "2"))
+    CANDIDATE_TSP_TIME_BUDGET: float = float(os.getenv("CANDIDATE_TSP_TIME_BUDGET", "2"))
+    # Regenerated plan keeps candidate warm started from previous routes, unless other candidate is better by more than margin (0.05 is 5%)
+    WARM_START_MARGIN: float = float(os.getenv("WARM_START_MARGIN", "0.05"))
+    # Maximum number of days of a plan, plans longer than REGION_DAYS are split into regions planned separately
+    MAX_DAYS: int = int(os.getenv("MAX_DAYS", "30"))
+    REGION_DAYS: int = int(os.getenv("REGION_DAYS", "7"))
+    # Clustering, 'balanced' (KMeans repaired to fit daily limits) or 'kmeans'
+    # Repair moves at most CLUSTERING_MAX_MOVES locations, same input gives same clusters (time budget in seconds is only a safety limit)
+    CLUSTERING_MODE: str = os.getenv("CLUSTERING_MODE", "balanced")
+    CLUSTERING_MAX_MOVES: int = int(os.getenv("CLUSTERING_MAX_MOVES", "500"))
+    CLUSTERING_TIME_BUDGET: float = float(os.getenv("CLUSTERING_TIME_BUDGET", "10"))
+    # KMeans seed and number of runs, MiniBatchKMeans is used above threshold number of locations
+    CLUSTERING_SEED: int = int(os.getenv("CLUSTERING_SEED", "101"))
+    CLUSTERING_N_INIT: int = int(os.getenv("CLUSTERING_N_INIT", "10"))
+    MINIBATCH_THRESHOLD: int = int(os.getenv("MINIBATCH_THRESHOLD", "1000"))
+    # Local cost model, road distance = haversine * detour factor
+    ROAD_DETOUR_FACTOR: float = float(os.getenv("ROAD_DETOUR_FACTOR", "1.3"))
+    AVERAGE_SPEED_KMH: float = float(os.getenv("AVERAGE_SPEED_KMH", "40"))
+    FUEL_LITERS_PER_KM: float = float(os.getenv("FUEL_LITERS_PER_KM", "0.07"))
+    # Number of routes built at the same time (shared by all plans in the process), keeps us inside google QPS quota
+    PLANNER_MAX_WORKERS: int = int(os.getenv("PLANNER_MAX_WORKERS", "4"))
+    # Workers generating routes for POST /routes?as_job=true
+    JOB_WORKERS: int = int(os.getenv("JOB_WORKERS", "2"))
+    # Workers generating routes for POST /routes/stream
+    STREAM_WORKERS: int = int(os.getenv("STREAM_WORKERS", "4"))
+    # Finished and abandoned jobs are removed from mongo after ttl in seconds
+    JOB_TTL: int = int(os.getenv("JOB_TTL", "604800"))
+    # Replica refreshes heartbeat of its not finished jobs every interval, job without heartbeat for stale_after seconds
+    # (replica restarted or died) is reported as failed, in seconds
+    JOB_HEARTBEAT_INTERVAL: int = int(os.getenv("JOB_HEARTBEAT_INTERVAL", "30"))
+    JOB_STALE_AFTER: int = int(os.getenv("JOB_STALE_AFTER", "120"))
+    # Routes documents in old schema are rewritten at startup, number of documents per bulk write
+    ROUTES_MIGRATION_BATCH: int = int(os.getenv("ROUTES_MIGRATION_BATCH", "200"))
+    # Startup tasks run by one replica hold a lock document, lock of a replica that died is removed after ttl in seconds
+    STARTUP_LOCK_TTL: int = int(os.getenv("STARTUP_LOCK_TTL", "600"))
+    # Cache of generated routes for identical requests, ttl in seconds
+    PLAN_CACHE_TTL: int = int(os.getenv("PLAN_CACHE_TTL", "3600"))
+    PLAN_CACHE_SIZE: int = int(os.getenv("PLAN_CACHE_SIZE", "128"))
+    # Shared HTTP client, timeouts and backoff in seconds
+    HTTP_POOL_CONNECTIONS: int = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))
+    HTTP_POOL_SIZE: int = int(os.getenv("HTTP_POOL_SIZE", "16"))
+    HTTP_CONNECT_TIMEOUT: float = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+    HTTP_READ_TIMEOUT: float = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+    HTTP_RETRIES: int = int(os.getenv("HTTP_RETRIES", "3"))
+    HTTP_BACKOFF: float = float(os.getenv("HTTP_BACKOFF", "0.5"))
+    HTTP_BACKOFF_MAX: float = float(os.getenv("HTTP_BACKOFF_MAX", "8"))
+    # Google maps calls per second and per day (UTC) of this process, calls above QPS wait, calls above daily budget fail
+    GEOCODE_QPS: float = float(os.getenv("GEOCODE_QPS", "40"))
+    GEOCODE_DAILY_BUDGET: int = int(os.getenv("GEOCODE_DAILY_BUDGET", "20000"))
+    REVERSE_GEOCODE_QPS: float = float(os.getenv("REVERSE_GEOCODE_QPS", "40"))
+    REVERSE_GEOCODE_DAILY_BUDGET: int = int(os.getenv("REVERSE_GEOCODE_DAILY_BUDGET", "20000"))
+    DIRECTIONS_QPS: float = float(os.getenv("DIRECTIONS_QPS", "40"))
+    DIRECTIONS_DAILY_BUDGET: int = int(os.getenv("DIRECTIONS_DAILY_BUDGET", "10000"))
+    DISTANCE_MATRIX_QPS: float = float(os.getenv("DISTANCE_MATRIX_QPS", "40"))
+    DISTANCE_MATRIX_DAILY_BUDGET: int = int(os.getenv("DISTANCE_MATRIX_DAILY_BUDGET", "10000"))
+    COMPUTE_ROUTES_QPS: float = float(os.getenv("COMPUTE_ROUTES_QPS", "40"))
+    COMPUTE_ROUTES_DAILY_BUDGET: int = int(os.getenv("COMPUTE_ROUTES_DAILY_BUDGET", "20000"))
\ No newline at end of file
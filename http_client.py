@@ -0,0 +1,161 @@
+import asyncio
+import random
+import threading
+import time
+
+import httpx
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+from config import Config
+
+
+class UpstreamServiceError(Exception):
+    pass
+
+
+class HttpClient():
+    '''
+    Keep-alive HTTP client shared by the planner and repositories
+    Requests answered with 429/5xx or failed on connection are retried with jittered exponential backoff
+    Latency of every call is recorded under its name, see stats()
+    '''
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, config):
+        self.config = config
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.config.HTTP_POOL_CONNECTIONS,
+                              pool_maxsize=self.config.HTTP_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.timeout = (self.config.HTTP_CONNECT_TIMEOUT, self.config.HTTP_READ_TIMEOUT)
+        self.lock = threading.Lock()
+        self.latency = {}
+        logger.info("Inited http client")
+
+    def post(self, url, name, retries=None, **kwargs):
+        return self.request('POST', url, name, retries, **kwargs)
+
+    # Function returns last response, also when it is still 429/5xx after all retries
+    # UpstreamServiceError is raised only when no response was received at all
+    def request(self, method, url, name, retries=None, **kwargs):
+        if retries is None:
+            retries = self.config.HTTP_RETRIES
+        kwargs.setdefault('timeout', self.timeout)
+
+        for attempt in range(retries + 1):
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.record(name, started, None)
+                if attempt == retries:
+                    raise UpstreamServiceError(f"{name} request failed: {str(e)}") from e
+                logger.warning(f"{name} request failed ({str(e)}), retry {attempt + 1}/{retries}")
+            else:
+                self.record(name, started, response.status_code)
+                if response.status_code not in self.RETRY_STATUSES or attempt == retries:
+                    return response
+                logger.warning(f"{name} responded with {response.status_code}, retry {attempt + 1}/{retries}")
+
+            time.sleep(self.backoff_delay(attempt))
+
+    # Full jitter, random delay up to exponentially growing cap
+    def backoff_delay(self, attempt):
+        return random.uniform(0, min(self.config.HTTP_BACKOFF_MAX, self.config.HTTP_BACKOFF * 2 ** attempt))
+
+    # Function raises UpstreamServiceError if response is 429/5xx (retries did not help)
+    def check(self, response, name):
+        if response.status_code in self.RETRY_STATUSES:
+            raise UpstreamServiceError(f"{name} responded with {response.status_code}")
+
+    def record(self, name, started, status_code):
+        elapsed_ms = (time.monotonic() - started) * 1000
+        logger.debug(f"{name} {status_code} in {elapsed_ms:.0f} ms")
+        with self.lock:
+            stats = self.latency.setdefault(name, {'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'last_ms': 0.0})
+            stats['calls'] += 1
+            if status_code is None or status_code in self.RETRY_STATUSES:
+                stats['errors'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['last_ms'] = elapsed_ms
+
+    def stats(self):
+        with self.lock:
+            return {name: {'calls': stats['calls'],
+                           'errors': stats['errors'],
+                           'avg_ms': round(stats['total_ms'] / stats['calls'], 1),
+                           'max_ms': round(stats['max_ms'], 1),
+                           'last_ms': round(stats['last_ms'], 1)} for name, stats in self.latency.items()}
+
+
+class AsyncHttpClient(HttpClient):
+    '''
+    Asyncio version of HttpClient (httpx), same retries, backoff and stats
+    httpx client is bound to the event loop it was created in, so every running loop gets its own client
+    Clients of closed loops are dropped, their connections were closed with the loop
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.clients = {}
+        self.timeout = httpx.Timeout(self.config.HTTP_READ_TIMEOUT, connect=self.config.HTTP_CONNECT_TIMEOUT)
+        self.limits = httpx.Limits(max_connections=self.config.HTTP_POOL_SIZE,
+                                   max_keepalive_connections=self.config.HTTP_POOL_SIZE)
+        self.lock = threading.Lock()
+        self.latency = {}
+        logger.info("Inited async http client")
+
+    def get_client(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            for closed_loop in [other for other in self.clients if other.is_closed()]:
+                del self.clients[closed_loop]
+            if loop not in self.clients:
+                self.clients[loop] = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+            return self.clients[loop]
+
+    async def get(self, url, name, retries=None, **kwargs):
+        return await self.request('GET', url, name, retries, **kwargs)
+
+    async def post(self, url, name, retries=None, **kwargs):
+        return await self.request('POST', url, name, retries, **kwargs)
+
+    # Function returns last response, also when it is still 429/5xx after all retries
+    # UpstreamServiceError is raised only when no response was received at all
+    async def request(self, method, url, name, retries=None, **kwargs):
+        if retries is None:
+            retries = self.config.HTTP_RETRIES
+        client = self.get_client()
+
+        for attempt in range(retries + 1):
+            started = time.monotonic()
+            try:
+                response = await client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                self.record(name, started, None)
+                if attempt == retries:
+                    raise UpstreamServiceError(f"{name} request failed: {str(e)}") from e
+                logger.warning(f"{name} request failed ({str(e)}), retry {attempt + 1}/{retries}")
+            else:
+                self.record(name, started, response.status_code)
+                if response.status_code not in self.RETRY_STATUSES or attempt == retries:
+                    return response
+                logger.warning(f"{name} responded with {response.status_code}, retry {attempt + 1}/{retries}")
+
+            await asyncio.sleep(self.backoff_delay(attempt))
+
+    # Function closes client of the running loop
+    async def close(self):
+        with self.lock:
+            client = self.clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+http_client = HttpClient(Config())
+async_http_client = AsyncHttpClient(Config())
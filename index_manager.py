@@ -0,0 +1,160 @@
+import os
+import socket
+import threading
+from datetime import datetime
+
+from loguru import logger
+from pymongo import ASCENDING, IndexModel, MongoClient
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+
+# Mongo error codes of create_index called for existing index with other options
+INDEX_OPTIONS_CONFLICT = 85
+INDEX_KEY_SPECS_CONFLICT = 86
+
+
+class IndexManager():
+    '''
+    Indexes of route_db declared in one place and created at startup
+    Queries by user_firebase_id alone use prefix of compound user indexes, so there is no separate index for them
+    Cache and jobs collections get TTL index on created_at, expiration is updated when ttl in config changes
+    Routes with the same name of the same user are renamed before unique index is built, by one replica at a time (lock document)
+    Build of every index is tracked, see status()
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.client: MongoClient = MongoClient(self.config.MONGO)
+        self.db: Database = self.client.route_db
+        self.lock = threading.Lock()
+        self.builds = {}
+        # Locks taken by this process, other replicas have other owner
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.indexes = {
+            'routes': [IndexModel([('user_firebase_id', ASCENDING), ('routes_completed', ASCENDING)], name='user_routes_completed'),
+                       IndexModel([('user_firebase_id', ASCENDING), ('name', ASCENDING)], name='user_name_unique', unique=True)],
+            'locations': [IndexModel([('routes_id', ASCENDING)], name='routes_id'),
+                          IndexModel([('user_firebase_id', ASCENDING)], name='user_firebase_id')],
+            'geocode_cache': [self.ttl_index(self.config.GEOCODE_CACHE_TTL)],
+            'reverse_geocode_cache': [self.ttl_index(self.config.GEOCODE_CACHE_TTL)],
+            'leg_cache': [self.ttl_index(self.config.LEG_CACHE_TTL)],
+            'plan_cache': [self.ttl_index(self.config.PLAN_CACHE_TTL)],
+            'jobs': [self.ttl_index(self.config.JOB_TTL)],
+            'locks': [self.ttl_index(self.config.STARTUP_LOCK_TTL)]
+        }
+        logger.info("Inited index manager")
+
+    def ttl_index(self, ttl):
+        return IndexModel([('created_at', ASCENDING)], name='created_at_ttl', expireAfterSeconds=ttl)
+
+    # Builds run one after another, failed build (e.g. duplicated names of routes) is logged and reported, other builds go on
+    def ensure_indexes(self):
+        try:
+            self.rename_duplicated_routes_once()
+        except PyMongoError as e:
+            logger.error(f"Renaming duplicated routes failed: {str(e)}")
+
+        for collection, indexes in self.indexes.items():
+            for index in indexes:
+                name = index.document['name']
+                self.set_build(collection, name, 'building')
+                try:
+                    self.create_index(collection, index)
+                except PyMongoError as e:
+                    logger.error(f"Index {collection}.{name} failed: {str(e)}")
+                    self.set_build(collection, name, 'failed', str(e))
+                    continue
+                self.set_build(collection, name, 'ready')
+                logger.info(f"Index {collection}.{name} is ready")
+
+    # Index creation does not block the app, status() shows when indexes are ready
+    def ensure_indexes_in_background(self):
+        threading.Thread(target=self.ensure_indexes, name='index-manager', daemon=True).start()
+
+    # Renaming is needed only until unique index exists, replicas starting at the same time do not rename the same routes
+    # Replica that does not get the lock skips renaming, its unique index build fails until the other replica builds it
+    def rename_duplicated_routes_once(self):
+        if 'user_name_unique' in {index['name'] for index in self.db.routes.list_indexes()}:
+            return
+        if not self.acquire_lock('rename_duplicated_routes'):
+            logger.info("Duplicated routes are renamed by other replica")
+            return
+        try:
+            self.rename_duplicated_routes()
+        finally:
+            self.release_lock('rename_duplicated_routes')
+
+    # Lock is a document with unique _id, insert fails if other replica holds it, TTL index removes locks of dead replicas
+    def acquire_lock(self, name):
+        try:
+            self.db.locks.insert_one({'_id': name, 'owner': self.owner, 'created_at': datetime.utcnow()})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def release_lock(self, name):
+        self.db.locks.delete_one({'_id': name, 'owner': self.owner})
+
+    # Routes saved before names were unique can share a name, all but the oldest get a number after the name
+    def rename_duplicated_routes(self):
+        duplicates = self.db.routes.aggregate([{'$sort': {'_id': 1}},
+                                               {'$group': {'_id': {'user_firebase_id': '$user_firebase_id', 'name': '$name'},
+                                                           'routes_ids': {'$push': '$_id'},
+                                                           'count': {'$sum': 1}}},
+                                               {'$match': {'count': {'$gt': 1}}}], allowDiskUse=True)
+        for duplicate in duplicates:
+            uid = duplicate['_id']['user_firebase_id']
+            name = duplicate['_id']['name']
+            number = 1
+            for routes_id in duplicate['routes_ids'][1:]:
+                number += 1
+                while self.db.routes.find_one({'user_firebase_id': uid, 'name': f'{name} ({number})'}, {'_id': 1}) is not None:
+                    number += 1
+                self.db.routes.update_one({'_id': routes_id}, {'$set': {'name': f'{name} ({number})'}})
+            logger.info(f"Renamed {duplicate['count'] - 1} routes named {name} of user {uid}")
+
+    def create_index(self, collection, index):
+        try:
+            self.db[collection].create_indexes([index])
+        except OperationFailure as e:
+            if e.code not in (INDEX_OPTIONS_CONFLICT, INDEX_KEY_SPECS_CONFLICT) or 'expireAfterSeconds' not in index.document:
+                raise
+            self.db.command('collMod', collection, index={'keyPattern': index.document['key'],
+                                                          'expireAfterSeconds': index.document['expireAfterSeconds']})
+
+    def set_build(self, collection, name, state, error=None):
+        with self.lock:
+            self.builds[(collection, name)] = {'state': state, 'error': error}
+
+    # Function returns state of every declared index: ready, building, failed (with error), missing (not created yet)
+    def status(self):
+        building = self.current_builds()
+        status = {}
+        for collection, indexes in self.indexes.items():
+            try:
+                existing = {index['name'] for index in self.db[collection].list_indexes()}
+            except PyMongoError as e:
+                logger.warning(f"Listing indexes of {collection} failed: {str(e)}")
+                existing = set()
+
+            status[collection] = {}
+            for index in indexes:
+                name = index.document['name']
+                with self.lock:
+                    build = dict(self.builds.get((collection, name), {'state': 'missing', 'error': None}))
+                if name in existing and build['state'] != 'building':
+                    build = {'state': 'ready', 'error': None}
+                if build['state'] == 'building' and collection in building:
+                    build['progress'] = building[collection]
+                status[collection][name] = build
+        return status
+
+    # Progress messages of index builds running on the server, {collection: message}
+    def current_builds(self):
+        try:
+            operations = self.client.admin.aggregate([{'$currentOp': {}},
+                                                      {'$match': {'command.createIndexes': {'$exists': True}, 'ns': {'$regex': f'^{self.db.name}\\.'}}}])
+            return {operation['command']['createIndexes']: operation.get('msg') for operation in operations}
+        except PyMongoError as e:
+            logger.warning(f"Reading index builds failed: {str(e)}")
+            return {}
@@ -2,19 +2,27 @@ import sys
 
 import firebase_admin
 from firebase_admin.auth import EmailAlreadyExistsError
-import googlemaps
 from fastapi import FastAPI, Request
 from starlette.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi_exceptions.exceptions import NotAuthenticated
 from firebase_admin import credentials
 from fastapi import HTTPException
 from loguru import logger
+from starlette.concurrency import run_in_threadpool
 
 from config import Config
+from http_client import UpstreamServiceError, async_http_client, http_client
+from index_manager import IndexManager
+from maps_gateway import ContextThreadPoolExecutor, maps_gateway
 from routes.model import RoutesModel, WaypointModel, RegenerateModel, StatisticModel, RenameModel, WaypointInfoModel
-from routes.planner import RoutesPlanner
+from routes.async_planner import AsyncRoutesPlanner
 from routes.route_repository import RouteRepository
+from routes.job_repository import JobRepository
+from routes.geocoding import geocoding_service
+from routes.leg_cache import leg_cache
+from routes.plan_cache import PlanCache
+from routes.progress import ProgressStream, no_progress
 from users.auth import authenticate_header
 from users.model import UserEmailModel, UserModel, UserModelChangePassword
 from users.user_repository import UserRepository
@@ -25,8 +33,17 @@ cfg = Config()
 
 user_repo = UserRepository(cfg)
 routes_repo = RouteRepository(cfg)
+jobs_repo = JobRepository(cfg)
+index_manager = IndexManager(cfg)
 
-routes_planner = RoutesPlanner(cfg)
+# Sync methods are used by jobs and streams, async ones by POST /routes
+routes_planner = AsyncRoutesPlanner(cfg)
+plan_cache = PlanCache(cfg)
+
+# Workers running routes generation jobs in background
+jobs_executor = ContextThreadPoolExecutor(max_workers=cfg.JOB_WORKERS)
+# Streams have their own workers, so open stream connections do not wait behind jobs
+streams_executor = ContextThreadPoolExecutor(max_workers=cfg.STREAM_WORKERS)
 
 cred = credentials.Certificate({
     "type": Config.FIREBASE_TYPE,
@@ -43,8 +60,6 @@ cred = credentials.Certificate({
 })
 firebase = firebase_admin.initialize_app(cred)
 
-gmaps = googlemaps.Client(key=Config.GOOGLEMAPS_API_KEY)
-
 app = FastAPI()
 
 '''
@@ -65,11 +80,52 @@ def firebase_middleware(request: Request, call_next):
     return authenticate_header(request, call_next) # type: ignore
 
 
+@app.on_event("startup")
+def prepare_database():
+    index_manager.ensure_indexes_in_background()
+    routes_repo.migrate_routes_in_background()
+    jobs_repo.start_heartbeat()
+
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    await async_http_client.close()
+
+
 @app.get("/")
 def ping():
     return {"message": "pong"}
 
 
+@app.get("/cache/stats")
+def cache_stats():
+    """
+    Hit rates of geocoding, leg and plan caches in this process
+    """
+
+    return {"geocode": geocoding_service.stats(),
+            "legs": leg_cache.stats(),
+            "plans": plan_cache.stats()}
+
+
+@app.get("/http/stats")
+def http_stats():
+    """
+    Number of calls, errors and latency of outgoing HTTP requests in this process, google maps usage of today
+    """
+
+    return {'http': http_client.stats(), 'http_async': async_http_client.stats(), 'google': maps_gateway.stats()}
+
+
+@app.get("/db/indexes")
+def db_indexes():
+    """
+    State of every index the app needs: ready, building (with progress), failed (with error) or missing
+    """
+
+    return index_manager.status()
+
+
 @app.post("/auth/sign-up")
 @logger.catch
 def create_user(user: UserModel, status_code=201):
@@ -247,36 +303,196 @@ def route_waypoint_info(request: Request, waypoint: WaypointInfoModel):
         return JSONResponse(status_code=400, content={"error": error})
     except KeyError as e:
         return JSONResponse(status_code=400, content={"error": "Route with that number not found"})
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.detail})
+
+
+def plan_routes(uid, routes: RoutesModel, routes_id, overwrite, progress=no_progress):
+    """
+    Generate routes and save them for user, progress(stage, **data) is called when a stage is done
+    """
+
+    # Google calls made for this plan are logged and returned in metadata
+    with maps_gateway.counting() as google_calls:
+        # Regenerated routes start one candidate plan from centers of previous routes, it is kept
+        # unless other candidate is better by more than WARM_START_MARGIN (estimated), so routes change only for a clear gain
+        centroids = routes_repo.get_route_centroids(routes_id) if routes_id is not None else []
+        if len(centroids) != routes.days:
+            centroids = None
+
+        # Identical requests (e.g. retried by the app) reuse cached routes
+        params = dict(routes.dict(), centroids=centroids)
+        calculated_routes = plan_cache.get_or_compute(params, lambda: routes_planner.get_routes(routes.depot_address,
+                                                                                                       routes.semi_depot_addresses,
+                                                                                                       routes.addresses,
+                                                                                                       routes.priorities,
+                                                                                                       routes.days,
+                                                                                                       routes.distance_limit,
+                                                                                                       routes.duration_limit,
+                                                                                                       routes.preferences,
+                                                                                                       routes.avoid_tolls,
+                                                                                                       centroids,
+                                                                                                       progress))
+
+        result = routes_repo.create_user_route(uid, calculated_routes, routes.days, routes.distance_limit, routes.duration_limit, routes.preferences, routes.avoid_tolls, routes_id, overwrite)
+        progress('persisted', routes_id=result['routes'][0]['routes_id'])
+
+    logger.info(f"Google calls for routes {result['routes'][0]['routes_id']}: {google_calls}")
+    result['metadata'] = {'google_calls': google_calls}
+
+    return result
+
+
+async def plan_routes_async(uid, routes: RoutesModel, routes_id, overwrite):
+    """
+    Async version of plan_routes, google calls are sent concurrently and mongo is used in threadpool
+    """
+
+    with maps_gateway.counting() as google_calls:
+        centroids = await run_in_threadpool(routes_repo.get_route_centroids, routes_id) if routes_id is not None else []
+        if len(centroids) != routes.days:
+            centroids = None
+
+        params = dict(routes.dict(), centroids=centroids)
+        calculated_routes = await plan_cache.get_or_compute_async(params, lambda: routes_planner.get_routes_async(routes.depot_address,
+                                                                                                                 routes.semi_depot_addresses,
+                                                                                                                 routes.addresses,
+                                                                                                                 routes.priorities,
+                                                                                                                 routes.days,
+                                                                                                                 routes.distance_limit,
+                                                                                                                 routes.duration_limit,
+                                                                                                                 routes.preferences,
+                                                                                                                 routes.avoid_tolls,
+                                                                                                                 centroids))
+
+        result = await run_in_threadpool(routes_repo.create_user_route, uid, calculated_routes, routes.days, routes.distance_limit,
+                                         routes.duration_limit, routes.preferences, routes.avoid_tolls, routes_id, overwrite)
+
+    logger.info(f"Google calls for routes {result['routes'][0]['routes_id']}: {google_calls}")
+    result['metadata'] = {'google_calls': google_calls}
+
+    return result
+
+
+def run_routes_job(job_id, uid, routes: RoutesModel, routes_id, overwrite):
+    """
+    Background job for POST /routes?as_job=true, result or error is saved in jobs collection
+    """
+
+    jobs_repo.mark_running(job_id)
+    try:
+        result = plan_routes(uid, routes, routes_id, overwrite)
+    except ValueError as e:
+        jobs_repo.mark_failed(job_id, str(e))
+        return
+    except IndexError as e:
+        jobs_repo.mark_failed(job_id, "Can not compute routes for those locations")
+        return
+    except UpstreamServiceError as e:
+        logger.error(str(e))
+        jobs_repo.mark_failed(job_id, "Google Maps API is unavailable, try again later")
+        return
+    except Exception as e:
+        logger.exception(f"Routes job {job_id} failed")
+        jobs_repo.mark_failed(job_id, "Internal error")
+        return
+
+    jobs_repo.mark_done(job_id, result)
 
 
 @app.post("/routes")
 @logger.catch
-def routes_post_handler(request: Request, routes: RoutesModel, routes_id: str = None, overwrite: bool = False):
+async def routes_post_handler(request: Request, routes: RoutesModel, routes_id: str = None, overwrite: bool = False, as_job: bool = False):
+    """
+    Generate routes, with as_job=true returns job_id at once and routes are generated in background
+    (poll GET /routes/jobs/{job_id})
+    """
+
     uid = request.state.uid
     if uid is None:
         raise NotAuthenticated('User ID not found in token')
+
+    if as_job is True:
+        job_id = await run_in_threadpool(jobs_repo.create_job, uid, routes.dict())
+        jobs_executor.submit(run_routes_job, job_id, uid, routes, routes_id, overwrite)
+        return JSONResponse(status_code=202, content={"job_id": job_id, "status": "queued"})
+
     try:
-        calculated_routes = routes_planner.get_routes(routes.depot_address,
-                                                      routes.semi_depot_addresses,
-                                                      routes.addresses,
-                                                      routes.priorities,
-                                                      routes.days,
-                                                      routes.distance_limit,
-                                                      routes.duration_limit,
-                                                      routes.preferences,
-                                                      routes.avoid_tolls)
-
-        routes = routes_repo.create_user_route(uid, calculated_routes, routes.days, routes.distance_limit, routes.duration_limit, routes.preferences, routes.avoid_tolls, routes_id, overwrite)
+        routes = await plan_routes_async(uid, routes, routes_id, overwrite)
 
     except ValueError as e:
         error = str(e)
         return JSONResponse(status_code=400, content={"error": error})
     except IndexError as e:
         return JSONResponse(status_code=400, content={"error": "Can not compute routes for those locations"})
+    except UpstreamServiceError as e:
+        logger.error(str(e))
+        return JSONResponse(status_code=502, content={"error": "Google Maps API is unavailable, try again later"})
 
     return routes
 
 
+def run_routes_stream(stream: ProgressStream, uid, routes: RoutesModel, routes_id, overwrite):
+    """
+    Generation for POST /routes/stream, last event is 'done' with routes or 'error'
+    """
+
+    try:
+        result = plan_routes(uid, routes, routes_id, overwrite, stream)
+        stream('done', result=result)
+    except ValueError as e:
+        stream('error', status=400, error=str(e))
+    except IndexError as e:
+        stream('error', status=400, error="Can not compute routes for those locations")
+    except UpstreamServiceError as e:
+        logger.error(str(e))
+        stream('error', status=502, error="Google Maps API is unavailable, try again later")
+    except Exception as e:
+        logger.exception("Routes stream failed")
+        stream('error', status=500, error="Internal error")
+    finally:
+        stream.close()
+
+
+@app.post("/routes/stream")
+@logger.catch
+async def routes_stream_handler(request: Request, routes: RoutesModel, routes_id: str = None, overwrite: bool = False):
+    """
+    Generate routes and stream progress as NDJSON, one event per line:
+    queued, geocoding (done/total), clustering, route_ordered and metrics (route, done/total), persisted, done (result) or error
+    Every event has elapsed_ms (from start) and stage_ms (from previous event)
+    """
+
+    uid = request.state.uid
+    if uid is None:
+        raise NotAuthenticated('User ID not found in token')
+
+    # Client gets first event before generation starts, also when every stream worker is busy
+    # Stream is read in event loop, waiting clients do not hold threads of the threadpool
+    stream = ProgressStream()
+    stream('queued')
+    streams_executor.submit(run_routes_stream, stream, uid, routes, routes_id, overwrite)
+    return StreamingResponse(stream.lines(), media_type="application/x-ndjson")
+
+
+@app.get("/routes/jobs/{job_id}")
+@logger.catch
+def routes_job_handler(request: Request, job_id: str):
+    """
+    Return status of routes generation job: queued, running, done (with result) or failed (with error)
+    """
+
+    uid = request.state.uid
+    if uid is None:
+        raise NotAuthenticated('User ID not found in token')
+
+    try:
+        job = jobs_repo.get_job(uid, job_id)
+        return job
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.detail})
+
+
 @app.delete("/routes")
 @logger.catch
 def del_user_route(request: Request, active: bool = False, routes_id: str = None):
@@ -294,7 +510,7 @@ def del_user_route(request: Request, active: bool = False, routes_id: str = None
 
 @app.post("/routes/waypoint")
 @logger.catch
-def mark_visited_waypoint(request: Request, waypoint: WaypointModel, should_keep: bool = False):
+def mark_visited_waypoint(request: Request, waypoint: WaypointModel, should_keep: bool = False, reinsert: bool = False):
     uid = request.state.uid
     if uid is None:
         raise NotAuthenticated('User ID not found in token')
@@ -304,7 +520,8 @@ def mark_visited_waypoint(request: Request, waypoint: WaypointModel, should_keep
                                                        waypoint.route_number,
                                                        waypoint.location_number,
                                                        waypoint.visited,
-                                                       should_keep)
+                                                       should_keep,
+                                                       reinsert)
 
         return updated_waypoint
 
@@ -312,6 +529,9 @@ def mark_visited_waypoint(request: Request, waypoint: WaypointModel, should_keep
         return JSONResponse(status_code=e.status_code, content={"error": e.detail})
     except ValueError as e:
         return JSONResponse(status_code=400, content={"error": str(e)})
+    except UpstreamServiceError as e:
+        logger.error(str(e))
+        return JSONResponse(status_code=502, content={"error": "Google Maps API is unavailable, try again later"})
 
 @app.post("/routes/rename")
 @logger.catch
@@ -331,12 +551,12 @@ def change_name_of_routes(request: Request, rename: RenameModel):
 
 @app.post("/routes/regenerate")
 @logger.catch
-def regenerate_routes(request: Request, regenerate: RegenerateModel, full_regeneration: bool = False):
+async def regenerate_routes(request: Request, regenerate: RegenerateModel, full_regeneration: bool = False):
     uid = request.state.uid
     if uid is None:
         raise NotAuthenticated('User ID not found in token')
     try:
-        locations = routes_repo.get_locations_to_regenerate(regenerate.routes_id, full_regeneration)
+        locations = await run_in_threadpool(routes_repo.get_locations_to_regenerate, regenerate.routes_id, full_regeneration)
         return locations
     except HTTPException as e:
         return JSONResponse(status_code=e.status_code, content={"error": e.detail})
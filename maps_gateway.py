@@ -0,0 +1,231 @@
+import asyncio
+import contextvars
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+import googlemaps
+from googlemaps import convert, exceptions
+from loguru import logger
+
+from config import Config
+from http_client import UpstreamServiceError, async_http_client, http_client
+
+# Calls made for the request being handled, {api: count}, None outside of counted request
+request_calls = contextvars.ContextVar('request_calls', default=None)
+
+
+class BudgetExceededError(UpstreamServiceError):
+    pass
+
+
+class TokenBucket():
+    '''
+    Bucket refilled with rate tokens per second up to capacity (one second of calls)
+    Calls above the rate are queued instead of failed, every call reserves a token and waits until its turn
+    '''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Function takes a token (tokens go below zero when calls are queued), returns seconds to wait for it
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    '''
+    Thread pool running every task in a copy of the caller's context, so google calls are counted for the right request
+    '''
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class MapsGateway():
+    '''
+    Every google maps call goes through here
+    Calls of every API are limited by token bucket (QPS) and daily budget of this process, counted per request and per day
+    '''
+
+    APIS = ('geocode', 'reverse_geocode', 'directions', 'distance_matrix', 'compute_routes')
+    COMPUTE_ROUTES_URL = 'https://routes.googleapis.com/directions/v2:computeRoutes'
+    GEOCODE_URL = 'https://maps.googleapis.com/maps/api/geocode/json'
+    DIRECTIONS_URL = 'https://maps.googleapis.com/maps/api/directions/json'
+    DISTANCE_MATRIX_URL = 'https://maps.googleapis.com/maps/api/distancematrix/json'
+    INVALID_REQUEST_STATUSES = ('INVALID_REQUEST', 'NOT_FOUND', 'MAX_WAYPOINTS_EXCEEDED', 'MAX_ROUTE_LENGTH_EXCEEDED',
+                                'MAX_ELEMENTS_EXCEEDED', 'MAX_DIMENSIONS_EXCEEDED')
+
+    def __init__(self, config):
+        self.config = config
+        self.gmaps = googlemaps.Client(key=self.config.GOOGLEMAPS_API_KEY)
+        self.buckets = {api: TokenBucket(getattr(self.config, f'{api.upper()}_QPS')) for api in self.APIS}
+        self.budgets = {api: getattr(self.config, f'{api.upper()}_DAILY_BUDGET') for api in self.APIS}
+        self.lock = threading.Lock()
+        self.day = None
+        self.used = {}
+        logger.info("Inited maps gateway")
+
+    # Function counts the call, raises BudgetExceededError if daily budget is used, returns bucket of the API
+    def reserve(self, api):
+        with self.lock:
+            today = datetime.utcnow().date()
+            if today != self.day:
+                self.day = today
+                self.used = {name: 0 for name in self.APIS}
+            if self.used[api] >= self.budgets[api]:
+                raise BudgetExceededError(f"Daily budget of {api} calls is used")
+            self.used[api] += 1
+
+            calls = request_calls.get()
+            if calls is not None:
+                calls[api] = calls.get(api, 0) + 1
+
+        return self.buckets[api]
+
+    # Function waits for a token and counts the call
+    def acquire(self, api):
+        self.reserve(api).acquire()
+
+    async def acquire_async(self, api):
+        await self.reserve(api).acquire_async()
+
+    def geocode(self, address):
+        self.acquire('geocode')
+        with self.client_errors('geocode'):
+            return self.gmaps.geocode(address)
+
+    def reverse_geocode(self, latlng):
+        self.acquire('reverse_geocode')
+        with self.client_errors('reverseGeocode'):
+            return self.gmaps.reverse_geocode(latlng)
+
+    def directions(self, origin, destination, **kwargs):
+        self.acquire('directions')
+        with self.client_errors('directions'):
+            return self.gmaps.directions(origin, destination, **kwargs)
+
+    def distance_matrix(self, origins, destinations, **kwargs):
+        self.acquire('distance_matrix')
+        with self.client_errors('distanceMatrix'):
+            return self.gmaps.distance_matrix(origins, destinations, **kwargs)
+
+    # Errors of googlemaps client are raised like errors of get_web_service, so sync and async endpoints answer the same
+    @contextmanager
+    def client_errors(self, name):
+        try:
+            yield
+        except exceptions.ApiError as e:
+            message = f"{name} failed with {e.status}: {e.message or ''}".strip()
+            if e.status in self.INVALID_REQUEST_STATUSES:
+                raise ValueError(message) from e
+            raise UpstreamServiceError(message) from e
+        except (exceptions.Timeout, exceptions.TransportError) as e:
+            raise UpstreamServiceError(f"{name} request failed: {str(e) or type(e).__name__}") from e
+
+    # Function returns parsed response of computeRoutes, field_mask lists fields we want in response
+    def compute_routes(self, payload, field_mask):
+        self.acquire('compute_routes')
+        response = http_client.post(self.COMPUTE_ROUTES_URL, 'computeRoutes', headers=self.compute_routes_headers(field_mask),
+                                    data=json.dumps(payload))
+        http_client.check(response, 'computeRoutes')
+        return response.json()
+
+    def compute_routes_headers(self, field_mask):
+        return {
+            'Content-Type': 'application/json',
+            'X-Goog-Api-Key': self.config.GOOGLEMAPS_API_KEY,
+            'X-Goog-FieldMask': field_mask
+        }
+
+    # Async versions of the calls above, sent with shared httpx client, results have the same shape as googlemaps results
+    async def geocode_async(self, address):
+        await self.acquire_async('geocode')
+        body = await self.get_web_service(self.GEOCODE_URL, 'geocode', {'address': address})
+        return body.get('results', [])
+
+    async def reverse_geocode_async(self, latlng):
+        await self.acquire_async('reverse_geocode')
+        body = await self.get_web_service(self.GEOCODE_URL, 'reverseGeocode', {'latlng': convert.latlng(latlng)})
+        return body.get('results', [])
+
+    async def directions_async(self, origin, destination, waypoints=None, mode='driving', optimize_waypoints=False, avoid=None):
+        await self.acquire_async('directions')
+        params = {'origin': convert.latlng(origin), 'destination': convert.latlng(destination), 'mode': mode}
+        if waypoints:
+            params['waypoints'] = convert.location_list(waypoints)
+            if optimize_waypoints:
+                params['waypoints'] = 'optimize:true|' + params['waypoints']
+        if avoid:
+            params['avoid'] = avoid
+        body = await self.get_web_service(self.DIRECTIONS_URL, 'directions', params)
+        return body.get('routes', [])
+
+    async def distance_matrix_async(self, origins, destinations, mode='driving'):
+        await self.acquire_async('distance_matrix')
+        params = {'origins': convert.location_list(origins), 'destinations': convert.location_list(destinations), 'mode': mode}
+        return await self.get_web_service(self.DISTANCE_MATRIX_URL, 'distanceMatrix', params)
+
+    async def compute_routes_async(self, payload, field_mask):
+        await self.acquire_async('compute_routes')
+        response = await async_http_client.post(self.COMPUTE_ROUTES_URL, 'computeRoutes', headers=self.compute_routes_headers(field_mask),
+                                                content=json.dumps(payload))
+        async_http_client.check(response, 'computeRoutes')
+        return response.json()
+
+    # Function returns body of google maps web service response, errors are raised like in googlemaps client
+    # Wrong request (e.g. unknown address, too many waypoints) is ValueError, anything else is UpstreamServiceError
+    async def get_web_service(self, url, name, params):
+        response = await async_http_client.get(url, name, params=dict(params, key=self.config.GOOGLEMAPS_API_KEY))
+        async_http_client.check(response, name)
+        if response.status_code != 200:
+            raise UpstreamServiceError(f"{name} responded with {response.status_code}")
+
+        body = response.json()
+        status = body.get('status')
+        if status in ('OK', 'ZERO_RESULTS'):
+            return body
+        if status in self.INVALID_REQUEST_STATUSES:
+            raise ValueError(f"{name} failed with {status}: {body.get('error_message', '')}".strip())
+        raise UpstreamServiceError(f"{name} failed with {status}: {body.get('error_message', '')}".strip())
+
+    # Calls made inside the block (also by tasks submitted to ContextThreadPoolExecutor) are counted in yielded dict {api: count}
+    @contextmanager
+    def counting(self):
+        calls = {}
+        token = request_calls.set(calls)
+        try:
+            yield calls
+        finally:
+            request_calls.reset(token)
+
+    def stats(self):
+        with self.lock:
+            return {api: {'used_today': self.used.get(api, 0),
+                          'daily_budget': self.budgets[api],
+                          'qps': self.buckets[api].rate} for api in self.APIS}
+
+
+maps_gateway = MapsGateway(Config())
@@ -0,0 +1,209 @@
+import asyncio
+import threading
+
+from starlette.concurrency import run_in_threadpool
+
+from maps_gateway import maps_gateway
+from routes import geometry
+from routes.geocoding import geocoding_service
+from routes.leg_cache import leg_cache
+from routes.planner import DIRECTIONS_MAX_WAYPOINTS, ROUTE_LEGS_FIELD_MASK, RoutesPlanner
+from routes.progress import no_progress
+
+
+class AsyncRoutesPlanner(RoutesPlanner):
+    '''
+    Asyncio version of the planner used by async endpoints, plans are the same as plans of RoutesPlanner
+    Google calls of one stage (geocoding, ordering, metrics, reverse geocoding) are sent at once with asyncio.gather,
+    maps gateway still keeps them inside QPS limits. Local ordering runs in planner executor, candidate plans and mongo caches
+    in threadpool, so event loop is free for other requests
+    Calls waiting for mongo caches in threadpool share one limiter of the event loop, so requests together take at most
+    HTTP_POOL_SIZE threads of the threadpool used by all endpoints
+    '''
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    # Semaphore can be used only in the loop it was created for, limiters of closed loops are dropped
+    def get_limiter(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            for closed_loop in [other for other in self.limiters if other.is_closed()]:
+                del self.limiters[closed_loop]
+            if loop not in self.limiters:
+                self.limiters[loop] = asyncio.Semaphore(self.config.HTTP_POOL_SIZE)
+            return self.limiters[loop]
+
+    # Function runs blocking cache function in threadpool, inside the limiter of the event loop
+    async def run_limited(self, function, *args):
+        async with self.get_limiter():
+            return await run_in_threadpool(function, *args)
+
+    # Function runs blocking function in planner executor (bounded, calls are counted for the request)
+    async def run_blocking(self, function, *args):
+        return await asyncio.wrap_future(self.executor.submit(function, *args))
+
+    # Function awaits function(*arguments) for every arguments, results keep the order
+    # Every call can wait for mongo cache in threadpool, so calls go through the limiter of the event loop
+    # Function must not use the limiter itself
+    async def gather_limited(self, function, arguments):
+        limiter = self.get_limiter()
+
+        async def limited(args):
+            async with limiter:
+                return await function(*args)
+
+        return list(await asyncio.gather(*[limited(args) for args in arguments]))
+
+    async def get_depot_coords_async(self, depot_address):
+        async with self.get_limiter():
+            return await geocoding_service.geocode_async(depot_address)
+
+    # Coordinates are returned in order of addresses
+    async def get_addresses_coords_async(self, addresses, progress=no_progress):
+        done = 0
+
+        async def geocode(address):
+            nonlocal done
+            coords = await geocoding_service.geocode_async(address)
+            done += 1
+            progress('geocoding', done=done, total=len(addresses))
+            return coords
+
+        return await self.gather_limited(geocode, [(address,) for address in addresses])
+
+    async def set_waypoints_google_async(self, avoid_tolls, start, addresses, end):
+        if len(addresses) > DIRECTIONS_MAX_WAYPOINTS:
+            return await self.run_blocking(self.set_waypoints_local, start, addresses, end)
+
+        directions_result = await maps_gateway.directions_async(start,
+                                                                end,
+                                                                waypoints=addresses,
+                                                                mode='driving',
+                                                                optimize_waypoints=True,
+                                                                avoid='tolls' if avoid_tolls is True else None)
+
+        return [addresses[i] for i in directions_result[0]['waypoint_order']]
+
+    # Groups of one route depend on each other (group starts where previous one ended), so only routes are ordered concurrently
+    async def order_route_async(self, avoid_tolls, df_label, start_depot, end_depot, engine=None):
+        if engine is None:
+            engine = self.config.ORDERING_ENGINE
+        if engine != 'google':
+            return await self.run_blocking(self.order_route, avoid_tolls, df_label, start_depot, end_depot, engine)
+
+        groups = [group for group in self.split_priorities(df_label) if len(group) != 0]
+        ordered_addresses = []
+        start = start_depot
+        for i, group in enumerate(groups):
+            end = geometry.centroid(groups[i + 1]) if i + 1 < len(groups) else end_depot
+            ordered_addresses = ordered_addresses + await self.set_waypoints_google_async(avoid_tolls, start, group, end)
+            start = ordered_addresses[-1]
+
+        return [start_depot] + ordered_addresses + [end_depot]
+
+    async def get_distance_matrix_async(self, origins, destinations, local=False):
+        local_matrix = geometry.haversine_matrix(origins, destinations)
+        if local is True or self.config.SEMI_DEPOT_MATRIX == 'local':
+            return local_matrix
+
+        matrix = local_matrix.copy()
+        parts = self.distance_matrix_parts(origins, destinations)
+        results = await asyncio.gather(*[maps_gateway.distance_matrix_async(origins[first_row:last_row],
+                                                                            destinations[first_column:last_column],
+                                                                            mode='driving')
+                                         for first_row, last_row, first_column, last_column in parts])
+        for (first_row, _, first_column, _), result in zip(parts, results):
+            self.fill_distance_matrix(matrix, first_row, first_column, result)
+
+        return matrix
+
+    async def order_routes_async(self, avoid_tolls, df, depot_address, semi_depot_addresses_coords, engine=None, progress=no_progress):
+        ordered = []
+        if len(semi_depot_addresses_coords) != 0:
+            centroids = self.cluster_centroids(df)
+            origins, destinations = self.semi_depot_matrix_points(centroids, depot_address, semi_depot_addresses_coords)
+            distances = await self.get_distance_matrix_async(origins, destinations)
+            ordered = self.assign_semi_depots(centroids, depot_address, semi_depot_addresses_coords, distances=distances)
+
+        ends, order_of_routes = self.route_ends(df, depot_address, semi_depot_addresses_coords, ordered)
+
+        waypoints = {}
+
+        async def order(label, start_depot, end_depot):
+            waypoints[label] = await self.order_route_async(avoid_tolls, df[df['label'] == label], start_depot, end_depot, engine)
+            progress('route_ordered', route=order_of_routes.index(label), done=len(waypoints), total=len(ends))
+
+        await asyncio.gather(*[order(label, start_depot, end_depot) for label, (start_depot, end_depot) in ends.items()])
+
+        return waypoints, order_of_routes
+
+    async def request_route_legs_async(self, avoid_tolls, waypoints):
+        payload = self.create_compute_routes_payload(avoid_tolls, waypoints)
+
+        return self.parse_route_legs(await maps_gateway.compute_routes_async(payload, ROUTE_LEGS_FIELD_MASK))
+
+    # Parts of a long route are requested concurrently
+    async def get_route_metrics_async(self, avoid_tolls, waypoints):
+        legs = await self.run_limited(leg_cache.get_route_legs, waypoints, avoid_tolls)
+        if any(leg is None for leg in legs):
+            parts = await asyncio.gather(*[self.request_route_legs_async(avoid_tolls, part) for part in self.split_route(waypoints)])
+            legs = [leg for part in parts for leg in part]
+            await self.run_limited(leg_cache.set_route_legs, waypoints, avoid_tolls, legs)
+
+        return self.metrics_from_legs(legs)
+
+    async def price_routes_async(self, avoid_tolls, waypoints, order_of_routes, progress=no_progress):
+        metrics = {}
+
+        async def price(label):
+            metrics[label] = await self.get_route_metrics_async(avoid_tolls, waypoints[label])
+            progress('metrics', route=order_of_routes.index(label), done=len(metrics), total=len(order_of_routes))
+
+        await asyncio.gather(*[price(label) for label in order_of_routes])
+
+        return self.build_routes(waypoints, metrics, order_of_routes)
+
+    # Function returns coords_names with names of all other points of routes, every point is reverse geocoded once
+    async def add_address_names_async(self, routes, coords_names):
+        missing = list(dict.fromkeys((coord[0], coord[1]) for value in routes.values() for coord in value[0]
+                                     if (coord[0], coord[1]) not in coords_names))
+        names = await self.gather_limited(geocoding_service.reverse_geocode_async, missing)
+
+        return {**coords_names, **dict(zip(missing, names))}
+
+    async def get_routes_async(self, depot_address, semi_depot_addresses, addresses, priorities, days, distance_limit, duration_limit,
+                               preferences, avoid_tolls, centroids=None, progress=no_progress):
+        '''
+        Asyncio version of get_routes, params and result are the same
+        '''
+
+        self.check_parameters(semi_depot_addresses, addresses, days)
+
+        # Depot, addresses and semi depots are geocoded at once
+        depot_coords, addresses_coords, semi_depot_addresses_coords = await asyncio.gather(
+            self.get_depot_coords_async(depot_address),
+            self.get_addresses_coords_async(addresses, progress),
+            self.get_addresses_coords_async(semi_depot_addresses))
+
+        # Not in planner executor, regions submit their plans to it and wait for them
+        best_df = await run_in_threadpool(self.choose_plan, addresses_coords, priorities, days, depot_coords, semi_depot_addresses_coords,
+                                          distance_limit, duration_limit, preferences, centroids)
+        progress('clustering', days=days)
+
+        waypoints, order_of_routes = await self.order_routes_async(avoid_tolls, best_df, depot_coords, semi_depot_addresses_coords,
+                                                                   progress=progress)
+        routes = await self.price_routes_async(avoid_tolls, waypoints, order_of_routes, progress)
+
+        # Check if real routes do not break daily limitation
+        routes = self.check_real_routes(routes, distance_limit, duration_limit)
+
+        # Change names of output values
+        addresses_priorities_dict, coords_names, semi_depot_coords = self.name_locations(depot_address, depot_coords, semi_depot_addresses,
+                                                                                          semi_depot_addresses_coords, addresses,
+                                                                                          addresses_coords, priorities)
+        coords_names = await self.add_address_names_async(routes, coords_names)
+
+        return self.add_parameter_names_to_output(routes, addresses_priorities_dict, coords_names, semi_depot_coords)
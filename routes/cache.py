@@ -0,0 +1,86 @@
+import copy
+import threading
+from datetime import datetime, timedelta
+
+from cachetools import TTLCache
+from loguru import logger
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+
+class TwoTierCache():
+    '''
+    Cache with an in-process LRU (bounded by maxsize, entries expire after ttl seconds)
+    in front of a mongo collection shared by every replica.
+    Documents in mongo look like {'_id': key, 'value': value, 'created_at': datetime}.
+    Mongo errors are logged and treated as a miss, cache must never break planning.
+    If max_documents is set, oldest documents above that number are removed every trim_every writes.
+    '''
+
+    def __init__(self, collection: Collection, ttl: int, maxsize: int, max_documents=None, trim_every=1000):
+        self.collection = collection
+        self.ttl = ttl
+        self.max_documents = max_documents
+        self.trim_every = trim_every
+        self.writes = 0
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.counters = {'memory_hits': 0, 'mongo_hits': 0, 'misses': 0}
+
+    def get(self, key):
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.counters['memory_hits'] += 1
+                return copy.deepcopy(value)
+
+        # Expired documents are skipped here, mongo TTL index removes them later
+        try:
+            document = self.collection.find_one({'_id': key,
+                                                 'created_at': {'$gte': datetime.utcnow() - timedelta(seconds=self.ttl)}})
+        except PyMongoError as e:
+            logger.warning(f"Cache read from {self.collection.name} failed: {str(e)}")
+            document = None
+
+        with self.lock:
+            if document is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['mongo_hits'] += 1
+            self.memory[key] = document['value']
+        return copy.deepcopy(document['value'])
+
+    def set(self, key, value, **fields):
+        with self.lock:
+            self.memory[key] = copy.deepcopy(value)
+            self.writes += 1
+            should_trim = self.max_documents is not None and self.writes % self.trim_every == 0
+
+        try:
+            self.collection.update_one({'_id': key},
+                                       {'$set': {'value': value, 'created_at': datetime.utcnow(), **fields}},
+                                       upsert=True)
+            if should_trim:
+                self.trim()
+        except PyMongoError as e:
+            logger.warning(f"Cache write to {self.collection.name} failed: {str(e)}")
+
+    # Function removes oldest documents, so collection does not grow above max_documents
+    def trim(self):
+        excess = self.collection.estimated_document_count() - self.max_documents
+        if excess <= 0:
+            return
+        oldest = self.collection.find({}, {'_id': 1}).sort('created_at', 1).limit(excess)
+        ids = [document['_id'] for document in oldest]
+        self.collection.delete_many({'_id': {'$in': ids}})
+        logger.info(f"Trimmed {len(ids)} documents from {self.collection.name}")
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+            size = len(self.memory)
+        requests = counters['memory_hits'] + counters['mongo_hits'] + counters['misses']
+        hits = counters['memory_hits'] + counters['mongo_hits']
+        counters['memory_size'] = size
+        counters['hit_rate'] = round(hits / requests, 4) if requests != 0 else 0.0
+        return counters
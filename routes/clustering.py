@@ -0,0 +1,130 @@
+import time
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+from routes import tsp
+
+# Improvement has to be bigger than that, otherwise float errors could make search loop forever
+EPSILON = 1e-9
+# Improvement passes of tours of clusters before locations are moved
+TOUR_PASSES = 2
+
+
+# Function clusters points (array of shape (n, 2)) into days clusters, returns label of every point
+# Results are repeatable for the same random_state, above minibatch_threshold points MiniBatchKMeans is used
+# With init (centroids of previous routes) clustering is warm started and runs only once
+def kmeans_labels(points, days, random_state, n_init=10, init=None, minibatch_threshold=1000):
+    if init is None:
+        init = 'k-means++'
+    else:
+        init = np.asarray(init, dtype=np.float64)
+        n_init = 1
+
+    model_class = MiniBatchKMeans if len(points) > minibatch_threshold else KMeans
+    model = model_class(n_clusters=days, init=init, n_init=n_init, random_state=random_state)
+    return model.fit_predict(points)
+
+
+# Function splits days between regions proportionally to number of locations in them
+# Every region gets at least one day and never more days than it has locations
+def split_days(sizes, days):
+    sizes = np.asarray(sizes)
+    shares = sizes / sizes.sum() * days
+    region_days = np.minimum(np.maximum(1, np.floor(shares)).astype(int), sizes)
+    while region_days.sum() < days:
+        region_days[int(np.argmax(np.where(region_days < sizes, shares - region_days, -np.inf)))] += 1
+    while region_days.sum() > days:
+        region_days[int(np.argmax(np.where(region_days > 1, region_days - shares, -np.inf)))] -= 1
+    return region_days
+
+
+# Function returns how much routes exceed the limit in total
+def overflow(costs, limit):
+    return sum(max(0.0, cost - limit) for cost in costs.values())
+
+
+# Function moves points between clusters until every estimated route fits in the limit
+# Labels are KMeans labels of points 1..n of cost matrix, point 0 is the depot
+# Every cluster keeps a tour (ordered with a few improvement passes at start), moves are priced incrementally:
+# point is cut out of its tour and inserted into cheapest position of other tour
+# Every step takes the move that reduces overflow the most, ties are broken by the smallest growth of total cost
+# Search stops when routes fit, no move helps or after max_moves moves, so the same input gives the same labels
+# Time budget is only a safety limit, labels are returned also when routes still do not fit
+def balance_labels(cost_matrix, labels, days, limit, time_budget=10, max_moves=500):
+    labels = np.asarray(labels).copy()
+    tours = {}
+    costs = {}
+    for label in range(days):
+        members = [int(i) + 1 for i in np.flatnonzero(labels == label)]
+        tours[label] = np.array(initial_tour(cost_matrix, members))
+        costs[label] = path_cost(cost_matrix, tours[label])
+
+    deadline = time.monotonic() + time_budget
+    moves = 0
+    while moves < max_moves and time.monotonic() < deadline:
+        current_overflow = overflow(costs, limit)
+        if current_overflow <= EPSILON:
+            break
+
+        best = None
+        for source in [label for label in range(days) if costs[label] > limit and len(tours[label]) > 3]:
+            points = tours[source][1:-1]
+            source_costs = costs[source] - removal_gains(cost_matrix, tours[source])
+            for target in range(days):
+                if target == source:
+                    continue
+                insertion_costs, positions = cheapest_insertions(cost_matrix, tours[target], points)
+                target_costs = costs[target] + insertion_costs
+                new_overflow = (current_overflow - excess(costs[source], limit) - excess(costs[target], limit)
+                                + excess(source_costs, limit) + excess(target_costs, limit))
+                growth = source_costs + target_costs - costs[source] - costs[target]
+                # First point with the smallest (overflow, growth)
+                i = int(np.lexsort((growth, new_overflow))[0])
+                score = (float(new_overflow[i]), float(growth[i]))
+                if best is None or score < best[0]:
+                    best = (score, i, source, target, int(positions[i]), float(source_costs[i]), float(target_costs[i]))
+
+        if best is None or best[0][0] >= current_overflow - EPSILON:
+            break
+
+        _, i, source, target, position, source_cost, target_cost = best
+        point = int(tours[source][i + 1])
+        tours[source] = np.delete(tours[source], i + 1)
+        tours[target] = np.insert(tours[target], position, point)
+        costs[source] = source_cost
+        costs[target] = target_cost
+        labels[point - 1] = target
+        moves += 1
+
+    return labels
+
+
+# Tour depot -> members -> depot, ordered close to the order routes get later, so only needed moves are made
+def initial_tour(cost_matrix, members):
+    indexes = [0] + list(members) + [0]
+    sub_matrix = cost_matrix[np.ix_(indexes, indexes)]
+    return [0] + [indexes[i] for i in tsp.solve_path(sub_matrix, max_passes=TOUR_PASSES)] + [0]
+
+
+def path_cost(cost_matrix, tour):
+    return float(cost_matrix[tour[:-1], tour[1:]].sum())
+
+
+# How much shorter tour gets when each of its points (without depots) is cut out
+def removal_gains(cost_matrix, tour):
+    before, points, after = tour[:-2], tour[1:-1], tour[2:]
+    return cost_matrix[before, points] + cost_matrix[points, after] - cost_matrix[before, after]
+
+
+# Extra cost of inserting each point into its cheapest position of tour and that position
+def cheapest_insertions(cost_matrix, tour, points):
+    starts, ends = tour[:-1], tour[1:]
+    extra = (cost_matrix[np.ix_(starts, points)] + cost_matrix[np.ix_(points, ends)].T
+             - cost_matrix[starts, ends][:, np.newaxis])
+    positions = np.argmin(extra, axis=0)
+    return extra[positions, np.arange(len(points))], positions + 1
+
+
+def excess(cost, limit):
+    return np.maximum(0.0, cost - limit)
@@ -0,0 +1,109 @@
+import re
+
+from loguru import logger
+from pymongo import MongoClient
+from starlette.concurrency import run_in_threadpool
+
+from config import Config
+from maps_gateway import maps_gateway
+from routes.cache import TwoTierCache
+
+
+class GeocodingService():
+    def __init__(self, config):
+        self.config = config
+        self.client: MongoClient = MongoClient(self.config.MONGO)
+        self.cache = TwoTierCache(self.client.route_db.geocode_cache,
+                                  self.config.GEOCODE_CACHE_TTL,
+                                  self.config.GEOCODE_CACHE_SIZE)
+        self.reverse_cache = TwoTierCache(self.client.route_db.reverse_geocode_cache,
+                                          self.config.GEOCODE_CACHE_TTL,
+                                          self.config.GEOCODE_CACHE_SIZE)
+        logger.info("Inited geocoding service")
+
+    # Same address typed with different case or spacing has to hit the same cache entry
+    def normalize_address(self, address):
+        address = ' '.join(address.lower().split())
+        return re.sub(r'\s*,\s*', ', ', address).strip(', ')
+
+    # Function transforms string address to coordinates, returns {'lat': ..., 'lng': ...}
+    def geocode(self, address):
+        key = self.normalize_address(address)
+        location = self.cache.get(key)
+        if location is not None:
+            return location
+
+        location = maps_gateway.geocode(address)[0]['geometry']['location']
+        self.cache.set(key, location, address=address)
+        return location
+
+    # Function transforms coordinates to string address, e.g. "Kassyusza 7, 60-549 Poznań, Poland"
+    def reverse_geocode(self, lat, lng):
+        key = '{:.6f},{:.6f}'.format(lat, lng)
+        address_name = self.reverse_cache.get(key)
+        if address_name is not None:
+            return address_name
+
+        address_name = self.format_address_name(maps_gateway.reverse_geocode((lat, lng)))
+        self.reverse_cache.set(key, address_name)
+        return address_name
+
+    # Async versions, cache is read and written in threadpool, so mongo does not block event loop
+    async def geocode_async(self, address):
+        key = self.normalize_address(address)
+        location = await run_in_threadpool(self.cache.get, key)
+        if location is not None:
+            return location
+
+        location = (await maps_gateway.geocode_async(address))[0]['geometry']['location']
+        await run_in_threadpool(self.cache.set, key, location, address=address)
+        return location
+
+    async def reverse_geocode_async(self, lat, lng):
+        key = '{:.6f},{:.6f}'.format(lat, lng)
+        address_name = await run_in_threadpool(self.reverse_cache.get, key)
+        if address_name is not None:
+            return address_name
+
+        address_name = self.format_address_name(await maps_gateway.reverse_geocode_async((lat, lng)))
+        await run_in_threadpool(self.reverse_cache.set, key, address_name)
+        return address_name
+
+    # Function makes "Kassyusza 7, 60-549 Poznań, Poland" from reverse geocoding result
+    def format_address_name(self, result):
+        address_components = result[0]['address_components']
+
+        # Values valuable for us
+        route = ''
+        street_number = ''
+        city = ''
+        postal_code = ''
+        country = ''
+        for component in address_components:
+            types = component['types']
+            if 'route' in types:
+                route = component['long_name']
+            if 'street_number' in types:
+                street_number = component['long_name']
+            if 'postal_code' in types:
+                postal_code = component['long_name']
+            if 'locality' in types:
+                city = component['long_name']
+            if 'country' in types:
+                country = component['long_name']
+
+        address_name = "{} {}, {} {}, {}".format(route, street_number, postal_code, city, country)
+
+        splitted_address_name = address_name.split(',')
+        if splitted_address_name[0] ==' ':
+            splitted_address_name[0] = splitted_address_name[1][1:]
+            cleaned_address = [element.strip() for element in splitted_address_name]
+            address_name = ', '.join(cleaned_address)
+
+        return address_name
+
+    def stats(self):
+        return {'forward': self.cache.stats(), 'reverse': self.reverse_cache.stats()}
+
+
+geocoding_service = GeocodingService(Config())
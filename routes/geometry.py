@@ -0,0 +1,43 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+
+# Function converts list of (lat, lng) points (or dicts with 'lat' and 'lng') to float64 array of shape (n, 2)
+def to_array(points):
+    if len(points) != 0 and isinstance(points[0], dict):
+        points = [(point['lat'], point['lng']) for point in points]
+    return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+
+# Function returns haversine distances (km) between every origin and every destination, shape (origins, destinations)
+# Without destinations it returns distances between all origins
+def haversine_matrix(origins, destinations=None):
+    origins = np.radians(to_array(origins))
+    destinations = origins if destinations is None else np.radians(to_array(destinations))
+
+    lat1 = origins[:, 0][:, None]
+    lng1 = origins[:, 1][:, None]
+    lat2 = destinations[:, 0][None, :]
+    lng2 = destinations[:, 1][None, :]
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+# Function returns haversine distances (km) from one point to every point
+def haversine_one_to_many(point, points):
+    return haversine_matrix([point], points)[0]
+
+
+# Function returns center of points as (lat, lng), empty tuple if there are no points
+def centroid(points):
+    if len(points) == 0:
+        return tuple()
+    lat, lng = to_array(points).mean(axis=0)
+    return float(lat), float(lng)
+
+
+# Function returns index of a point that is the closest to given point
+def nearest_point(point, points):
+    return int(np.argmin(haversine_one_to_many(point, points)))
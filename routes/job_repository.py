@@ -0,0 +1,112 @@
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from fastapi import HTTPException
+from loguru import logger
+from pymongo import MongoClient
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+
+# Statuses of jobs that are not finished yet
+ACTIVE_STATUSES = ['queued', 'running']
+
+
+class JobRepository():
+    '''
+    State of routes generation jobs, kept in mongo so every replica can answer status polling
+    Status goes queued -> running -> done or failed
+    Jobs run only in the replica that created them (owner), the replica refreshes their heartbeat,
+    job whose heartbeat stopped (replica restarted) is reported as failed instead of being polled forever
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.client: MongoClient = MongoClient(self.config.MONGO)
+        self.db: Database = self.client.route_db
+        self.jobs_collection: Collection = self.client.route_db.jobs
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        logger.info("Inited jobs repo")
+
+    def create_job(self, uid, params):
+        document = {'user_firebase_id': uid,
+                    'status': 'queued',
+                    'params': params,
+                    'result': None,
+                    'error': None,
+                    'owner': self.owner,
+                    'created_at': datetime.utcnow(),
+                    'heartbeat_at': datetime.utcnow(),
+                    'started_at': None,
+                    'finished_at': None}
+        res = self.jobs_collection.insert_one(document)
+        return str(res.inserted_id)
+
+    def mark_running(self, job_id):
+        self.jobs_collection.update_one({'_id': ObjectId(job_id)},
+                                        {'$set': {'status': 'running', 'started_at': datetime.utcnow()}})
+
+    def mark_done(self, job_id, result):
+        self.jobs_collection.update_one({'_id': ObjectId(job_id)},
+                                        {'$set': {'status': 'done', 'result': result, 'finished_at': datetime.utcnow()}})
+
+    def mark_failed(self, job_id, error):
+        self.jobs_collection.update_one({'_id': ObjectId(job_id)},
+                                        {'$set': {'status': 'failed', 'error': error, 'finished_at': datetime.utcnow()}})
+
+    # Function refreshes heartbeat of not finished jobs of this replica, one update for all of them
+    def refresh_heartbeat(self):
+        self.jobs_collection.update_many({'owner': self.owner, 'status': {'$in': ACTIVE_STATUSES}},
+                                         {'$set': {'heartbeat_at': datetime.utcnow()}})
+
+    def heartbeat_loop(self):
+        stop = threading.Event()
+        while not stop.wait(self.config.JOB_HEARTBEAT_INTERVAL):
+            try:
+                self.refresh_heartbeat()
+            except PyMongoError as e:
+                logger.warning(f"Refreshing heartbeat of jobs failed: {str(e)}")
+
+    def start_heartbeat(self):
+        threading.Thread(target=self.heartbeat_loop, name='jobs-heartbeat', daemon=True).start()
+
+    # Job is marked failed only if its heartbeat is still old, so job that got heartbeat in the meantime is not touched
+    # Jobs saved before heartbeats have created_at in its place
+    def fail_if_stale(self, job):
+        if job['status'] not in ACTIVE_STATUSES:
+            return job
+        stale_before = datetime.utcnow() - timedelta(seconds=self.config.JOB_STALE_AFTER)
+        if job.get('heartbeat_at', job['created_at']) >= stale_before:
+            return job
+
+        error = "Job was interrupted, generate routes again"
+        result = self.jobs_collection.update_one({'_id': job['_id'],
+                                                  'status': {'$in': ACTIVE_STATUSES},
+                                                  '$or': [{'heartbeat_at': {'$lt': stale_before}},
+                                                          {'heartbeat_at': {'$exists': False}, 'created_at': {'$lt': stale_before}}]},
+                                                 {'$set': {'status': 'failed', 'error': error, 'finished_at': datetime.utcnow()}})
+        if result.modified_count == 0:
+            return self.jobs_collection.find_one({'_id': job['_id']}, {'params': 0})
+        logger.warning(f"Job {job['_id']} of {job.get('owner')} has no heartbeat since {job.get('heartbeat_at', job['created_at'])}, marked failed")
+        return dict(job, status='failed', error=error, finished_at=datetime.utcnow())
+
+    def get_job(self, uid, job_id):
+        try:
+            job = self.jobs_collection.find_one({'_id': ObjectId(job_id), 'user_firebase_id': uid}, {'params': 0})
+        except InvalidId:
+            raise HTTPException(status_code=404, detail="Job not found")
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        job = self.fail_if_stale(job)
+
+        return {'job_id': str(job['_id']),
+                'status': job['status'],
+                'created_at': job['created_at'],
+                'started_at': job['started_at'],
+                'finished_at': job['finished_at'],
+                'result': job['result'],
+                'error': job['error']}
@@ -0,0 +1,51 @@
+from loguru import logger
+from pymongo import MongoClient
+
+from config import Config
+from routes.cache import TwoTierCache
+
+# Part of every key, changed when legs are computed differently, so old legs are not read and expire with ttl
+# Version 2: fuel of route shared between legs by distance (legs cached before had fuel 0)
+LEG_CACHE_VERSION = 2
+
+
+class LegCache():
+    '''
+    Cache of single legs between two points, value is a dict:
+    {'distance_m': int, 'duration_s': float, 'fuel_microliters': int, 'polyline': str}
+    Coordinates are rounded to LEG_CACHE_PRECISION decimal places (5 is about 1 meter).
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.client: MongoClient = MongoClient(self.config.MONGO)
+        self.cache = TwoTierCache(self.client.route_db.leg_cache,
+                                  self.config.LEG_CACHE_TTL,
+                                  self.config.LEG_CACHE_SIZE,
+                                  max_documents=self.config.LEG_CACHE_MAX_DOCUMENTS)
+        logger.info("Inited leg cache")
+
+    def create_key(self, origin, destination, avoid_tolls):
+        precision = self.config.LEG_CACHE_PRECISION
+        return 'v{}|{:.{p}f},{:.{p}f}|{:.{p}f},{:.{p}f}|{}'.format(LEG_CACHE_VERSION, origin[0], origin[1], destination[0], destination[1],
+                                                                 bool(avoid_tolls), p=precision)
+
+    def get(self, origin, destination, avoid_tolls):
+        return self.cache.get(self.create_key(origin, destination, avoid_tolls))
+
+    def set(self, origin, destination, avoid_tolls, leg):
+        self.cache.set(self.create_key(origin, destination, avoid_tolls), leg)
+
+    # Function returns cached legs between consecutive waypoints, None in place of every missing leg
+    def get_route_legs(self, waypoints, avoid_tolls):
+        return [self.get(waypoints[i], waypoints[i + 1], avoid_tolls) for i in range(len(waypoints) - 1)]
+
+    def set_route_legs(self, waypoints, avoid_tolls, legs):
+        for i, leg in enumerate(legs):
+            self.set(waypoints[i], waypoints[i + 1], avoid_tolls, leg)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+leg_cache = LegCache(Config())
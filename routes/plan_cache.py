@@ -0,0 +1,136 @@
+import asyncio
+import copy
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+
+from loguru import logger
+from pymongo import MongoClient
+from starlette.concurrency import run_in_threadpool
+
+from routes.cache import TwoTierCache
+from routes.geocoding import geocoding_service
+
+# Digits after decimal point of numbers in cache key, 6 digits of coordinates is about 0.1 m
+KEY_PRECISION = 6
+
+
+class PlanCache():
+    '''
+    Cache of generated routes keyed by canonical hash of request parameters
+    Identical requests computed at the same time in this process are coalesced, only one of them runs the planner
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.client: MongoClient = MongoClient(self.config.MONGO)
+        self.cache = TwoTierCache(self.client.route_db.plan_cache,
+                                  self.config.PLAN_CACHE_TTL,
+                                  self.config.PLAN_CACHE_SIZE)
+        self.lock = threading.Lock()
+        self.in_progress = {}
+        logger.info("Inited plan cache")
+
+    # Order of addresses does not change the plan, order of semi depots does (it is a chain)
+    def create_key(self, params):
+        addresses = sorted(zip([geocoding_service.normalize_address(address) for address in params['addresses']],
+                               params['priorities']))
+        canonical = {'depot_address': geocoding_service.normalize_address(params['depot_address']),
+                     'semi_depot_addresses': [geocoding_service.normalize_address(address) for address in params['semi_depot_addresses'] or []],
+                     'addresses': addresses,
+                     'days': params['days'],
+                     'distance_limit': self.canonical_number(params['distance_limit']),
+                     'duration_limit': self.canonical_number(params['duration_limit']),
+                     'preferences': params['preferences'],
+                     'avoid_tolls': params['avoid_tolls'],
+                     'centroids': self.canonical_centroids(params.get('centroids'))}
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode('utf-8')).hexdigest()
+
+    # 100 and 100.0 are the same limit, float noise below KEY_PRECISION digits does not change the key
+    def canonical_number(self, value):
+        if value is None:
+            return None
+        return round(float(value), KEY_PRECISION)
+
+    def canonical_centroids(self, centroids):
+        if centroids is None:
+            return None
+        return [[self.canonical_number(value) for value in centroid] for centroid in centroids]
+
+    # Function returns cached routes or computes them with compute(), params are RoutesModel as dict
+    def get_or_compute(self, params, compute):
+        key = self.create_key(params)
+
+        routes = self.cache.get(key)
+        if routes is not None:
+            return self.from_document(routes)
+
+        future, is_leader = self.claim(key)
+
+        if not is_leader:
+            logger.info(f"Waiting for identical plan {key[:12]}")
+            return self.from_document(future.result())
+
+        try:
+            routes = self.to_document(compute())
+            self.cache.set(key, routes)
+            future.set_result(routes)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self.release(key)
+
+        return self.from_document(routes)
+
+    # Async version of get_or_compute, compute() returns coroutine
+    # Requests waiting for the same plan share it with sync requests computing it
+    async def get_or_compute_async(self, params, compute):
+        key = self.create_key(params)
+
+        routes = await run_in_threadpool(self.cache.get, key)
+        if routes is not None:
+            return self.from_document(routes)
+
+        future, is_leader = self.claim(key)
+
+        if not is_leader:
+            logger.info(f"Waiting for identical plan {key[:12]}")
+            return self.from_document(await asyncio.wrap_future(future))
+
+        try:
+            routes = self.to_document(await compute())
+            await run_in_threadpool(self.cache.set, key, routes)
+            future.set_result(routes)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self.release(key)
+
+        return self.from_document(routes)
+
+    # Function returns future of the plan computed for the key and True if caller has to compute it
+    def claim(self, key):
+        with self.lock:
+            future = self.in_progress.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self.in_progress[key] = future
+        return future, is_leader
+
+    def release(self, key):
+        with self.lock:
+            del self.in_progress[key]
+
+    # Mongo documents must have only string keys, planner returns routes under int keys
+    def to_document(self, routes):
+        return {str(key): value for key, value in routes.items()}
+
+    def from_document(self, document):
+        return {int(key): copy.deepcopy(value) for key, value in document.items()}
+
+    def stats(self):
+        return self.cache.stats()
@@ -1,67 +1,122 @@
 import pandas as pd
 import numpy as np
 from geopy.distance import geodesic
-from sklearn.cluster import KMeans
-from config import Config
-import googlemaps
-import requests
+from scipy.optimize import linear_sum_assignment
+from maps_gateway import ContextThreadPoolExecutor, maps_gateway
 import polyline
-from math import radians, sin, cos, sqrt, atan2
-import json
-import random
+import math
+from concurrent.futures import as_completed
 from bson.objectid import ObjectId
-
-gmaps = googlemaps.Client(key=Config.GOOGLEMAPS_API_KEY)
-
-# Necessary when using ML model
-random.seed(101)
+from loguru import logger
+from config import Config
+from routes.geocoding import geocoding_service
+from routes.leg_cache import leg_cache
+from routes import clustering, geometry, tsp
+from routes.progress import no_progress
+
+# Limits of google APIs, number of waypoints between origin and destination
+DIRECTIONS_MAX_WAYPOINTS = 25
+COMPUTE_ROUTES_MAX_INTERMEDIATES = 25
+# Distance matrix request can have at most 25 origins, 25 destinations and 100 elements
+DISTANCE_MATRIX_MAX_ORIGINS = 25
+DISTANCE_MATRIX_MAX_DESTINATIONS = 25
+DISTANCE_MATRIX_MAX_ELEMENTS = 100
+# Fuel consumption is given only for whole route, not for legs
+ROUTE_LEGS_FIELD_MASK = ('routes.legs.duration,routes.legs.distanceMeters,routes.legs.polyline.encodedPolyline,'
+                         'routes.travelAdvisory.fuelConsumptionMicroliters')
+
+# Shared by all planners and plans of the process, so the number of concurrent google requests stays bounded
+planner_executor = ContextThreadPoolExecutor(max_workers=Config().PLANNER_MAX_WORKERS)
 
 class RoutesPlanner():
     def __init__(self, config):
         self.config = config
+        self.executor = planner_executor
 
     # Function transforms string address of our depot to coordinates
     def get_depot_coords(self, depot_address):
-        return gmaps.geocode(depot_address)[0]['geometry']['location']
+        return geocoding_service.geocode(depot_address)
 
     # Function transforms string addresses of our locations to visit to coordinates
-    def get_addresses_coords(self, addresses):
+    def get_addresses_coords(self, addresses, progress=no_progress):
         addresses_coords = []
         for address in addresses:
-            coords = gmaps.geocode(address)[0]['geometry']['location']
+            coords = geocoding_service.geocode(address)
             addresses_coords.append(coords)
+            progress('geocoding', done=len(addresses_coords), total=len(addresses))
         return addresses_coords
 
     # Function uses KMeans to cluster location into clusters, df is our data in pandas DataFrame
-    # Days is a number of cluster
-    def cluster_addresses(self, df, days):
-        model = KMeans(n_clusters=days)
-        labels = model.fit_predict(df)
+    # Days is a number of cluster, same seed gives same clusters, init are centroids of previous routes (warm start)
+    def cluster_addresses(self, df, days, random_state=None, init=None):
+        if random_state is None:
+            random_state = self.config.CLUSTERING_SEED
+        labels = clustering.kmeans_labels(df[['lat', 'lng']].values, days, random_state, self.config.CLUSTERING_N_INIT,
+                                          init, self.config.MINIBATCH_THRESHOLD)
         df['label'] = labels
         return df
 
-    # Function that prepare centers of p2 and p1
-    def prepare_waypoints(self, p2_addresses, p1_addresses):
+    # Function moves locations between clusters, so estimated routes (depot -> locations -> depot) fit in daily limits
+    # Infeasible clustering is repaired before any route is priced, without limits KMeans labels are kept
+    def balance_clusters(self, df, depot_coords, distance_limit, duration_limit):
+        limits = []
+        if distance_limit is not None:
+            limits.append(distance_limit)
+        if duration_limit is not None:
+            limits.append(duration_limit / 60 * self.config.AVERAGE_SPEED_KMH)
+        if len(limits) == 0 or self.config.CLUSTERING_MODE != 'balanced':
+            return df
+
+        # Search works on haversine distances, so limit is scaled down by detour factor
+        limit = min(limits) / self.config.ROAD_DETOUR_FACTOR
+        cost_matrix = geometry.haversine_matrix([(depot_coords['lat'], depot_coords['lng'])] + list(zip(df['lat'], df['lng'])))
+        df['label'] = clustering.balance_labels(cost_matrix, df['label'].values, len(df['label'].unique()), limit,
+                                                self.config.CLUSTERING_TIME_BUDGET, self.config.CLUSTERING_MAX_MOVES)
+        return df
+
+    # Function to order waypoints, engine is chosen in config
+    # Engine 'estimate' is local ordering with fewer improvement passes, used to score candidate plans
+    # Priorities are used only by local engines, google ignores them
+    def set_waypoints(self, avoid_tolls, start, addresses, end, engine=None, priorities=None):
+        if engine is None:
+            engine = self.config.ORDERING_ENGINE
+        if engine == 'google':
+            return self.set_waypoints_google(avoid_tolls, start, addresses, end)
+        if engine == 'estimate':
+            return self.set_waypoints_local(start, addresses, end, self.config.CANDIDATE_TSP_TIME_BUDGET, priorities,
+                                            self.config.CANDIDATE_TSP_MAX_PASSES)
+        return self.set_waypoints_local(start, addresses, end, priorities=priorities)
+
+    # Function to order waypoints locally, start and end are fixed
+    # It does not send any request and there is no limit of waypoints
+    # Locations with higher priority are visited first, with PRIORITY_MODE 'soft' order can break it if it saves enough kilometers
+    # Number of improvement passes is limited, so the same waypoints are always ordered the same way
+    def set_waypoints_local(self, start, addresses, end, time_budget=None, priorities=None, max_passes=None):
+        if time_budget is None:
+            time_budget = self.config.TSP_TIME_BUDGET
+        if max_passes is None:
+            max_passes = self.config.TSP_MAX_PASSES
+        waypoints = [start] + addresses + [end]
+        cost_matrix = geometry.haversine_matrix(waypoints)
 
-        # Create centroid for p2 and p1
-        if len(p2_addresses) >= 1:
-            p2_lat_center = list(map(lambda coord: coord[0], p2_addresses))
-            p2_lng_center = list(map(lambda coord: coord[1], p2_addresses))
-            p2_center = (sum(p2_lat_center) / len(p2_lat_center), sum(p2_lng_center) / len(p2_lng_center))
-        else:
-            p2_center = tuple()
+        ranks = None
+        penalty = None
+        if priorities is not None:
+            ranks = [max(priorities) + 1] + list(priorities) + [0]
+            if self.config.PRIORITY_MODE == 'soft':
+                penalty = self.config.PRIORITY_PENALTY
 
-        if len(p1_addresses) >= 1:
-            p1_lat_center = list(map(lambda coord: coord[0], p1_addresses))
-            p1_lng_center = list(map(lambda coord: coord[1], p1_addresses))
-            p1_center = (sum(p1_lat_center) / len(p1_lat_center), sum(p1_lng_center) / len(p1_lng_center))
-        else:
-            p1_center = tuple()
+        # Indexes of addresses are shifted by one because of the start
+        optimal_order = tsp.solve_path(cost_matrix, time_budget, ranks, penalty, max_passes)
+        ordered_addresses = [addresses[i - 1] for i in optimal_order]
 
-        return p2_center, p1_center
+        return ordered_addresses
 
-    # Function to order waypoints
-    def set_waypoints(self, avoid_tolls, start, addresses, end):
+    # Function to order waypoints with google directions (maximum 25 waypoints)
+    # Groups bigger than directions limit are ordered locally
+    def set_waypoints_google(self, avoid_tolls, start, addresses, end):
+        if len(addresses) > DIRECTIONS_MAX_WAYPOINTS:
+            return self.set_waypoints_local(start, addresses, end)
 
         if avoid_tolls is True:
             avoid = 'tolls'
@@ -71,12 +126,12 @@ class RoutesPlanner():
         # Define waypoints
         waypoints = [start] + addresses + [end]
         # Direction from google
-        directions_result = gmaps.directions(waypoints[0],
-                                             waypoints[-1],
-                                             waypoints=waypoints[1:-1],
-                                             mode='driving',
-                                             optimize_waypoints=True,
-                                             avoid=avoid)
+        directions_result = maps_gateway.directions(waypoints[0],
+                                                    waypoints[-1],
+                                                    waypoints=waypoints[1:-1],
+                                                    mode='driving',
+                                                    optimize_waypoints=True,
+                                                    avoid=avoid)
 
         # List with ordered addresses indexes
         optimal_order = directions_result[0]['waypoint_order']
@@ -86,61 +141,26 @@ class RoutesPlanner():
 
         return ordered_addresses
 
-    # Function returns correct waypoints order for whole route (all priorities)
+    # Function orders all locations of a route, locations with higher priority are visited first
+    # Local engines order whole route in one pass, priority is precedence constraint of the solver
+    # Google can not keep priorities, so groups are ordered one after another, every group heads to center of the next one
     def get_all_waypoints(self, avoid_tolls, priority3_addresses, priority2_addresses, priority1_addresses, start_depot, end_depot,
-                          p2_center, p1_center):
-
-        # There are several combinations, number in a string says that there is at least one location with that priority
-        # 321, 32, 31, 3, 21, 2, 1
-        if len(priority3_addresses) >= 1 and len(priority2_addresses) >= 1 and len(priority1_addresses) >= 1:
-            ordered_addresses = []
-            ordered_addresses1 = self.set_waypoints(avoid_tolls, start_depot, priority3_addresses, p2_center)
-            ordered_addresses = ordered_addresses + ordered_addresses1
-
-            ordered_addresses2 = self.set_waypoints(avoid_tolls, ordered_addresses[-1], priority2_addresses, p1_center)
-            ordered_addresses = ordered_addresses + ordered_addresses2
-
-            ordered_addresses3 = self.set_waypoints(avoid_tolls, ordered_addresses[-1], priority1_addresses, end_depot)
-            ordered_addresses = ordered_addresses + ordered_addresses3
-
-        if len(priority3_addresses) >= 1 and len(priority2_addresses) >= 1 and len(priority1_addresses) < 1:
-            ordered_addresses = []
-            ordered_addresses1 = self.set_waypoints(avoid_tolls, start_depot, priority3_addresses, p2_center)
-            ordered_addresses = ordered_addresses + ordered_addresses1
-
-            ordered_addresses2 = self.set_waypoints(avoid_tolls, ordered_addresses[-1], priority2_addresses, end_depot)
-            ordered_addresses = ordered_addresses + ordered_addresses2
-
-        if len(priority3_addresses) >= 1 and len(priority2_addresses) < 1 and len(priority1_addresses) >= 1:
-            ordered_addresses = []
-            ordered_addresses1 = self.set_waypoints(avoid_tolls, start_depot, priority3_addresses, p1_center)
-            ordered_addresses = ordered_addresses + ordered_addresses1
-
-            ordered_addresses2 = self.set_waypoints(avoid_tolls, ordered_addresses[-1], priority1_addresses, end_depot)
-            ordered_addresses = ordered_addresses + ordered_addresses2
-
-        if len(priority3_addresses) >= 1 and len(priority2_addresses) < 1 and len(priority1_addresses) < 1:
-            ordered_addresses = []
-            ordered_addresses1 = self.set_waypoints(avoid_tolls, start_depot, priority3_addresses, end_depot)
-            ordered_addresses = ordered_addresses + ordered_addresses1
-
-        if len(priority3_addresses) < 1 and len(priority2_addresses) >= 1 and len(priority1_addresses) >= 1:
-            ordered_addresses = []
-            ordered_addresses1 = self.set_waypoints(avoid_tolls, start_depot, priority2_addresses, p1_center)
-            ordered_addresses = ordered_addresses + ordered_addresses1
-
-            ordered_addresses2 = self.set_waypoints(avoid_tolls, ordered_addresses[-1], priority1_addresses, end_depot)
-            ordered_addresses = ordered_addresses + ordered_addresses2
-
-        if len(priority3_addresses) < 1 and len(priority2_addresses) >= 1 and len(priority1_addresses) < 1:
-            ordered_addresses = []
-            ordered_addresses1 = self.set_waypoints(avoid_tolls, start_depot, priority2_addresses, end_depot)
-            ordered_addresses = ordered_addresses + ordered_addresses1
-
-        if len(priority3_addresses) < 1 and len(priority2_addresses) < 1 and len(priority1_addresses) >= 1:
-            ordered_addresses = []
-            ordered_addresses1 = self.set_waypoints(avoid_tolls, start_depot, priority1_addresses, end_depot)
-            ordered_addresses = ordered_addresses + ordered_addresses1
+                          engine=None):
+        if engine is None:
+            engine = self.config.ORDERING_ENGINE
+
+        if engine != 'google':
+            addresses = priority3_addresses + priority2_addresses + priority1_addresses
+            priorities = [3] * len(priority3_addresses) + [2] * len(priority2_addresses) + [1] * len(priority1_addresses)
+            return self.set_waypoints(avoid_tolls, start_depot, addresses, end_depot, engine, priorities)
+
+        groups = [group for group in (priority3_addresses, priority2_addresses, priority1_addresses) if len(group) != 0]
+        ordered_addresses = []
+        start = start_depot
+        for i, group in enumerate(groups):
+            end = geometry.centroid(groups[i + 1]) if i + 1 < len(groups) else end_depot
+            ordered_addresses = ordered_addresses + self.set_waypoints(avoid_tolls, start, group, end, engine)
+            start = ordered_addresses[-1]
 
         return ordered_addresses
 
@@ -154,15 +174,8 @@ class RoutesPlanner():
             }
         }
 
-    # Function to create request that will return distance, duration, polyline of whole route
-    def get_distance_duration(self, avoid_tolls, waypoints):
-        url = 'https://routes.googleapis.com/directions/v2:computeRoutes'
-        headers = {
-            'Content-Type': 'application/json',
-            'X-Goog-Api-Key': Config.GOOGLEMAPS_API_KEY,
-            'X-Goog-FieldMask': 'routes.duration,routes.distanceMeters,routes.polyline.encodedPolyline,routes.travelAdvisory.fuelConsumptionMicroliters'
-        }
-
+    # Function to create body of computeRoutes request going through all waypoints
+    def create_compute_routes_payload(self, avoid_tolls, waypoints):
         intermediates = []
         for i in range(1, len(waypoints) - 1):
             lat, lng = waypoints[i]
@@ -175,263 +188,215 @@ class RoutesPlanner():
             avoid = False
 
         payload = {
-            "origin": {
-                "location": {
-                    "latLng": {
-                        "latitude": waypoints[0][0],
-                        "longitude": waypoints[0][1]
-                    }
-                }
-            },
-            "destination": {
-                "location": {
-                    "latLng": {
-                        "latitude": waypoints[-1][0],
-                        "longitude": waypoints[-1][1]
-                    }
-                }
-            },
+            "origin": self.create_json_intermediate(waypoints[0][0], waypoints[0][1]),
+            "destination": self.create_json_intermediate(waypoints[-1][0], waypoints[-1][1]),
             "intermediates": intermediates,
-            "routeModifiers": {
-                "vehicleInfo": {
-                    "emissionType": "GASOLINE"
-                }
-            },
-
             "travelMode": "DRIVE",
             "routingPreference": "TRAFFIC_AWARE_OPTIMAL",
             "routeModifiers": {
-                "avoidTolls": avoid
-            },
-            "extraComputations": ["FUEL_CONSUMPTION"]
-        }
-
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-
-        data = response.json()
-
-        # Take whole distance
-        distance_m = data['routes'][0]['distanceMeters']
-        distance_km = distance_m / 1000
-
-        # Take whole duration
-        duration_string = data['routes'][0]['duration']
-        duration_s = float(duration_string[:-1])
-        duration_min = duration_s / 60
-
-        # Take polyline
-        poly = data['routes'][0]['polyline']['encodedPolyline']
-        polylines = self.get_polylines(avoid_tolls, waypoints)
-
-        return distance_km, duration_min, poly, polylines
-
-    # Function to get polylines between points
-    def get_polylines(self, avoid_tolls, waypoints):
-        url = 'https://routes.googleapis.com/directions/v2:computeRoutes'
-        headers = {
-            'Content-Type': 'application/json',
-            'X-Goog-Api-Key': Config.GOOGLEMAPS_API_KEY,
-            'X-Goog-FieldMask': 'routes.duration,routes.distanceMeters,routes.polyline.encodedPolyline,routes.travelAdvisory.fuelConsumptionMicroliters'
-        }
-
-        if avoid_tolls is True:
-            avoid = True
-        else:
-            avoid = False
-
-        polylines = []
-
-        for i in range(len(waypoints)-1):
-            payload = {
-                "origin": {
-                    "location": {
-                        "latLng": {
-                            "latitude": waypoints[i][0],
-                            "longitude": waypoints[i][1]
-                        }
-                    }
-                },
-                "destination": {
-                    "location": {
-                        "latLng": {
-                            "latitude": waypoints[i+1][0],
-                            "longitude": waypoints[i+1][1]
-                        }
-                    }
-                },
-                "travelMode": "DRIVE",
-                "routingPreference": "TRAFFIC_AWARE_OPTIMAL",
-                "routeModifiers": {
-                    "avoidTolls": avoid
-                },
-                "extraComputations": ["FUEL_CONSUMPTION"]
-            }
-
-            response = requests.post(url, headers=headers, data=json.dumps(payload))
-
-            data = response.json()
-
-            polylines.append(data['routes'][0]['polyline']['encodedPolyline'])
-
-        return polylines
-
-    # Function to create request that will return fuel consumption between 2 points
-    def get_fuel_between_points(self, avoid_tolls, origin, destination):
-        url = 'https://routes.googleapis.com/directions/v2:computeRoutes'
-        headers = {
-            'Content-Type': 'application/json',
-            'X-Goog-Api-Key': Config.GOOGLEMAPS_API_KEY,
-            'X-Goog-FieldMask': 'routes.duration,routes.distanceMeters,routes.polyline.encodedPolyline,routes.travelAdvisory.fuelConsumptionMicroliters'
-        }
-
-        if avoid_tolls is True:
-            avoid = True
-        else:
-            avoid = False
-
-        payload = {
-            "origin": {
-                "location": {
-                    "latLng": {
-                        "latitude": origin[0],
-                        "longitude": origin[1]
-                    }
-                }
-            },
-            "destination": {
-                "location": {
-                    "latLng": {
-                        "latitude": destination[0],
-                        "longitude": destination[1]
-                    }
-                }
-            },
-            "routeModifiers": {
+                "avoidTolls": avoid,
                 "vehicleInfo": {
                     "emissionType": "GASOLINE"
                 }
             },
-            "travelMode": "DRIVE",
-            "routingPreference": "TRAFFIC_AWARE_OPTIMAL",
-            "routeModifiers": {
-                "avoidTolls": avoid
-            },
             "extraComputations": ["FUEL_CONSUMPTION"]
         }
 
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-
-        data = response.json()
-
-        # Take fuel in Microliters
-        fuel_micro = data['routes'][0]['travelAdvisory']['fuelConsumptionMicroliters']
-        fuel_liters = int(fuel_micro) / 1000000
+        return payload
+
+    # Function to create request that will return distance, duration, fuel and polyline of every leg of the route
+    # One request per route, legs are taken from the same response
+    def request_route_legs(self, avoid_tolls, waypoints):
+        payload = self.create_compute_routes_payload(avoid_tolls, waypoints)
+
+        return self.parse_route_legs(maps_gateway.compute_routes(payload, ROUTE_LEGS_FIELD_MASK))
+
+    # Function returns legs of computeRoutes response, every leg connects waypoints[i] and waypoints[i + 1]
+    def parse_route_legs(self, data):
+        if len(data.get('routes', [])) == 0:
+            raise ValueError('Can not compute routes for those locations')
+
+        route = data['routes'][0]
+        legs = []
+        for leg in route['legs']:
+            legs.append({
+                'distance_m': leg.get('distanceMeters', 0),
+                'duration_s': float(leg['duration'][:-1]),
+                'polyline': leg['polyline']['encodedPolyline']
+            })
+
+        distances = [leg['distance_m'] for leg in legs]
+        fuel_microliters = route.get('travelAdvisory', {}).get('fuelConsumptionMicroliters')
+        if fuel_microliters is None:
+            # Google does not estimate fuel for every route, then it is estimated from distance like in candidate plans
+            logger.warning("Google returned no fuel consumption for route, it is estimated from distance")
+            fuel_microliters = sum(distances) / 1000 * self.config.FUEL_LITERS_PER_KM * 1000000
+        for leg, fuel in zip(legs, self.share_by_distance(int(fuel_microliters), distances)):
+            leg['fuel_microliters'] = fuel
+
+        return legs
+
+    # Function splits total between legs proportionally to their distances, shares are ints and sum to total
+    def share_by_distance(self, total, distances):
+        route_distance = sum(distances)
+        if route_distance == 0:
+            return [total if i == len(distances) - 1 else 0 for i in range(len(distances))]
+        bounds = [round(total * covered / route_distance) for covered in np.cumsum([0] + distances)]
+        return [int(bounds[i + 1] - bounds[i]) for i in range(len(distances))]
+
+    # Function joins polylines of consecutive legs into polyline of whole route
+    def merge_polylines(self, polylines):
+        points = []
+        for encoded in polylines:
+            decoded = polyline.decode(encoded)
+            if len(points) != 0 and len(decoded) != 0 and points[-1] == decoded[0]:
+                decoded = decoded[1:]
+            points.extend(decoded)
+        return polyline.encode(points)
+
+    # Function returns distance, duration, fuel and polylines of whole route and of every leg
+    # Legs are read from leg cache, Google is asked only if any leg of the route is missing
+    def get_route_metrics(self, avoid_tolls, waypoints):
+        legs = leg_cache.get_route_legs(waypoints, avoid_tolls)
+        if any(leg is None for leg in legs):
+            legs = []
+            for part in self.split_route(waypoints):
+                legs = legs + self.request_route_legs(avoid_tolls, part)
+            leg_cache.set_route_legs(waypoints, avoid_tolls, legs)
+
+        return self.metrics_from_legs(legs)
+
+    # Long routes are split into parts that fit in one request, neighbouring parts share a waypoint
+    def split_route(self, waypoints):
+        step = COMPUTE_ROUTES_MAX_INTERMEDIATES + 1
+        return [waypoints[i:i + step + 1] for i in range(0, len(waypoints) - 1, step)]
+
+    def metrics_from_legs(self, legs):
+        polylines = [leg['polyline'] for leg in legs]
+
+        return {
+            'distance_km': sum(leg['distance_m'] for leg in legs) / 1000,
+            'duration_min': sum(leg['duration_s'] for leg in legs) / 60,
+            'fuel_liters': sum(leg['fuel_microliters'] for leg in legs) / 1000000,
+            'polyline': self.merge_polylines(polylines),
+            'polylines': polylines,
+            'legs': legs
+        }
 
-        return fuel_liters
+    # Function returns matrix of driving distances (km) from every origin to every destination
+    # Google is asked once per part of matrix that fits in its limits, local haversine matrix is used if configured or if google can not find a route
+    def get_distance_matrix(self, origins, destinations, local=False):
+        local_matrix = geometry.haversine_matrix(origins, destinations)
+        if local is True or self.config.SEMI_DEPOT_MATRIX == 'local':
+            return local_matrix
+
+        matrix = local_matrix.copy()
+        for first_row, last_row, first_column, last_column in self.distance_matrix_parts(origins, destinations):
+            result = maps_gateway.distance_matrix(origins=origins[first_row:last_row],
+                                                  destinations=destinations[first_column:last_column],
+                                                  mode='driving')
+            self.fill_distance_matrix(matrix, first_row, first_column, result)
+
+        return matrix
+
+    # Function returns parts of matrix asked in one request, (first row, last row, first column, last column), last ones are excluded
+    def distance_matrix_parts(self, origins, destinations):
+        parts = []
+        for first_column in range(0, len(destinations), DISTANCE_MATRIX_MAX_DESTINATIONS):
+            last_column = min(first_column + DISTANCE_MATRIX_MAX_DESTINATIONS, len(destinations))
+            rows_per_request = min(DISTANCE_MATRIX_MAX_ORIGINS, DISTANCE_MATRIX_MAX_ELEMENTS // (last_column - first_column))
+            for first_row in range(0, len(origins), rows_per_request):
+                parts.append((first_row, min(first_row + rows_per_request, len(origins)), first_column, last_column))
+        return parts
+
+    # Routes found by google replace haversine distances
+    def fill_distance_matrix(self, matrix, first_row, first_column, result):
+        for i, row in enumerate(result['rows']):
+            for j, element in enumerate(row['elements']):
+                if element['status'] == 'OK':
+                    matrix[first_row + i, first_column + j] = element['distance']['value'] / 1000
+
+    # Function assigns every cluster to a part of the chain depot -> semi depot 0 -> ... -> semi depot n-1 -> depot
+    # Returns dict {label: [start, end]}, where -1 means depot and other numbers are indexes of semi depots
+    # Assignment minimizes summed distance from clusters centroids to both ends of their parts
+    # Distances can be given if they were already computed, otherwise they are taken from get_distance_matrix
+    def assign_semi_depots(self, centroids, depot_address, semi_depot_addresses_coords, local=False, distances=None):
+        origins, destinations = self.semi_depot_matrix_points(centroids, depot_address, semi_depot_addresses_coords)
+
+        # Depot is the last column of distance matrix
+        if distances is None:
+            distances = self.get_distance_matrix(origins, destinations, local)
+        depot_column = len(destinations) - 1
+
+        segments = [[-1, 0]] + [[i, i + 1] for i in range(len(semi_depot_addresses_coords) - 1)] + [[len(semi_depot_addresses_coords) - 1, -1]]
+
+        costs = np.zeros((len(origins), len(segments)))
+        for j, (start, end) in enumerate(segments):
+            start_column = depot_column if start == -1 else start
+            end_column = depot_column if end == -1 else end
+            costs[:, j] = distances[:, start_column] + distances[:, end_column]
+
+        rows, columns = linear_sum_assignment(costs)
+
+        # Clusters left without a part (more clusters than parts) start and end in depot
+        labels = [int(label) for label in centroids['label']]
+        order = {label: [-1, -1] for label in labels}
+        for row, column in zip(rows, columns):
+            order[labels[row]] = segments[column]
+
+        return dict(sorted(order.items()))
+
+    # Origins are centroids of clusters, destinations are semi depots and depot (last)
+    def semi_depot_matrix_points(self, centroids, depot_address, semi_depot_addresses_coords):
+        origins = list(zip(centroids['lat'], centroids['lng']))
+        destinations = [(address['lat'], address['lng']) for address in semi_depot_addresses_coords]
+        destinations.append((depot_address['lat'], depot_address['lng']))
+        return origins, destinations
 
     # Function takes data in DataFrame format and converted coordinates of our addresses
     # In this function we set optimal order of the waypoints in every route
-    def set_optimal_waypoints(self, avoid_tolls, df, depot_address, semi_depot_addresses_coords):
+    def set_optimal_waypoints(self, avoid_tolls, df, depot_address, semi_depot_addresses_coords, progress=no_progress):
+        waypoints, order_of_routes = self.order_routes(avoid_tolls, df, depot_address, semi_depot_addresses_coords, progress=progress)
+        return self.price_routes(avoid_tolls, waypoints, order_of_routes, progress)
+
+    # Function orders waypoints of every cluster, returns dict {label: waypoints} and order in which routes are driven
+    # With engine 'estimate' nothing is sent to google
+    def order_routes(self, avoid_tolls, df, depot_address, semi_depot_addresses_coords, engine=None, progress=no_progress):
 
         ordered = []
         # Put semi depots in right place
         if len(semi_depot_addresses_coords) != 0:
-            centroids = df.groupby('label').agg({'lat': 'mean', 'lng': 'mean'}).reset_index()
-
-            # Calculate distances to semi-depot addresses and add as new columns
-            for i, address in enumerate(semi_depot_addresses_coords):
-                dist_col = f'distance_to_{i}'
-
-                centroids[dist_col] = centroids.apply(lambda row: gmaps.distance_matrix(
-                    origins=(row['lat'], row['lng']),
-                    destinations=(address['lat'], address['lng']),
-                    mode='driving')['rows'][0]['elements'][0]['distance']['value'], axis=1)
-
-            if len(semi_depot_addresses_coords) == 1:
-                df_sorted = centroids.sort_values(by='distance_to_0')
-                min_label = int(df_sorted.iloc[0]['label'])
-                df_sorted = df_sorted.drop(df_sorted[df_sorted['label'] == min_label].index)
-                second_label = int(df_sorted.iloc[0]['label'])
-                order = {min_label: [-1, 0], second_label: [0, -1]}
-                ordered = dict(sorted(order.items()))
-            if len(semi_depot_addresses_coords) == 2:
-                min_distance_label_0 = int(centroids.loc[centroids['distance_to_0'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_0].index)
-                centroids['distance_sum_01'] = centroids['distance_to_0'] + centroids['distance_to_1']
-                min_distance_label_01 = int(centroids.loc[centroids['distance_sum_01'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_01].index)
-                min_distance_label_1 = int(centroids.loc[centroids['distance_to_1'].idxmin()]['label'])
-                order = {min_distance_label_0: [-1, 0], min_distance_label_01: [0, 1], min_distance_label_1: [1, -1]}
-                ordered = dict(sorted(order.items()))
-            if len(semi_depot_addresses_coords) == 3:
-                min_distance_label_0 = int(centroids.loc[centroids['distance_to_0'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_0].index)
-                centroids['distance_sum_01'] = centroids['distance_to_0'] + centroids['distance_to_1']
-                min_distance_label_01 = int(centroids.loc[centroids['distance_sum_01'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_01].index)
-                centroids['distance_sum_12'] = centroids['distance_to_1'] + centroids['distance_to_2']
-                min_distance_label_12 = int(centroids.loc[centroids['distance_sum_12'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_12].index)
-                min_distance_label_2 = int(centroids.loc[centroids['distance_to_2'].idxmin()]['label'])
-                order = {min_distance_label_0: [-1, 0], min_distance_label_01: [0, 1], min_distance_label_12: [1, 2], min_distance_label_2: [2,-1]}
-                ordered = dict(sorted(order.items()))
-            if len(semi_depot_addresses_coords) == 4:
-                min_distance_label_0 = int(centroids.loc[centroids['distance_to_0'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_0].index)
-                centroids['distance_sum_01'] = centroids['distance_to_0'] + centroids['distance_to_1']
-                min_distance_label_01 = int(centroids.loc[centroids['distance_sum_01'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_01].index)
-                centroids['distance_sum_12'] = centroids['distance_to_1'] + centroids['distance_to_2']
-                min_distance_label_12 = int(centroids.loc[centroids['distance_sum_12'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_12].index)
-                centroids['distance_sum_23'] = centroids['distance_to_2'] + centroids['distance_to_3']
-                min_distance_label_23 = int(centroids.loc[centroids['distance_sum_23'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_23].index)
-                min_distance_label_3 = int(centroids.loc[centroids['distance_to_3'].idxmin()]['label'])
-                order = {min_distance_label_0: [-1, 0], min_distance_label_01: [0, 1], min_distance_label_12: [1, 2], min_distance_label_23: [2, 3], min_distance_label_3: [3, -1]}
-                ordered = dict(sorted(order.items()))
-            if len(semi_depot_addresses_coords) == 5:
-                min_distance_label_0 = int(centroids.loc[centroids['distance_to_0'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_0].index)
-                centroids['distance_sum_01'] = centroids['distance_to_0'] + centroids['distance_to_1']
-                min_distance_label_01 = int(centroids.loc[centroids['distance_sum_01'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_01].index)
-                centroids['distance_sum_12'] = centroids['distance_to_1'] + centroids['distance_to_2']
-                min_distance_label_12 = int(centroids.loc[centroids['distance_sum_12'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_12].index)
-                centroids['distance_sum_23'] = centroids['distance_to_2'] + centroids['distance_to_3']
-                min_distance_label_23 = int(centroids.loc[centroids['distance_sum_23'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_23].index)
-                centroids['distance_sum_34'] = centroids['distance_to_3'] + centroids['distance_to_4']
-                min_distance_label_34 = int(centroids.loc[centroids['distance_sum_34'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_34].index)
-                min_distance_label_4 = int(centroids.loc[centroids['distance_to_4'].idxmin()]['label'])
-                order = {min_distance_label_0: [-1, 0], min_distance_label_01: [0, 1], min_distance_label_12: [1, 2], min_distance_label_23: [2, 3], min_distance_label_34: [3, 4], min_distance_label_4: [4, -1]}
-                ordered = dict(sorted(order.items()))
-            if len(semi_depot_addresses_coords) == 6:
-                min_distance_label_0 = int(centroids.loc[centroids['distance_to_0'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_0].index)
-                centroids['distance_sum_01'] = centroids['distance_to_0'] + centroids['distance_to_1']
-                min_distance_label_01 = int(centroids.loc[centroids['distance_sum_01'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_01].index)
-                centroids['distance_sum_12'] = centroids['distance_to_1'] + centroids['distance_to_2']
-                min_distance_label_12 = int(centroids.loc[centroids['distance_sum_12'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_12].index)
-                centroids['distance_sum_23'] = centroids['distance_to_2'] + centroids['distance_to_3']
-                min_distance_label_23 = int(centroids.loc[centroids['distance_sum_23'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_23].index)
-                centroids['distance_sum_34'] = centroids['distance_to_3'] + centroids['distance_to_4']
-                min_distance_label_34 = int(centroids.loc[centroids['distance_sum_34'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_34].index)
-                centroids['distance_sum_45'] = centroids['distance_to_4'] + centroids['distance_to_5']
-                min_distance_label_45 = int(centroids.loc[centroids['distance_sum_45'].idxmin()]['label'])
-                centroids = centroids.drop(centroids[centroids['label'] == min_distance_label_45].index)
-                min_distance_label_5 = int(centroids.loc[centroids['distance_to_5'].idxmin()]['label'])
-                order = {min_distance_label_0: [-1, 0], min_distance_label_01: [0, 1], min_distance_label_12: [1, 2], min_distance_label_23: [2, 3], min_distance_label_34: [3, 4], min_distance_label_45: [4, 5], min_distance_label_5: [5, -1]}
-                ordered = dict(sorted(order.items()))
-
-        # For every cluster(route)
-        routes = {}
+            centroids = self.cluster_centroids(df)
+            ordered = self.assign_semi_depots(centroids, depot_address, semi_depot_addresses_coords, engine == 'estimate')
+
+        ends, order_of_routes = self.route_ends(df, depot_address, semi_depot_addresses_coords, ordered)
+
+        # Estimates are computed locally, there is no point in using threads for them
+        if engine == 'estimate':
+            waypoints = {label: self.order_route(avoid_tolls, df[df['label'] == label], start_depot, end_depot, engine)
+                         for label, (start_depot, end_depot) in ends.items()}
+            return waypoints, order_of_routes
+
+        # Clusters are independent, so routes are ordered concurrently, pool size limits requests sent at once
+        # Route number is position of the route in order of routes
+        futures = {self.executor.submit(self.order_route, avoid_tolls, df[df['label'] == label], start_depot, end_depot, engine): label
+                   for label, (start_depot, end_depot) in ends.items()}
+        waypoints = {}
+        for future in as_completed(futures):
+            label = futures[future]
+            waypoints[label] = future.result()
+            progress('route_ordered', route=order_of_routes.index(label), done=len(waypoints), total=len(futures))
+
+        return waypoints, order_of_routes
+
+    def cluster_centroids(self, df):
+        return df.groupby('label').agg({'lat': 'mean', 'lng': 'mean'}).reset_index()
+
+    # Function returns start and end of every cluster(route) {label: (start, end)} and order in which routes are driven
+    # ordered is result of assign_semi_depots, empty if there are no semi depots
+    def route_ends(self, df, depot_address, semi_depot_addresses_coords, ordered):
+        ends = {}
+        order_of_routes = list(range(0, len(df['label'].unique())))
         for label in range(0, len(df['label'].unique())):
 
             if len(ordered) != 0:
@@ -452,45 +417,154 @@ class RoutesPlanner():
                 start_depot = (depot_address['lat'], depot_address['lng'])
                 end_depot = (depot_address['lat'], depot_address['lng'])
 
-            df_label = df[df['label'] == label]
+            ends[label] = (start_depot, end_depot)
 
-            # Create dataframe for every priority
-            priority3_df = df_label[df_label['priority'] == 3][['lat', 'lng']]
-            priority2_df = df_label[df_label['priority'] == 2][['lat', 'lng']]
-            priority1_df = df_label[df_label['priority'] == 1][['lat', 'lng']]
+        return ends, order_of_routes
 
-            # Convert dataframe to list
-            priority3_addresses = list(zip(priority3_df['lat'], priority3_df['lng']))
-            priority2_addresses = list(zip(priority2_df['lat'], priority2_df['lng']))
-            priority1_addresses = list(zip(priority1_df['lat'], priority1_df['lng']))
+    # Function orders waypoints of one cluster, returns whole route including depots
+    def order_route(self, avoid_tolls, df_label, start_depot, end_depot, engine=None):
+        priority3_addresses, priority2_addresses, priority1_addresses = self.split_priorities(df_label)
 
-            # Get centers of priority2 and priority1
-            p2_center, p1_center = self.prepare_waypoints(priority2_addresses, priority1_addresses)
+        # Get ordered waypoints for whole route
+        ordered_addresses = self.get_all_waypoints(avoid_tolls, priority3_addresses, priority2_addresses, priority1_addresses,
+                                                   start_depot, end_depot, engine)
 
-            # Get ordered waypoints for whole route
-            ordered_addresses = self.get_all_waypoints(avoid_tolls, priority3_addresses, priority2_addresses, priority1_addresses,
-                                                  start_depot, end_depot, p2_center, p1_center)
+        # Whole route in the correct order, including depot
+        return [start_depot] + ordered_addresses + [end_depot]
 
-            # Whole route in the correct order, including depot
-            waypoints = [start_depot] + ordered_addresses + [end_depot]
+    # Function returns lists of (lat, lng) of a cluster with priority 3, 2 and 1
+    def split_priorities(self, df_label):
 
-            # Calculate distance and duration for whole route
-            total_distance, total_duration, polyline, polylines = self.get_distance_duration(avoid_tolls, waypoints)
+        # Create dataframe for every priority
+        priority3_df = df_label[df_label['priority'] == 3][['lat', 'lng']]
+        priority2_df = df_label[df_label['priority'] == 2][['lat', 'lng']]
+        priority1_df = df_label[df_label['priority'] == 1][['lat', 'lng']]
 
-            # Calculate fuel consumption
-            total_fuel = 0
-            for i in range(len(waypoints) - 1):
-                origin = waypoints[i]
-                destination = waypoints[i + 1]
-                fuel_consumption = self.get_fuel_between_points(avoid_tolls, origin, destination)
-                total_fuel = total_fuel + fuel_consumption
+        # Convert dataframe to list
+        priority3_addresses = list(zip(priority3_df['lat'], priority3_df['lng']))
+        priority2_addresses = list(zip(priority2_df['lat'], priority2_df['lng']))
+        priority1_addresses = list(zip(priority1_df['lat'], priority1_df['lng']))
 
-            routes[label] = [waypoints, total_distance, total_duration, total_fuel, polyline, polylines]
+        return priority3_addresses, priority2_addresses, priority1_addresses
 
-        if len(ordered) != 0:
-            routes = {index: routes[index] for index in order_of_routes}
+    # Function calculates distance, duration, fuel consumption and polylines of ordered routes, one request per route
+    # Routes are priced concurrently and returned in order of routes
+    def price_routes(self, avoid_tolls, waypoints, order_of_routes, progress=no_progress):
+        futures = {self.executor.submit(self.get_route_metrics, avoid_tolls, waypoints[label]): label for label in order_of_routes}
+
+        metrics = {}
+        for future in as_completed(futures):
+            label = futures[future]
+            metrics[label] = future.result()
+            progress('metrics', route=order_of_routes.index(label), done=len(metrics), total=len(futures))
+
+        return self.build_routes(waypoints, metrics, order_of_routes)
+
+    # Function returns routes {label: [waypoints, distance, duration, fuel, polyline, polylines]} in order of routes
+    def build_routes(self, waypoints, metrics, order_of_routes):
+        routes = {}
+        for label in order_of_routes:
+            routes[label] = [waypoints[label], metrics[label]['distance_km'], metrics[label]['duration_min'], metrics[label]['fuel_liters'],
+                             metrics[label]['polyline'], metrics[label]['polylines']]
         return routes
 
+    # Function estimates distance, duration and fuel consumption of ordered routes without any request
+    # Haversine distance is multiplied by detour factor, duration and fuel come from average speed and consumption
+    def estimate_routes(self, waypoints, order_of_routes):
+        routes = {}
+        for label in order_of_routes:
+            points = waypoints[label]
+            legs = geometry.haversine_matrix(points)[np.arange(len(points) - 1), np.arange(1, len(points))]
+            distance_km = float(legs.sum()) * self.config.ROAD_DETOUR_FACTOR
+            duration_min = distance_km / self.config.AVERAGE_SPEED_KMH * 60
+            fuel_liters = distance_km * self.config.FUEL_LITERS_PER_KM
+            routes[label] = [points, distance_km, duration_min, fuel_liters, None, None]
+        return routes
+
+    # Function generates candidate plans (different KMeans seeds and reclustering moves) and scores them locally
+    # First candidate is warm started from centroids of previous routes, if they are given
+    # Returns list of (df with labels, estimated routes), there is no request to google
+    def generate_candidates(self, df_addresses, days, depot_coords, semi_depot_addresses_coords, distance_limit=None, duration_limit=None,
+                            centroids=None):
+        candidates = []
+        seeds = range(self.config.PLAN_CANDIDATE_SEEDS) if days > 1 else range(1)
+        for seed in seeds:
+            init = centroids if seed == 0 else None
+            df = self.cluster_addresses(df_addresses[['lat', 'lng']].copy(), days, self.config.CLUSTERING_SEED + seed, init)
+            df = self.balance_clusters(df, depot_coords, distance_limit, duration_limit)
+            df['priority'] = df_addresses['priority'].values
+
+            # Every move takes location closest to the shortest route from the longest route
+            for move in range(days):
+                waypoints, order_of_routes = self.order_routes(None, df, depot_coords, semi_depot_addresses_coords, 'estimate')
+                routes = self.estimate_routes(waypoints, order_of_routes)
+                candidates.append((df, routes))
+                if len(candidates) >= self.config.PLAN_CANDIDATES:
+                    return candidates
+                if move == days - 1:
+                    break
+
+                routes_by_label = {label: routes[label] for label in sorted(routes)}
+                df = self.reorganise_routes(routes_by_label, self.calculate_distances(routes_by_label), df)
+
+        return candidates
+
+    # Function chooses candidate plan that minimize given preferences, plans breaking limits (estimated) are skipped
+    # Estimates are not exact, if every candidate breaks limits we let real metrics decide
+    # With warm_start first candidate keeps previous routes, it is chosen unless other one is better by more than WARM_START_MARGIN
+    # Returns df with labels of chosen plan
+    def choose_candidate(self, candidates, distance_limit, duration_limit, preferences, warm_start=False):
+        all_routes = self.check_limitations([routes for _, routes in candidates], distance_limit, duration_limit)
+        if isinstance(all_routes, str):
+            all_routes = [routes for _, routes in candidates]
+        best_routes = self.choose_min_routes(all_routes, preferences)
+
+        warm_routes = candidates[0][1]
+        if warm_start is True and any(routes is warm_routes for routes in all_routes):
+            margin = self.preference_total(warm_routes, preferences) * self.config.WARM_START_MARGIN
+            if self.preference_total(best_routes, preferences) >= self.preference_total(warm_routes, preferences) - margin:
+                best_routes = warm_routes
+
+        return next(df for df, routes in candidates if routes is best_routes)
+
+    # Sum of distances, durations or fuel of all routes, depending on preference
+    def preference_total(self, routes, preference):
+        column = {'distance': 1, 'duration': 2, 'fuel': 3}[preference]
+        return sum(value[column] for value in routes.values())
+
+    # Function plans big problems hierarchically: region -> day -> route
+    # Locations are split into regions of at most REGION_DAYS days, regions are planned in parallel and labels are stitched together
+    # Work of one region does not depend on size of whole problem, so planning time grows linearly with number of regions
+    def plan_regions(self, df_addresses, days, depot_coords, distance_limit, duration_limit, preferences):
+        regions = math.ceil(days / self.config.REGION_DAYS)
+        labels = clustering.kmeans_labels(df_addresses[['lat', 'lng']].values, regions, self.config.CLUSTERING_SEED,
+                                          self.config.CLUSTERING_N_INIT, None, self.config.MINIBATCH_THRESHOLD)
+        region_days = clustering.split_days(np.bincount(labels, minlength=regions), days)
+
+        # Semi depots are assigned when regions are stitched, inside a region every route starts and ends in depot
+        futures = []
+        for region in range(regions):
+            df_region = df_addresses[labels == region].reset_index(drop=True)
+            futures.append(self.executor.submit(self.plan_region, df_region, int(region_days[region]), depot_coords,
+                                                distance_limit, duration_limit, preferences))
+
+        # Rows get back index of df_addresses, so every address can be found in stitched plan
+        dfs = []
+        offset = 0
+        for region in range(regions):
+            df = futures[region].result()
+            df.index = df_addresses.index[labels == region][df.index]
+            df['label'] = df['label'] + offset
+            offset += int(region_days[region])
+            dfs.append(df[['lat', 'lng', 'label', 'priority']])
+
+        return pd.concat(dfs).sort_index()
+
+    # Function returns df with labels of best candidate plan of one region
+    def plan_region(self, df_region, days, depot_coords, distance_limit, duration_limit, preferences):
+        candidates = self.generate_candidates(df_region, days, depot_coords, [], distance_limit, duration_limit)
+        return self.choose_candidate(candidates, distance_limit, duration_limit, preferences)
+
     # Function take dict with optimized routes
     # Arranges a list of total distances
     def calculate_distances(self, routes):
@@ -515,26 +589,11 @@ class RoutesPlanner():
             fuels.append(routes[fuel][3])
         return fuels
 
-    # Function takes dict with optimized routes and list od total distances
+    # Function takes dict with optimized routes, list od total distances and df of the plan (locations with labels)
     # In case a route breaks a distance or a duration daily limit we have to rearrange clusters (routes)
     # We move location from longest route, that is most similar (is the closest to the centroid) to the shortest route and put it in there
-    def reorganise_routes(self, routes, distances, df_addresses):
-
-        # Function take dict with routes
-        # Convert data do DataFrame for further set_optimal_waypoints(df, depot_address) usage
-        def routes_to_df(routes, df_addresses):
-            df_list = []
-            for key in routes:
-                data = routes[key][0][1:-1]
-                df_list.append(pd.DataFrame({'lat': [coord[0] for coord in data],
-                                             'lng': [coord[1] for coord in data],
-                                             'label': key}))
-
-            df = pd.concat(df_list, ignore_index=True)
-            # We need to add priority column
-            merged_df = pd.merge(df, df_addresses[['lat', 'lng', 'priority']], on=['lat', 'lng'], how='inner')
-
-            return merged_df
+    # Rows keep index of df_addresses, so addresses with the same coordinates stay separate rows and only one of them is moved
+    def reorganise_routes(self, routes, distances, df):
 
         # Function takes dict with optimized routes and list od total distances
         # Function finds a location that will be reclustered
@@ -554,52 +613,56 @@ class RoutesPlanner():
                 distances[longest_route] = 0
 
             # Calculate centroid for shortest route, including depot
-            lat_center = [p[0] for p in routes[shortest_route][0]]
-            lng_center = [p[1] for p in routes[shortest_route][0]]
-            center = (sum(lat_center) / len(routes[0][0]), sum(lng_center) / len(routes[0][0]))
-
-            # Function to calculate distance between 2 coords
-            # Packages which do this, sometimes return an error
-            def calculate_distance(lat1, lon1, lat2, lon2):
-                earth_radius = 6371.0
-
-                # Convert the coordinates from degrees to radians
-                lat1_rad = radians(lat1)
-                lon1_rad = radians(lon1)
-                lat2_rad = radians(lat2)
-                lon2_rad = radians(lon2)
-
-                # Differences between the coordinates
-                dlat = lat2_rad - lat1_rad
-                dlon = lon2_rad - lon1_rad
-
-                # Haversine formula
-                a = sin(dlat / 2) ** 2 + cos(lat1_rad) * cos(lat2_rad) * sin(dlon / 2) ** 2
-                c = 2 * atan2(sqrt(a), sqrt(1 - a))
-                distance = earth_radius * c
-
-                return distance
+            center = geometry.centroid(routes[shortest_route][0])
 
             # Find closest point to centroid from longest route
-            min_distance = float('inf')
-            closest_location = None
-            for location in routes[longest_route][0][1:-1]:
-                distance = calculate_distance(center[0], center[1], location[0], location[1])
-                if distance < min_distance:
-                    min_distance = distance
-                    closest_location = location
+            locations = routes[longest_route][0][1:-1]
+            closest_location = locations[geometry.nearest_point(center, locations)]
 
             return shortest_route, longest_route, closest_location
 
         shortest_route, longest_route, location = find_location_to_recluster(routes, distances)
 
-        df = routes_to_df(routes, df_addresses)
-
-        # Change the value in column 'label' for a reclustered point
-        df.loc[(df['lat'] == location[0]) & (df['lng'] == location[1]), 'label'] = shortest_route
+        # Change the value in column 'label' for a reclustered point, previous plan is not changed
+        df = df.copy()
+        rows = df.index[(df['label'] == longest_route) & (df['lat'] == location[0]) & (df['lng'] == location[1])]
+        df.loc[rows[0], 'label'] = shortest_route
 
         return df
 
+    # Function finds positions where a kept location can be inserted into saved routes, cheapest first
+    # Location can be put only after the last marked location of a route and must not break order of priorities
+    # Extra distance is estimated with local cost model, positions breaking daily limits are skipped
+    # Returns list of (route key, index of location in route after insertion, extra km)
+    def find_insertion_positions(self, routes, location, distance_limit, duration_limit):
+        if distance_limit is None:
+            distance_limit = float('inf')
+        if duration_limit is None:
+            duration_limit = float('inf')
+        point = (location['latitude'], location['longitude'])
+        priority = location['priority']
+
+        positions = []
+        for key, route in routes.items():
+            coords = route['coords']
+            points = [(item['latitude'], item['longitude']) for item in coords]
+            to_point = geometry.haversine_one_to_many(point, points)
+            first = max([i for i, item in enumerate(coords) if item['visited'] is not None], default=0)
+            for i in range(first, len(coords) - 1):
+                before = [item['priority'] for item in coords[first + 1:i + 1] if item['isDepot'] is False]
+                after = [item['priority'] for item in coords[i + 1:] if item['isDepot'] is False]
+                if any(p < priority for p in before) or any(p > priority for p in after):
+                    continue
+
+                leg = geometry.haversine_matrix([points[i]], [points[i + 1]])[0, 0]
+                extra_km = float(to_point[i] + to_point[i + 1] - leg) * self.config.ROAD_DETOUR_FACTOR
+                distance_km = route['distance_km'] + extra_km
+                duration_min = route['duration_hours'] * 60 + extra_km / self.config.AVERAGE_SPEED_KMH * 60
+                if distance_km <= distance_limit and duration_min <= duration_limit:
+                    positions.append((extra_km, key, i + 1))
+
+        return [(key, index, extra_km) for extra_km, key, index in sorted(positions)]
+
     # We have to check if any route break daily limitations, and if so, we have to remove it from the list
     def check_limitations(self, all_routes, distance_limit, duration_limit):
         if distance_limit is None:
@@ -628,41 +691,13 @@ class RoutesPlanner():
         return all_routes[index_of_min_sum]
 
     # Function adds string address of a location
+    # Used only for points without address given by user, results are cached
     def add_address_name(self, lat, lng):
-        result = gmaps.reverse_geocode((lat, lng))
-        address_components = result[0]['address_components']
-
-        # Values valuable for us
-        route = ''
-        street_number = ''
-        city = ''
-        postal_code = ''
-        country = ''
-        for component in address_components:
-            types = component['types']
-            if 'route' in types:
-                route = component['long_name']
-            if 'street_number' in types:
-                street_number = component['long_name']
-            if 'postal_code' in types:
-                postal_code = component['long_name']
-            if 'locality' in types:
-                city = component['long_name']
-            if 'country' in types:
-                country = component['long_name']
-
-        address_name = "{} {}, {} {}, {}".format(route, street_number, postal_code, city, country)
-
-        splitted_address_name = address_name.split(',')
-        if splitted_address_name[0] ==' ':
-            splitted_address_name[0] = splitted_address_name[1][1:]
-            cleaned_address = [element.strip() for element in splitted_address_name]
-            address_name = ', '.join(cleaned_address)
-
-        return address_name
+        return geocoding_service.reverse_geocode(lat, lng)
 
     # Function changes names of output values
-    def add_parameter_names_to_output(self, routes, addresses_priorities_dict, semi_depot_addresses):
+    # coords_names maps (lat, lng) to address given by user, semi_depot_coords is a set of (lat, lng) of semi depots
+    def add_parameter_names_to_output(self, routes, addresses_priorities_dict, coords_names, semi_depot_coords):
         routes_dict = {}
         original_keys = list(routes.keys())
         routes = {i: routes[key] for i, key in enumerate(original_keys)}
@@ -682,23 +717,86 @@ class RoutesPlanner():
             polylines.append(value[5])
 
         for key in routes_dict:
-            routes_dict[key]['coords'] = [{'latitude': coord[0],
-                                           'longitude': coord[1],
-                                           'name': self.add_address_name(coord[0], coord[1]),
-                                           'priority': addresses_priorities_dict.get((coord[0], coord[1])),
-                                           'location_number': i,
-                                           'visited': None,
-                                           'should_keep': None,
-                                           'polyline_to_next_point': None,
-                                           'isDepot': i == 0 or i == len(routes_dict[key]['coords']) - 1,
-                                           'isSemiDepot': self.add_address_name(coord[0], coord[1]) in semi_depot_addresses} for i, coord in enumerate(routes_dict[key]['coords'])]
+            coords = routes_dict[key]['coords']
+            routes_dict[key]['coords'] = []
+            for i, coord in enumerate(coords):
+                name = coords_names.get((coord[0], coord[1]))
+                if name is None:
+                    name = self.add_address_name(coord[0], coord[1])
+                is_depot = i == 0 or i == len(coords) - 1
+                routes_dict[key]['coords'].append({'latitude': coord[0],
+                                                   'longitude': coord[1],
+                                                   'name': name,
+                                                   'priority': addresses_priorities_dict.get((coord[0], coord[1])),
+                                                   'location_number': i,
+                                                   'visited': None,
+                                                   'should_keep': None,
+                                                   'polyline_to_next_point': None,
+                                                   'isDepot': is_depot,
+                                                   'isSemiDepot': is_depot and (coord[0], coord[1]) in semi_depot_coords})
         for i in range(len(polylines)):
             for j in range(len(polylines[i])):
                 routes_dict[i]['coords'][j]['polyline_to_next_point'] = polylines[i][j]
 
         return routes_dict
 
-    def get_routes(self, depot_address, semi_depot_addresses, addresses, priorities, days, distance_limit, duration_limit, preferences, avoid_tolls):
+    # Function raises ValueError if routes can not be planned for those parameters, nothing is geocoded before that
+    def check_parameters(self, semi_depot_addresses, addresses, days):
+        if days > self.config.MAX_DAYS:
+            raise ValueError('Maximum number of days is {}'.format(self.config.MAX_DAYS))
+        if days > len(addresses):
+            raise ValueError('To little addresses')
+        if len(semi_depot_addresses) != 0 and days - len(semi_depot_addresses) != 1:
+            raise ValueError('Number of semi depots must equal days - 1')
+
+    # Function returns DataFrame with labels of the best candidate plan, there is no request to google
+    # Long plans are split into regions planned separately
+    def choose_plan(self, addresses_coords, priorities, days, depot_coords, semi_depot_addresses_coords, distance_limit, duration_limit,
+                    preferences, centroids=None):
+        # For further convenience we put data into pandas DataFrame
+        df_addresses = pd.DataFrame(addresses_coords)
+
+        # Add priority column
+        df_addresses['priority'] = priorities
+
+        if days > self.config.REGION_DAYS:
+            return self.plan_regions(df_addresses, days, depot_coords, distance_limit, duration_limit, preferences)
+
+        # Previous routes are used only if there is one for every day
+        if centroids is not None and len(centroids) != days:
+            centroids = None
+        candidates = self.generate_candidates(df_addresses, days, depot_coords, semi_depot_addresses_coords, distance_limit, duration_limit,
+                                              centroids)
+        return self.choose_candidate(candidates, distance_limit, duration_limit, preferences, centroids is not None)
+
+    # Function returns priced routes if they fit in limits, raises ValueError otherwise
+    def check_real_routes(self, routes, distance_limit, duration_limit):
+        all_routes = self.check_limitations([routes], distance_limit, duration_limit)
+
+        if all_routes == 'to_small_distance':
+            raise ValueError('To small distance limit')
+        if all_routes == 'to_small_duration':
+            raise ValueError('To small duration limit')
+        if len(all_routes) == 0:
+            raise ValueError('Can not compute routes for this parameters. Modify parameters.')
+        return all_routes[0]
+
+    # Function returns arguments of add_parameter_names_to_output: priorities and names of locations given by user, semi depots
+    def name_locations(self, depot_address, depot_coords, semi_depot_addresses, semi_depot_addresses_coords, addresses, addresses_coords,
+                       priorities):
+        # Dict to save proper priority in db
+        addresses_priorities_dict = {key: value for key, value in zip([(address['lat'], address['lng']) for address in addresses_coords], priorities)}
+
+        # Addresses given by user are saved as names of locations, so there is no need to reverse geocode them
+        coords_names = {(depot_coords['lat'], depot_coords['lng']): depot_address}
+        for address, coords in zip(semi_depot_addresses + addresses, semi_depot_addresses_coords + addresses_coords):
+            coords_names.setdefault((coords['lat'], coords['lng']), address)
+        semi_depot_coords = {(coords['lat'], coords['lng']) for coords in semi_depot_addresses_coords}
+
+        return addresses_priorities_dict, coords_names, semi_depot_coords
+
+    def get_routes(self, depot_address, semi_depot_addresses, addresses, priorities, days, distance_limit, duration_limit, preferences, avoid_tolls,
+                   centroids=None, progress=no_progress):
         '''
         Function generates n routes, returns a dict of all addresses in correct order including depot
         Params:
@@ -711,79 +809,36 @@ class RoutesPlanner():
         - duration_limit - number of min we can drive in one day (float)
         - preferences - can be 'distance','duration' or 'fuel', based of that, routes would be chosen by this parameter (str)
         - avoid_tolls - boolean
+        - centroids - optional centers of previous routes, [[lat, lng], ...], used to warm start clustering on regeneration
+        - progress - optional callback progress(stage, **data), called when a stage of generation is done
         '''
 
+        self.check_parameters(semi_depot_addresses, addresses, days)
+
         # Convert depot address to coords
         depot_coords = self.get_depot_coords(depot_address)
 
         # Convert list of addresses to coords
-        addresses_coords = self.get_addresses_coords(addresses)
+        addresses_coords = self.get_addresses_coords(addresses, progress)
 
         # Convert list of semi_depot_addresses to coords
-        if days > 7:
-            raise ValueError('Maximum number of days is 7')
-        if days > len(addresses):
-            raise ValueError('To little addresses')
-        if len(semi_depot_addresses) != 0:
-            if days - len(semi_depot_addresses) != 1:
-                raise ValueError('Number of semi depots must equal days - 1')
-            semi_depot_addresses_coords = self.get_addresses_coords(semi_depot_addresses)
-        if len(semi_depot_addresses) == 0:
-            semi_depot_addresses_coords = []
-
-        # Dict to save proper priority in db
-        addresses_priorities_dict = {key: value for key, value in zip([(address['lat'], address['lng']) for address in addresses_coords], priorities)}
-
-        # For further convenience we put data into pandas DataFrame
-        df_addresses = pd.DataFrame(addresses_coords)
-
-        # Create model and cluster locations into days
-        df_addresses = self.cluster_addresses(df_addresses, days)
-
-        # Add priority column
-        df_addresses['priority'] = priorities
-
-        # Prepare all points, set waypoints
-        routes = self.set_optimal_waypoints(avoid_tolls, df_addresses, depot_coords, semi_depot_addresses_coords)
+        semi_depot_addresses_coords = self.get_addresses_coords(semi_depot_addresses) if len(semi_depot_addresses) != 0 else []
 
-        # Calculate distance, duration and consumption
-        distances = self.calculate_distances(routes)
-        durations = self.calculate_durations(routes)
-        fuels = self.calculate_fuel(routes)
+        # Generate many candidate plans and score them locally, later we will choose one that minimize given preferences
+        best_df = self.choose_plan(addresses_coords, priorities, days, depot_coords, semi_depot_addresses_coords, distance_limit, duration_limit,
+                                   preferences, centroids)
+        progress('clustering', days=days)
 
-        # List with all routes, later we will choose one that minimize given preferences
-        all_routes = []
-        all_routes.append(routes)
+        # Only the winner is sent to google for real order, polylines and metrics
+        routes = self.set_optimal_waypoints(avoid_tolls, best_df, depot_coords, semi_depot_addresses_coords, progress)
 
-        # We will generate more possible routes if there is more than 1 day
-        # Loop has to be short because long loop would affect efficiency of our function badly
-        # Additionally in every iteration there is google maps API request, so to many requests could cause fees!
-        #if days > 1:
-        #    for day in range(1, days):
-        #        df_addresses = self.reorganise_routes(routes, distances, df_addresses)
-        #        routes = self.set_optimal_waypoints(avoid_tolls, df_addresses, depot_coords, semi_depot_addresses_coords)
-        #        distances = self.calculate_distances(routes)
-        #        all_routes.append(routes)
-
-        # Check if any route does not break daily limitation
-        all_routes = self.check_limitations(all_routes, distance_limit, duration_limit)
-
-        # Return routes that minimize given preferences
-        if all_routes == 'to_small_distance':
-            raise ValueError('To small distance limit')
-        if all_routes == 'to_small_duration':
-            raise ValueError('To small duration limit')
-        if len(all_routes) == 0:
-            raise ValueError('Can not compute routes for this parameters. Modify parameters.')
-        else:
-            if preferences == 'distance':
-                routes = self.choose_min_routes(all_routes, 'distance')
-            elif preferences == 'duration':
-                routes = self.choose_min_routes(all_routes, 'duration')
-            elif preferences == 'fuel':
-                routes = self.choose_min_routes(all_routes, 'fuel')
+        # Check if real routes do not break daily limitation
+        routes = self.check_real_routes(routes, distance_limit, duration_limit)
 
         # Change names of output values
-        routes = self.add_parameter_names_to_output(routes, addresses_priorities_dict, semi_depot_addresses)
+        addresses_priorities_dict, coords_names, semi_depot_coords = self.name_locations(depot_address, depot_coords, semi_depot_addresses,
+                                                                                          semi_depot_addresses_coords, addresses,
+                                                                                          addresses_coords, priorities)
+        routes = self.add_parameter_names_to_output(routes, addresses_priorities_dict, coords_names, semi_depot_coords)
 
         return routes
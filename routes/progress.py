@@ -0,0 +1,51 @@
+import asyncio
+import json
+import threading
+import time
+
+
+# Default progress callback of the planner, does nothing
+def no_progress(stage, **data):
+    pass
+
+
+class ProgressStream():
+    '''
+    Stage events of one routes generation, read by client as NDJSON lines
+    Planner reports stages from many threads, every event gets time from start and from previous event (ms)
+    Events are passed to the event loop the stream was created in, so waiting client does not hold a thread
+    '''
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last = self.started
+
+    def __call__(self, stage, **data):
+        with self.lock:
+            now = time.monotonic()
+            event = {'stage': stage,
+                     **data,
+                     'elapsed_ms': round((now - self.started) * 1000, 1),
+                     'stage_ms': round((now - self.last) * 1000, 1)}
+            self.last = now
+            self.put(event)
+
+    # No events are sent after close
+    def close(self):
+        with self.lock:
+            self.put(None)
+
+    # Events of a loop that is already closed (app shut down) are dropped
+    def put(self, event):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+    async def lines(self):
+        while True:
+            event = await self.queue.get()
+            if event is None:
+                return
+            yield json.dumps(event, default=str) + '\n'
@@ -1,4 +1,5 @@
 from bson import json_util
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
 from firebase_admin import auth, credentials
 from loguru import logger
@@ -6,11 +7,14 @@ from passlib.context import CryptContext
 from pymongo import MongoClient
 from pymongo.collection import Collection
 from pymongo.database import Database
+from pymongo import ReplaceOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from pymongo.results import InsertOneResult
 from fastapi import HTTPException
-import googlemaps
 
 from datetime import datetime
+import copy
+import threading
 import numpy as np
 from dateutil.parser import parse
 
@@ -19,9 +23,28 @@ from config import Config
 cfg = Config()
 
 from routes.planner import RoutesPlanner
+from routes.geocoding import geocoding_service
+from routes import geometry, route_schema
 routes_planner = RoutesPlanner(cfg)
 
-gmaps = googlemaps.Client(key=Config.GOOGLEMAPS_API_KEY)
+# Fields of routes in responses, in response order
+ROUTES_RESPONSE_FIELDS = ['user_firebase_id', 'email', 'days', 'distance_limit', 'duration_limit', 'preferences', 'avoid_tolls',
+                          'routes_completed', 'date_of_completion', 'generation_date', 'name', 'routes_id']
+SUB_ROUTE_RESPONSE_FIELDS = ['completed', 'date_of_completion', 'distance_km', 'duration_hours', 'fuel_liters', 'polyline', 'route_number']
+LOCATION_RESPONSE_FIELDS = ['latitude', 'longitude', 'name', 'priority', 'location_number', 'visited', 'should_keep',
+                            'polyline_to_next_point', 'isDepot', 'isSemiDepot']
+
+# Fields of routes document read when a location is marked
+WAYPOINT_FIELDS = ['route_number', 'completed', 'coords.latitude', 'coords.longitude', 'coords.name', 'coords.priority',
+                   'coords.location_number', 'coords.visited', 'coords.isDepot', 'coords.isSemiDepot']
+WAYPOINT_METADATA = ['days', 'distance_limit', 'duration_limit', 'preferences', 'avoid_tolls']
+
+# Fields of routes document read when locations are regenerated
+REGENERATION_FIELDS = ['completed', 'coords.name', 'coords.priority', 'coords.isDepot', 'coords.isSemiDepot']
+REGENERATION_METADATA = ['routes_completed', 'days', 'distance_limit', 'duration_limit', 'preferences', 'avoid_tolls']
+
+# Attempts to save old routes document in current schema while other requests change it
+MIGRATION_ATTEMPTS = 3
 
 
 class RouteRepository():
@@ -34,23 +57,16 @@ class RouteRepository():
         self.locations_collection: Collection = self.client.route_db.locations
         logger.info("Inited routes repo")
 
-    # documents must have only string keys, key was 0
-    def convert_dict_keys_to_str(self, dictionary):
-        if isinstance(dictionary, dict):
-            new_dict = {}
-            for key, value in dictionary.items():
-                new_key = str(key)
-                new_value = self.convert_dict_keys_to_str(value)
-                new_dict[new_key] = new_value
-            return new_dict
-        else:
-            return dictionary
-
     def create_user_route(self, uid: str, body: dict, days, distance_limit, duration_limit, preferences, avoid_tolls, routes_id, overwrite):
         firebase_user = auth.get_user(uid)
 
-        document = self.convert_dict_keys_to_str(body)
+        # Planner returns routes under route numbers
+        sub_routes = [body[key] for key in sorted(body)]
+        for route in sub_routes:
+            route['centroid'] = self.get_centroid(route['coords'])
 
+        document = {'schema_version': route_schema.SCHEMA_VERSION,
+                    'sub_routes': sub_routes}
         document['user_firebase_id'] = uid
         document['email'] = firebase_user.email
         document['days'] = days
@@ -62,7 +78,8 @@ class RouteRepository():
         document['date_of_completion'] = None
         current_datetime = datetime.now()
         document['generation_date'] = f'{current_datetime.day:02d}.{current_datetime.month:02d}.{current_datetime.year}, {current_datetime.hour:02d}:{current_datetime.minute:02d}'
-        document['name'] = f'{current_datetime.day:02d}.{current_datetime.month:02d}.{current_datetime.year}, {current_datetime.hour:02d}:{current_datetime.minute:02d}' #date as default
+        default_name = f'{current_datetime.day:02d}.{current_datetime.month:02d}.{current_datetime.year}, {current_datetime.hour:02d}:{current_datetime.minute:02d}' #date as default
+        document['name'] = self.get_unique_routes_name(uid, default_name, routes_id)
 
         if routes_id is not None:
             routes = self.routes_collection.find_one({"_id": ObjectId(routes_id)})
@@ -87,7 +104,13 @@ class RouteRepository():
                 transformed_document['routes'][0]['subRoutes'] = active_routes
                 return transformed_document
 
-        res = self.routes_collection.insert_one(dict(document))
+        # Other routes could take the same name in the meantime
+        while True:
+            try:
+                res = self.routes_collection.insert_one(dict(document))
+                break
+            except DuplicateKeyError:
+                document['name'] = self.get_unique_routes_name(uid, default_name)
 
         document['routes_id'] = str(res.inserted_id)
 
@@ -95,208 +118,128 @@ class RouteRepository():
 
         return transformed_document
 
+    # Function rewrites routes documents saved in old schema, batch_size documents per bulk write
+    # Document is replaced only if nobody changed it since it was read (filter is route_schema.unchanged_filter),
+    # changed documents are left for the next run, returns numbers of migrated and skipped documents
+    def migrate_routes(self, batch_size=None):
+        if batch_size is None:
+            batch_size = self.config.ROUTES_MIGRATION_BATCH
+        migrated = 0
+        skipped = 0
+        last_id = None
+        while True:
+            query = {'schema_version': {'$exists': False}}
+            if last_id is not None:
+                query['_id'] = {'$gt': last_id}
+            documents = list(self.routes_collection.find(query).sort('_id', 1).limit(batch_size))
+            if len(documents) == 0:
+                break
+            last_id = documents[-1]['_id']
+
+            replacements = [ReplaceOne(route_schema.unchanged_filter(document), route_schema.to_current(document)) for document in documents]
+            result = self.routes_collection.bulk_write(replacements, ordered=False)
+            migrated += result.modified_count
+            skipped += len(documents) - result.matched_count
+            logger.info(f"Migrated {migrated} routes documents to schema {route_schema.SCHEMA_VERSION}, skipped {skipped}")
+
+        return {'migrated': migrated, 'skipped': skipped}
+
+    def migrate_routes_in_background(self):
+        threading.Thread(target=logger.catch(self.migrate_routes), name='routes-migration', daemon=True).start()
+
+    # Function returns routes in response format, document is one routes document or, with all_routes, a list of them
     def transform_format(self, document, all_routes=False):
-
         if all_routes is True:
-            routes = []
-            for key_document, value_document in document.items():
-                if isinstance(value_document, dict):
-                    subRoutes = []
-                    for key_routes, value_routes in value_document.items():
-                        if isinstance(value_routes, dict):
-                            coords = []
-                            for location in value_routes["coords"]:
-                                point = {
-                                    "latitude": location["latitude"],
-                                    "longitude": location["longitude"],
-                                    "name": location["name"],
-                                    "priority": location["priority"],
-                                    "location_number": location["location_number"],
-                                    "visited": location["visited"],
-                                    "should_keep": location["should_keep"],
-                                    "polyline_to_next_point": location["polyline_to_next_point"],
-                                    "isDepot": location["isDepot"],
-                                    "isSemiDepot": location["isSemiDepot"]
-                                }
-                                coords.append(point)
-                            route = {
-                                "coords": coords,
-                                "completed": value_routes["completed"],
-                                "date_of_completion": value_routes["date_of_completion"],
-                                "distance_km": value_routes["distance_km"],
-                                "duration_hours": value_routes["duration_hours"],
-                                "fuel_liters": value_routes["fuel_liters"],
-                                "polyline": value_routes["polyline"],
-                                "route_number": value_routes["route_number"]
-                            }
-                            subRoutes.append(route)
-                    output_data = {"subRoutes": subRoutes,
-                         "user_firebase_id": value_document["user_firebase_id"],
-                         "email": value_document["email"],
-                         "days": value_document["days"],
-                         "distance_limit": value_document["distance_limit"],
-                         "duration_limit": value_document["duration_limit"],
-                         "preferences": value_document["preferences"],
-                         "avoid_tolls": value_document["avoid_tolls"],
-                         "routes_completed": value_document["routes_completed"],
-                         "date_of_completion": value_document["date_of_completion"],
-                         "generation_date": value_document["generation_date"],
-                         "name": value_document["name"],
-                         "routes_id": value_document["routes_id"]
-                         }
-                    routes.append(output_data)
-
-            return {"routes": routes}
-
-        subRoutes = []
-
-        for key_document, value_document in document.items():
-            if isinstance(value_document, dict):
-                coords = []
-                for location in value_document["coords"]:
-                    point = {
-                        "latitude": location["latitude"],
-                        "longitude": location["longitude"],
-                        "name": location["name"],
-                        "priority": location["priority"],
-                        "location_number": location["location_number"],
-                        "visited": location["visited"],
-                        "should_keep": location["should_keep"],
-                        "polyline_to_next_point": location["polyline_to_next_point"],
-                        "isDepot": location["isDepot"],
-                        "isSemiDepot": location["isSemiDepot"]
-                    }
-                    coords.append(point)
-                route = {
-                    "coords": coords,
-                    "completed": value_document["completed"],
-                    "date_of_completion": value_document["date_of_completion"],
-                    "distance_km": value_document["distance_km"],
-                    "duration_hours": value_document["duration_hours"],
-                    "fuel_liters": value_document["fuel_liters"],
-                    "polyline": value_document["polyline"],
-                    "route_number": value_document["route_number"]
-                }
-                subRoutes.append(route)
-
-        output_data = {"routes": [
-                {"subRoutes": subRoutes,
-                "user_firebase_id": document["user_firebase_id"],
-                "email": document["email"],
-                "days": document["days"],
-                "distance_limit": document["distance_limit"],
-                "duration_limit": document["duration_limit"],
-                "preferences": document["preferences"],
-                "avoid_tolls": document["avoid_tolls"],
-                "routes_completed": document["routes_completed"],
-                "date_of_completion": document["date_of_completion"],
-                "generation_date": document["generation_date"],
-                "name": document["name"],
-                "routes_id": document["routes_id"]
-                }
-            ]
-        }
-
-        return output_data
+            return {"routes": [self.format_routes(routes) for routes in document]}
 
+        return {"routes": [self.format_routes(document)]}
 
-    def get_completed_routes(self, routes):
-        keys_to_remove = []
-        for key, value in routes.items():
-            if isinstance(value, dict):
-                if value['completed'] is False:
-                    keys_to_remove.append(key)
-
-        for key in keys_to_remove:
-            del routes[key]
+    def format_routes(self, document):
+        routes = {"subRoutes": [self.format_sub_route(route) for route in route_schema.get_sub_routes(document)]}
+        routes.update({field: document[field] for field in ROUTES_RESPONSE_FIELDS})
         return routes
 
-    def merge_routes(self, document, completed_routes):
-        # Merge documents with, change key for added routes, change rute number
-        new_key = 0
-        while str(new_key) in document:
-            new_key += 1
+    def format_sub_route(self, route):
+        sub_route = {"coords": [{field: location[field] for field in LOCATION_RESPONSE_FIELDS} for location in route["coords"]]}
+        sub_route.update({field: route[field] for field in SUB_ROUTE_RESPONSE_FIELDS})
+        return sub_route
 
-        for key, value in completed_routes.items():
-            if isinstance(value, dict):
-                document[str(new_key)] = value
-                value['route_number'] = new_key
-                new_key += 1
+    # Aggregation stage building the same response format as format_routes, active keeps only not completed sub routes
+    def response_stage(self, active=False):
+        sub_routes = route_schema.sub_routes_expression()
+        if active is True:
+            sub_routes = {'$filter': {'input': sub_routes, 'as': 'route', 'cond': {'$ne': ['$$route.completed', True]}}}
 
-        numeric_keys = [key for key in document if key.isdigit()]
-        other_keys = [key for key in document if not key.isdigit()]
-        numeric_keys.sort()
-        sorted_doc = {**{key: document[key] for key in numeric_keys},**{key: document[key] for key in other_keys}}
+        coords = {'$map': {'input': '$$route.coords',
+                           'as': 'location',
+                           'in': {field: f'$$location.{field}' for field in LOCATION_RESPONSE_FIELDS}}}
+        sub_route = {'coords': coords}
+        sub_route.update({field: f'$$route.{field}' for field in SUB_ROUTE_RESPONSE_FIELDS})
 
-        return sorted_doc, new_key
+        stage = {'_id': 0, 'subRoutes': {'$map': {'input': sub_routes, 'as': 'route', 'in': sub_route}}}
+        stage.update({field: f'${field}' for field in ROUTES_RESPONSE_FIELDS if field != 'routes_id'})
+        stage['routes_id'] = {'$toString': '$_id'}
+        return {'$project': stage}
 
-    def get_user_route(self, uid: str, active=False, for_stats=False):
-        cursor = self.routes_collection.find({"user_firebase_id": uid})
-        documents = list(cursor)
+    def get_completed_routes(self, routes):
+        return [route for route in route_schema.get_sub_routes(routes) if route['completed'] is not False]
 
-        all_routes = []
+    # Completed routes go after new ones, with next route numbers
+    def merge_routes(self, document, completed_routes):
+        new_number = len(document['sub_routes'])
+        for route in completed_routes:
+            route['route_number'] = new_number
+            document['sub_routes'].append(route)
+            new_number += 1
 
-        for document in documents:
-            document['routes_id'] = str(document.pop('_id'))
-            all_routes.append(document)
+        return document, new_number
 
-        # Returns routes where completed is False
+    # Function returns routes documents of user in response format, built by mongo, for_stats returns documents as they are (list)
+    # Active routes are found with index user_routes_completed, completed routes of user are not read
+    def get_user_route(self, uid: str, active=False, for_stats=False):
+        query = {"user_firebase_id": uid}
         if active is True:
-            # Filter documents
-            active_routes = []
-            for document in all_routes:
-                if document.get('routes_completed') is False:
-                    active_routes.append(document)
-            # Filter routes
-            filtered_data = []
-            for routes in active_routes:
-                filtered_routes = {}
-
-                for key, value in routes.items():
-                    if key not in ('user_firebase_id', 'email', 'days', 'distance_limit', 'duration_limit', 'preferences', 'avoid_tolls', 'routes_completed', 'date_of_completion', 'generation_date', 'routes_id', 'name') and (not value.get('completed', False)):
-                        filtered_routes[key] = value
-
-                filtered_routes['user_firebase_id'] = routes['user_firebase_id']
-                filtered_routes['email'] = routes['email']
-                filtered_routes['days'] = routes['days']
-                filtered_routes['distance_limit'] = routes['distance_limit']
-                filtered_routes['duration_limit'] = routes['duration_limit']
-                filtered_routes['preferences'] = routes['preferences']
-                filtered_routes['avoid_tolls'] = routes['avoid_tolls']
-                filtered_routes['routes_completed'] = routes['routes_completed']
-                filtered_routes['date_of_completion'] = routes['date_of_completion']
-                filtered_routes['generation_date'] = routes['generation_date']
-                filtered_routes['name'] = routes['name']
-                filtered_routes['routes_id'] = routes['routes_id']
-
-                filtered_data.append(filtered_routes)
-
-            filtered_data_to_dict = {str(i): value for i, value in enumerate(filtered_data)}
-
-            if for_stats is True:
-                return filtered_data_to_dict
-
-            transformed_document = self.transform_format(filtered_data_to_dict, True)
-
-            return transformed_document
-
-        # Returns all routes no matter if completed is False or True
-        all_routes_as_dict = {str(i): value for i, value in enumerate(all_routes)}
+            query['routes_completed'] = False
 
         if for_stats is True:
-            return all_routes_as_dict
-
-        transformed_document = self.transform_format(all_routes_as_dict, True)
-
-        return transformed_document
+            documents = []
+            for document in self.routes_collection.find(query):
+                document['routes_id'] = str(document.pop('_id'))
+                documents.append(document)
+            return documents
+
+        return {"routes": list(self.routes_collection.aggregate([{'$match': query}, self.response_stage(active)]))}
+
+    # Center of locations of a route (without depots), [lat, lng]
+    def get_centroid(self, coords):
+        return list(geometry.centroid([(item['latitude'], item['longitude']) for item in coords if item['isDepot'] is False]))
+
+    # Centroids of not completed routes, used to warm start clustering when routes are generated again
+    # Routes saved before centroids were stored get them from coords
+    def get_route_centroids(self, routes_id):
+        try:
+            routes = self.routes_collection.find_one({"_id": ObjectId(routes_id)})
+        except InvalidId:
+            return []
+        if routes is None:
+            return []
+
+        centroids = []
+        for value in route_schema.get_sub_routes(routes):
+            if value['completed'] is False:
+                centroid = value.get('centroid')
+                if centroid is None:
+                    centroid = self.get_centroid(value['coords'])
+                if len(centroid) != 0:
+                    centroids.append(centroid)
+        return centroids
 
     def delete_user_route(self, uid, active, routes_id):
         # Delete chosen routes_id
         if routes_id is not None:
-            routes = self.routes_collection.find_one({"_id": ObjectId(routes_id)})
-            if routes is None:
+            routes_resp = self.routes_collection.delete_one({"_id": ObjectId(routes_id)})
+            if routes_resp.deleted_count == 0:
                 raise HTTPException(status_code=404, detail="Routes not found")
-            routes_resp = self.routes_collection.delete_many({"_id": ObjectId(routes_id)})
             locations_resp = self.locations_collection.delete_many({"routes_id": routes_id})
 
             return {'message': "Routes {} deleted".format(routes_id)}
@@ -316,88 +259,72 @@ class RouteRepository():
         return {'deleted_routes': routes_resp.deleted_count,
                 'deleted_locations': locations_resp.deleted_count}
 
-    def update_waypoint(self, uid, routes_id: str, route_number: str, location_number: int, visited: bool, should_keep: bool):
-        # Get right routes document
-        routes = self.routes_collection.find_one({"_id": ObjectId(routes_id)})
+    def update_waypoint(self, uid, routes_id: str, route_number: str, location_number: int, visited: bool, should_keep: bool, reinsert=False):
+        # Get locations of routes without polylines, positional updates below need document in current schema
+        routes = self.find_routes(routes_id, route_schema.sub_routes_projection(WAYPOINT_FIELDS, WAYPOINT_METADATA))
         if routes is None:
             raise HTTPException(status_code=404, detail="Routes not found")
+        if not route_schema.is_current(routes):
+            routes = self.migrate_routes_document(routes)
         avoid_tolls = routes['avoid_tolls']
-        route = []
-        for key, value in routes.items():
-            if isinstance(value, dict):
-                if 'route_number' in value and value['route_number'] == route_number:
-                    route.append((key, value))
-
-            elif isinstance(value, list):
-                for item in value:
-                    if isinstance(item, dict) and 'route_number' in item and item['route_number'] == route_number:
-                        route.append((key, item))
+        sub_routes = route_schema.get_sub_routes(routes)
 
         # Check if there is that route in document
-        if len(route) == 0:
+        try:
+            route = route_schema.get_sub_route(routes, route_number)
+        except KeyError:
             raise HTTPException(status_code=404, detail="Route not found")
 
         # Check if these routes are already completed
-        if all(route.get('completed', True) for _, route in routes.items() if isinstance(route, dict)):
+        if all(item.get('completed', True) for item in sub_routes):
             raise HTTPException(status_code=404, detail="Routes already completed")
 
         # Check if that route is already completed
-        if all(item['visited'] in [True, False] for item in route[0][1]['coords']):
+        if all(item['visited'] in [True, False] for item in route['coords']):
             raise HTTPException(status_code=404, detail="Route already completed")
 
         depot_address = None
         semi_depot_addresses = []
-        name = None
-
-        # Pass visited into right route
-        visited_changed = False
-        for key, value in dict(route).items():
-            if isinstance(value, dict):
-                if 'coords' in value and isinstance(value['coords'], list):
-                    for item in value['coords']:
-                        if item['isSemiDepot'] is True:
-                            semi_depot_addresses.append(item['name'])
-                        if item['isDepot'] is True and item['isSemiDepot'] is False:
-                            depot_address = item['name']
-                        if 'location_number' in item and item['location_number'] == location_number:
-                            if item['visited'] is not None:
-                                raise HTTPException(status_code=404, detail="Location already marked")
-                            item['visited'] = visited
-                            name = item['name']
-                            visited_changed = True
-                            if visited is False and should_keep is True and item['isDepot'] is False:
-                                if depot_address is None:
-                                    routes_to_search = self.routes_collection.find_one({"_id": ObjectId(routes_id)})
-                                    found_name = routes_to_search['0']['coords'][0]['name']
-                                    self.add_location_to_collection(routes_id, found_name, semi_depot_addresses,item['name'], item['priority'], routes['days'],routes['distance_limit'], routes['duration_limit'],routes['preferences'], routes['avoid_tolls'], uid)
-                                    item['should_keep'] = True
-                                else:
-                                    self.add_location_to_collection(routes_id, depot_address, semi_depot_addresses, item['name'], item['priority'], routes['days'], routes['distance_limit'], routes['duration_limit'], routes['preferences'], routes['avoid_tolls'], uid)
-                                    item['should_keep'] = True
+        location = None
+        for item in route['coords']:
+            if item['isSemiDepot'] is True:
+                semi_depot_addresses.append(item['name'])
+            if item['isDepot'] is True and item['isSemiDepot'] is False:
+                depot_address = item['name']
+            if 'location_number' in item and item['location_number'] == location_number:
+                location = item
 
         # Check if location is in route
-        if visited_changed is False:
+        if location is None:
             raise HTTPException(status_code=404, detail="No such location in route")
+        if location['visited'] is not None:
+            raise HTTPException(status_code=404, detail="Location already marked")
+        name = location['name']
+        keep = visited is False and should_keep is True and location['isDepot'] is False
+
+        # Location can be marked by other device after document was read, then nothing is changed
+        route = self.mark_location(routes_id, route_number, location_number, visited, keep)
+        if route is None:
+            raise HTTPException(status_code=404, detail="Location already marked")
+
+        # Kept location goes into remaining routes, if it does not fit anywhere it waits for regeneration
+        reinserted = False
+        if keep is True:
+            kept_location = dict(location, visited=visited, should_keep=True)
+            if reinsert is True:
+                reinserted = self.insert_kept_location(routes_id, kept_location, route_number)
+            if reinserted is False:
+                if depot_address is None:
+                    depot_address = sub_routes[0]['coords'][0]['name']
+                self.add_location_to_collection(routes_id, depot_address, semi_depot_addresses, kept_location['name'], kept_location['priority'], routes['days'], routes['distance_limit'], routes['duration_limit'], routes['preferences'], routes['avoid_tolls'], uid)
 
         # Check if in all location there is True or False value
-        all_visited = all(item['visited'] in [True, False] for item in route[0][1]['coords'])
-        route[0][1]['completed'] = all_visited
-        current_datetime = datetime.now()
-        if route[0][1]['completed'] is True:
-            route[0][1]['date_of_completion'] = f'{current_datetime.day:02d}.{current_datetime.month:02d}.{current_datetime.year}, {current_datetime.hour:02d}:{current_datetime.minute:02d}'
-            real_distance, real_duration, real_polyline, real_fuel = self.get_real_stats(route[0][1]['coords'], avoid_tolls)
-            route[0][1]['distance_km'] = real_distance
-            route[0][1]['duration_hours'] = real_duration / 60
-            route[0][1]['polyline'] = real_polyline
-            route[0][1]['fuel_liters'] = real_fuel
-
-        # Update document in mongo
-        self.routes_collection.replace_one({"_id": ObjectId(routes_id)}, routes)
+        all_visited = all(item['visited'] in [True, False] for item in route['coords'])
+        if all_visited:
+            route = self.complete_route(routes_id, route, avoid_tolls)
 
         # Update 'routes_completed' if all routes are completed
-        all_routes_completed = all(route.get('completed', True) for _, route in routes.items() if isinstance(route, dict))
-        if all_routes_completed:
-            self.routes_collection.update_one({'_id': ObjectId(routes_id)}, {'$set': {'routes_completed': True, 'date_of_completion': f'{current_datetime.day:02d}.{current_datetime.month:02d}.{current_datetime.year}, {current_datetime.hour:02d}:{current_datetime.minute:02d}'}})
+        all_routes_completed = self.complete_routes(routes_id)
 
         if name == depot_address:
             return {'routes_id': routes_id,
@@ -406,7 +333,7 @@ class RouteRepository():
                     'location_number': location_number,
                     'visited': visited,
                     'completed': all_visited,
-                    'date_of_completion': route[0][1]['date_of_completion'],
+                    'date_of_completion': route['date_of_completion'],
                     'routes_completed': all_routes_completed}
 
         return {'routes_id': routes_id,
@@ -415,10 +342,137 @@ class RouteRepository():
                 'location_number': location_number,
                 'visited': visited,
                 'should_keep': should_keep,
+                'reinserted': reinserted,
                 'completed': all_visited,
-                'date_of_completion': route[0][1]['date_of_completion'],
+                'date_of_completion': route['date_of_completion'],
                 'routes_completed': all_routes_completed}
 
+    # Function saves routes document in current schema, if nobody changed it in the meantime, and returns it as it is in mongo
+    def migrate_routes_document(self, document):
+        for _ in range(MIGRATION_ATTEMPTS):
+            self.routes_collection.replace_one(route_schema.unchanged_filter(document), route_schema.to_current(document))
+            document = self.routes_collection.find_one({'_id': document['_id']})
+            if document is None:
+                raise HTTPException(status_code=404, detail="Routes not found")
+            if route_schema.is_current(document):
+                return document
+        raise HTTPException(status_code=409, detail="Routes are being changed, try again")
+
+    # Function marks location only if it is not marked yet, in one update, so marks sent at the same time from 2 devices are not lost
+    # Returns marked route as it is in mongo, None if location was already marked
+    def mark_location(self, routes_id, route_number, location_number, visited, should_keep):
+        fields = {'sub_routes.$[route].coords.$[location].visited': visited}
+        if should_keep is True:
+            fields['sub_routes.$[route].coords.$[location].should_keep'] = True
+
+        document = self.routes_collection.find_one_and_update(
+            {'_id': ObjectId(routes_id),
+             'sub_routes': {'$elemMatch': {'route_number': route_number,
+                                           'coords': {'$elemMatch': {'location_number': location_number, 'visited': None}}}}},
+            {'$set': fields},
+            projection={'sub_routes': {'$elemMatch': {'route_number': route_number}}},
+            array_filters=[{'route.route_number': route_number},
+                           {'location.location_number': location_number, 'location.visited': None}],
+            return_document=ReturnDocument.AFTER)
+        if document is None:
+            return None
+        return document['sub_routes'][0]
+
+    # Real stats of route are saved only by the first request that completes it, returns route as it is in mongo
+    def complete_route(self, routes_id, route, avoid_tolls):
+        current_datetime = datetime.now()
+        real_distance, real_duration, real_polyline, real_fuel = self.get_real_stats(route['coords'], avoid_tolls)
+        projection = {'sub_routes': {'$elemMatch': {'route_number': route['route_number']}}}
+
+        document = self.routes_collection.find_one_and_update(
+            {'_id': ObjectId(routes_id), 'sub_routes': {'$elemMatch': {'route_number': route['route_number'], 'completed': False}}},
+            {'$set': {'sub_routes.$[route].completed': True,
+                      'sub_routes.$[route].date_of_completion': f'{current_datetime.day:02d}.{current_datetime.month:02d}.{current_datetime.year}, {current_datetime.hour:02d}:{current_datetime.minute:02d}',
+                      'sub_routes.$[route].distance_km': real_distance,
+                      'sub_routes.$[route].duration_hours': real_duration / 60,
+                      'sub_routes.$[route].polyline': real_polyline,
+                      'sub_routes.$[route].fuel_liters': real_fuel}},
+            projection=projection,
+            array_filters=[{'route.route_number': route['route_number']}],
+            return_document=ReturnDocument.AFTER)
+        if document is None:
+            document = self.routes_collection.find_one({'_id': ObjectId(routes_id)}, projection)
+        return document['sub_routes'][0]
+
+    # Routes are completed when none of sub routes is left not completed, returns 'routes_completed'
+    def complete_routes(self, routes_id):
+        current_datetime = datetime.now()
+        result = self.routes_collection.update_one(
+            {'_id': ObjectId(routes_id), 'routes_completed': False, 'sub_routes': {'$not': {'$elemMatch': {'completed': {'$ne': True}}}}},
+            {'$set': {'routes_completed': True, 'date_of_completion': f'{current_datetime.day:02d}.{current_datetime.month:02d}.{current_datetime.year}, {current_datetime.hour:02d}:{current_datetime.minute:02d}'}})
+        if result.modified_count == 1:
+            return True
+        return self.routes_collection.find_one({'_id': ObjectId(routes_id)}, {'routes_completed': 1})['routes_completed']
+
+    # Function inserts kept location into other not completed routes of the same document, at the cheapest position fitting in limits
+    # Only legs around inserted location are priced, returns False if location does not fit anywhere
+    # Route is saved only if its locations did not change since document was read, otherwise location waits for regeneration
+    def insert_kept_location(self, routes_id, location, skipped_route_number):
+        # Only not completed routes are read, with their polylines
+        pipeline = [{'$match': {'_id': ObjectId(routes_id)}}, route_schema.not_completed_stage(['distance_limit', 'duration_limit', 'avoid_tolls'])]
+        routes = next(self.routes_collection.aggregate(pipeline), None)
+        if routes is None:
+            return False
+        active_routes = {value['route_number']: copy.deepcopy(value) for value in route_schema.get_sub_routes(routes)
+                         if value['route_number'] != skipped_route_number}
+        positions = routes_planner.find_insertion_positions(active_routes, location, routes['distance_limit'], routes['duration_limit'])
+        distance_limit = routes['distance_limit'] if routes['distance_limit'] is not None else float('inf')
+        duration_limit = routes['duration_limit'] if routes['duration_limit'] is not None else float('inf')
+
+        # Estimate can be wrong, so few cheapest positions are priced before we give up
+        for key, index, _ in positions[:self.config.INSERTION_ATTEMPTS]:
+            route = active_routes[key]
+            before = route['coords'][index - 1]
+            after = route['coords'][index]
+            start = (before['latitude'], before['longitude'])
+            point = (location['latitude'], location['longitude'])
+            end = (after['latitude'], after['longitude'])
+
+            old_leg = routes_planner.get_route_metrics(routes['avoid_tolls'], [start, end])
+            new_legs = routes_planner.get_route_metrics(routes['avoid_tolls'], [start, point, end])
+            distance_km = route['distance_km'] + new_legs['distance_km'] - old_leg['distance_km']
+            duration_min = route['duration_hours'] * 60 + new_legs['duration_min'] - old_leg['duration_min']
+            if distance_km > distance_limit or duration_min > duration_limit:
+                continue
+
+            before['polyline_to_next_point'] = new_legs['polylines'][0]
+            route['coords'].insert(index, {'latitude': location['latitude'],
+                                           'longitude': location['longitude'],
+                                           'name': location['name'],
+                                           'priority': location['priority'],
+                                           'location_number': index,
+                                           'visited': None,
+                                           'should_keep': None,
+                                           'polyline_to_next_point': new_legs['polylines'][1],
+                                           'isDepot': False,
+                                           'isSemiDepot': False})
+            for i, item in enumerate(route['coords']):
+                item['location_number'] = i
+
+            route['distance_km'] = round(distance_km, 2)
+            route['duration_hours'] = round(duration_min / 60, 2)
+            route['fuel_liters'] = round(route['fuel_liters'] + new_legs['fuel_liters'] - old_leg['fuel_liters'], 2)
+            route['polyline'] = routes_planner.merge_polylines([item['polyline_to_next_point'] for item in route['coords'][:-1]])
+            route['centroid'] = self.get_centroid(route['coords'])
+
+            result = self.routes_collection.update_one(
+                {'_id': routes['_id'],
+                 'sub_routes': {'$elemMatch': {'route_number': key, 'coords': route_schema.get_sub_route(routes, key)['coords']}}},
+                {'$set': {'sub_routes.$[route]': route}},
+                array_filters=[{'route.route_number': key}])
+            if result.modified_count == 0:
+                logger.info(f"Route {key} changed before location {location['name']} was inserted")
+                return False
+            logger.info(f"Location {location['name']} inserted into route {route['route_number']} at {index}")
+            return True
+
+        return False
+
     def add_location_to_collection(self, routes_id, depot_address, semi_depot_addresses, address, priority, days, distance_limit, duration_limit, preferences, avoid_tolls, uid):
         # Check if there is a document with that routes
         routes = self.locations_collection.find_one({"routes_id": routes_id})
@@ -469,7 +523,7 @@ class RouteRepository():
             avoid_tolls_locations = locations['avoid_tolls']
 
         #Get routes that were not visited
-        routes = self.routes_collection.find_one({"_id": ObjectId(routes_id)})
+        routes = self.find_routes(routes_id, route_schema.sub_routes_projection(REGENERATION_FIELDS, REGENERATION_METADATA))
         if routes is not None:
             if routes['routes_completed'] is True and locations is None:
                 return {'message': 'No locations to regenerate'}
@@ -482,37 +536,21 @@ class RouteRepository():
             duration_limit_routes = None
             preferences_routes = None
             avoid_tolls_routes = None
-            for key, value in routes.items():
-                if isinstance(value, dict):
-                    if full_regeneration is True:
-                        for item in value['coords']:
-                            if item['isSemiDepot'] is True:
-                                semi_depot_routes.append(item['name'])
-                            if item['isDepot'] is True and item['isSemiDepot'] is False:
-                                depot_address_routes = item['name']
-                            if item['isDepot'] is False:
-                                addresses_routes.append(item['name'])
-                                priorities_routes.append(item['priority'])
-                    else:
-                        if value['completed'] is False:
-                            for item in value['coords']:
-                                if item['isSemiDepot'] is True:
-                                    semi_depot_routes.append(item['name'])
-                                if item['isDepot'] is True and item['isSemiDepot'] is False:
-                                    depot_address_routes = item['name']
-                                if item['isDepot'] is False:
-                                    addresses_routes.append(item['name'])
-                                    priorities_routes.append(item['priority'])
-                if key == 'days':
-                    days_routes = value
-                if key == 'distance_limit':
-                    distance_limit_routes = value
-                if key == 'duration_limit':
-                    duration_limit_routes = value
-                if key == 'preferences':
-                    preferences_routes = value
-                if key == 'avoid_tolls':
-                    avoid_tolls_routes = value
+            for value in route_schema.get_sub_routes(routes):
+                if full_regeneration is True or value['completed'] is False:
+                    for item in value['coords']:
+                        if item['isSemiDepot'] is True:
+                            semi_depot_routes.append(item['name'])
+                        if item['isDepot'] is True and item['isSemiDepot'] is False:
+                            depot_address_routes = item['name']
+                        if item['isDepot'] is False:
+                            addresses_routes.append(item['name'])
+                            priorities_routes.append(item['priority'])
+            days_routes = routes.get('days')
+            distance_limit_routes = routes.get('distance_limit')
+            duration_limit_routes = routes.get('duration_limit')
+            preferences_routes = routes.get('preferences')
+            avoid_tolls_routes = routes.get('avoid_tolls')
 
         #Combine
         if locations is None and routes is None:
@@ -529,9 +567,7 @@ class RouteRepository():
             else:
                 addresses_with_coords = []
 
-            document = {'depot_address': {'name': depot_address_routes,
-                                          'latitude': gmaps.geocode(depot_address_routes)[0]['geometry']['location']['lat'],
-                                          'longitude': gmaps.geocode(depot_address_routes)[0]['geometry']['location']['lng']},
+            document = {'depot_address': self.add_coords_to_addresses([depot_address_routes])[0],
                         'semi_depot_addresses': semi_depot_with_coords,
                         'addresses': addresses_with_coords,
                         'priorities': priorities_routes,
@@ -554,9 +590,7 @@ class RouteRepository():
             else:
                 addresses_with_coords = []
 
-            document = {'depot_address': {'name': depot_address_locations,
-                                          'latitude': gmaps.geocode(depot_address_locations)[0]['geometry']['location']['lat'],
-                                          'longitude': gmaps.geocode(depot_address_locations)[0]['geometry']['location']['lng']},
+            document = {'depot_address': self.add_coords_to_addresses([depot_address_locations])[0],
                         'semi_depot_addresses': semi_depot_with_coords,
                         'addresses': addresses_with_coords,
                         'priorities': priorities_locations,
@@ -579,9 +613,7 @@ class RouteRepository():
             else:
                 addresses_with_coords = []
 
-            document = {'depot_address': {'name': depot_address_routes,
-                                          'latitude': gmaps.geocode(depot_address_routes)[0]['geometry']['location']['lat'],
-                                          'longitude': gmaps.geocode(depot_address_routes)[0]['geometry']['location']['lng']},
+            document = {'depot_address': self.add_coords_to_addresses([depot_address_routes])[0],
                         'semi_depot_addresses': semi_depot_with_coords,
                         'addresses': addresses_with_coords,
                         'priorities': priorities_routes,
@@ -605,9 +637,7 @@ class RouteRepository():
             else:
                 addresses_with_coords = []
 
-            document = {'depot_address': {'name': depot_address_locations,
-                                          'latitude': gmaps.geocode(depot_address_locations)[0]['geometry']['location']['lat'],
-                                          'longitude': gmaps.geocode(depot_address_locations)[0]['geometry']['location']['lng']},
+            document = {'depot_address': self.add_coords_to_addresses([depot_address_locations])[0],
                         'semi_depot_addresses': semi_depot_with_coords,
                         'addresses': addresses_with_coords,
                         'priorities': unique_priorities,
@@ -619,12 +649,29 @@ class RouteRepository():
                         'routes_id': routes_id}
             return document
 
+    # Function reads only projected fields of routes document (without polylines)
+    # Documents in old schema can not be projected, they are read whole until they are migrated
+    def find_routes(self, routes_id, projection):
+        routes = self.routes_collection.find_one({"_id": ObjectId(routes_id)}, projection)
+        if routes is not None and not route_schema.is_current(routes):
+            routes = self.routes_collection.find_one({"_id": ObjectId(routes_id)})
+        return routes
+
+    # Function reads only given fields of one sub route, sub_routes of returned document has at most one route
+    def find_sub_route(self, routes_id, route_number, fields):
+        pipeline = [{'$match': {'_id': ObjectId(routes_id)}}] + route_schema.sub_route_stages(route_number, fields)
+        routes = next(self.routes_collection.aggregate(pipeline), None)
+        if routes is not None and not route_schema.is_current(routes):
+            routes = self.routes_collection.find_one({"_id": ObjectId(routes_id)})
+        return routes
+
     def add_coords_to_addresses(self, addresses):
         addresses_with_coords = []
         for address in addresses:
+            coords = geocoding_service.geocode(address)
             addresses_with_coords.append({'name': address,
-                                          'latitude': gmaps.geocode(address)[0]['geometry']['location']['lat'],
-                                          'longitude': gmaps.geocode(address)[0]['geometry']['location']['lng']})
+                                          'latitude': coords['lat'],
+                                          'longitude': coords['lng']})
         return addresses_with_coords
 
     def remove_duplicated_addresses(self, addresses_locations, addresses_routes, priorities_locations, priorities_routes):
@@ -650,16 +697,9 @@ class RouteRepository():
         if len(locations) == 2:
             return 0.0, 0.0, "", 0.0
 
-        real_distance, real_duration, real_polyline, poly = routes_planner.get_distance_duration(avoid_tolls, locations)
-
-        real_total_fuel = 0
-        for i in range(len(locations) - 1):
-            origin = locations[i]
-            destination = locations[i + 1]
-            fuel_consumption = routes_planner.get_fuel_between_points(avoid_tolls, origin, destination)
-            real_total_fuel = real_total_fuel + fuel_consumption
+        metrics = routes_planner.get_route_metrics(avoid_tolls, locations)
 
-        return real_distance, real_duration, real_polyline, real_total_fuel
+        return metrics['distance_km'], metrics['duration_min'], metrics['polyline'], metrics['fuel_liters']
 
     def collect_stats(self, uid, start_date, end_date, all_locations=False):
         routes = self.get_user_route(uid, False, True)
@@ -680,56 +720,53 @@ class RouteRepository():
 
         # If to get addresses and count of them
         if all_locations is True:
-            for key, value in routes.items():
-                if isinstance(value, dict):
-                    for key_in, value_in in value.items():
-                        if isinstance(value_in, dict):
-                            for location in value_in['coords']:
-                                if location['visited'] in [True, False, None] and location['isDepot'] is False:
-                                    all_locations_to_visit.append(location['name'])
-                                if location['isDepot'] is True:
-                                    all_depots.append(location['name'])
+            for document in routes:
+                for value_in in route_schema.get_sub_routes(document):
+                    for location in value_in['coords']:
+                        if location['visited'] in [True, False, None] and location['isDepot'] is False:
+                            all_locations_to_visit.append(location['name'])
+                        if location['isDepot'] is True:
+                            all_depots.append(location['name'])
             all_addresses = all_locations_to_visit + self.remove_half_duplicates(all_depots)
             all_addresses = self.get_most_popular(all_addresses, divide=False, all_addresses=True)
             transformed_addresses = [{'name': address, 'count': count} for address, count in all_addresses]
             for location in transformed_addresses:
-                location['latitude'] = gmaps.geocode(location['name'])[0]['geometry']['location']['lat']
-                location['longitude'] = gmaps.geocode(location['name'])[0]['geometry']['location']['lng']
+                coords = geocoding_service.geocode(location['name'])
+                location['latitude'] = coords['lat']
+                location['longitude'] = coords['lng']
             reordered_transformed_addresses = [{'latitude': location['latitude'],
                                                 'longitude': location['longitude'],
                                                 'name': location['name'],
                                                 'count': location['count']} for location in transformed_addresses]
             return {'addresses': reordered_transformed_addresses}
 
-        for key, value in routes.items():
-            if isinstance(value, dict):
-                for key_in, value_in in value.items():
-                    if isinstance(value_in, dict):
-                        if value_in['date_of_completion'] is not None and parse(start_date) <= parse(value_in['date_of_completion']) <= parse(end_date):
-                            num_completed_routes = num_completed_routes + 1
-                            sum_distance = sum_distance + value_in['distance_km']
-                            sum_duration = sum_duration + value_in['duration_hours']
-                            sum_fuel = sum_fuel + value_in['fuel_liters']
-                            data_obj = datetime.strptime(value_in['date_of_completion'], '%d.%m.%Y, %H:%M')
-                            day_of_week = data_obj.strftime('%A')
-                            sum_days_of_week[day_of_week] = sum_days_of_week[day_of_week] + 1
-                            for location in value_in['coords']:
-                                if location['visited'] is True and location['isDepot'] is False:
-                                    num_visited_loc = num_visited_loc + 1
-                                    most_frequently_visited.append(location['name'])
-                                    if location['priority'] == 1:
-                                        sum_of_priorities['Priority 1'] = sum_of_priorities['Priority 1'] + 1
-                                    if location['priority'] == 2:
-                                        sum_of_priorities['Priority 2'] = sum_of_priorities['Priority 2'] + 1
-                                    if location['priority'] == 3:
-                                        sum_of_priorities['Priority 3'] = sum_of_priorities['Priority 3'] + 1
-                                if location['visited'] is False and location['isDepot'] is False:
-                                    num_unvisited_loc = num_unvisited_loc + 1
-                                    most_frequently_missed.append(location['name'])
-                                if location['isSemiDepot'] is True:
-                                    most_frequent_semi_depot.append(location['name'])
-                                if location['isDepot'] is True:
-                                    most_frequent_depot.append(location['name'])
+        for document in routes:
+            for value_in in route_schema.get_sub_routes(document):
+                if value_in['date_of_completion'] is not None and parse(start_date) <= parse(value_in['date_of_completion']) <= parse(end_date):
+                    num_completed_routes = num_completed_routes + 1
+                    sum_distance = sum_distance + value_in['distance_km']
+                    sum_duration = sum_duration + value_in['duration_hours']
+                    sum_fuel = sum_fuel + value_in['fuel_liters']
+                    data_obj = datetime.strptime(value_in['date_of_completion'], '%d.%m.%Y, %H:%M')
+                    day_of_week = data_obj.strftime('%A')
+                    sum_days_of_week[day_of_week] = sum_days_of_week[day_of_week] + 1
+                    for location in value_in['coords']:
+                        if location['visited'] is True and location['isDepot'] is False:
+                            num_visited_loc = num_visited_loc + 1
+                            most_frequently_visited.append(location['name'])
+                            if location['priority'] == 1:
+                                sum_of_priorities['Priority 1'] = sum_of_priorities['Priority 1'] + 1
+                            if location['priority'] == 2:
+                                sum_of_priorities['Priority 2'] = sum_of_priorities['Priority 2'] + 1
+                            if location['priority'] == 3:
+                                sum_of_priorities['Priority 3'] = sum_of_priorities['Priority 3'] + 1
+                        if location['visited'] is False and location['isDepot'] is False:
+                            num_unvisited_loc = num_unvisited_loc + 1
+                            most_frequently_missed.append(location['name'])
+                        if location['isSemiDepot'] is True:
+                            most_frequent_semi_depot.append(location['name'])
+                        if location['isDepot'] is True:
+                            most_frequent_depot.append(location['name'])
 
         return {'number_of_completed_routes': num_completed_routes,
                 'summed_distance_km': round(sum_distance, 2),
@@ -786,24 +823,42 @@ class RouteRepository():
         return result
 
     def change_routes_name(self, uid, routes_id, name):
-        routes = self.routes_collection.find_one({"_id": ObjectId(routes_id)})
+        routes = self.routes_collection.find_one({"_id": ObjectId(routes_id)}, {'_id': 1})
         if routes is None:
             raise HTTPException(status_code=404, detail="Routes not found")
-        user_routes = self.routes_collection.find({"user_firebase_id": uid})
-        for route in user_routes:
-            if route['name'] == name:
-                raise HTTPException(status_code=404, detail="Routes with that name already exists")
-        self.routes_collection.update_one({'_id': ObjectId(routes_id)}, {'$set': {'name': name}})
+        if self.routes_name_exists(uid, name):
+            raise HTTPException(status_code=404, detail="Routes with that name already exists")
+        try:
+            self.routes_collection.update_one({'_id': ObjectId(routes_id)}, {'$set': {'name': name}})
+        except DuplicateKeyError:
+            raise HTTPException(status_code=404, detail="Routes with that name already exists")
         return {
             "routes_id": str(routes['_id']),
             "name": name
         }
 
+    # Names of routes of a user are unique (index user_name_unique), routes generated in the same minute get a number after the date
+    # Routes document routes_id keeps its name, so it can be replaced with the same name
+    def get_unique_routes_name(self, uid, name, routes_id=None):
+        unique_name = name
+        number = 1
+        while self.routes_name_exists(uid, unique_name, routes_id):
+            number += 1
+            unique_name = f'{name} ({number})'
+        return unique_name
+
+    # Indexed existence query, only _id of one document is read
+    def routes_name_exists(self, uid, name, routes_id=None):
+        query = {'user_firebase_id': uid, 'name': name}
+        if routes_id is not None:
+            query['_id'] = {'$ne': ObjectId(routes_id)}
+        return self.routes_collection.find_one(query, {'_id': 1}) is not None
+
     def get_waypoint_info(self, routes_id,  route_number):
-        routes = self.routes_collection.find_one({"_id": ObjectId(routes_id)})
+        routes = self.find_sub_route(routes_id, route_number, ['coords.name', 'coords.visited'])
         if routes is None:
             raise HTTPException(status_code=404, detail="Routes not found")
-        locations = routes[str(route_number)]['coords']
+        locations = route_schema.get_sub_route(routes, route_number)['coords']
         info = []
         for location in locations:
             info.append({'name': location['name'], 'visited': location['visited']})
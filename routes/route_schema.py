@@ -0,0 +1,85 @@
+# Shape of routes documents in mongo
+# Version 1 (no schema_version field) keeps sub routes under numeric string keys ('0', '1', ...) next to metadata
+# Version 2 keeps them in sub_routes array ordered by route_number, so mongo can index and update them directly
+# Readers use functions below, so both versions work until every document is migrated
+SCHEMA_VERSION = 2
+
+
+def is_current(document):
+    return document.get('schema_version') == SCHEMA_VERSION
+
+
+# Function returns sub routes of routes document ordered by route_number, dicts are the ones inside document
+def get_sub_routes(document):
+    if 'sub_routes' in document:
+        return document['sub_routes']
+    return sorted([value for value in document.values() if isinstance(value, dict)], key=lambda route: route['route_number'])
+
+
+# Function returns sub route with given route_number, raises KeyError if there is no such route
+def get_sub_route(document, route_number):
+    for route in get_sub_routes(document):
+        if route['route_number'] == route_number:
+            return route
+    raise KeyError(route_number)
+
+
+# Everything except sub routes (including _id)
+def get_metadata(document):
+    return {key: value for key, value in document.items() if key != 'sub_routes' and not isinstance(value, dict)}
+
+
+# Function returns document in current version, sub routes are shared with given document
+def to_current(document):
+    if is_current(document):
+        return document
+    current = get_metadata(document)
+    current['schema_version'] = SCHEMA_VERSION
+    current['sub_routes'] = get_sub_routes(document)
+    return current
+
+
+# Filter matching document only if it is exactly as given, also fields added since it was read make it not match
+# (equality filter on every field would still match a document with a new field and replace would drop that field)
+def unchanged_filter(document):
+    return {'_id': document['_id'], '$expr': {'$eq': ['$$ROOT', {'$literal': document}]}}
+
+
+# Projection of given sub routes fields (e.g. 'coords.name') and metadata fields
+# Sub routes of old version are under unknown keys and can not be projected, such documents come back without schema_version
+def sub_routes_projection(fields, metadata=()):
+    projection = {'schema_version': 1}
+    projection.update({f'sub_routes.{field}': 1 for field in fields})
+    projection.update({field: 1 for field in metadata})
+    return projection
+
+
+# Aggregation stages keeping only sub route with given route_number, with given fields
+def sub_route_stages(route_number, fields, metadata=()):
+    sub_route = {'$filter': {'input': '$sub_routes', 'as': 'route', 'cond': {'$eq': ['$$route.route_number', route_number]}}}
+    return [{'$project': dict({'schema_version': 1, 'sub_routes': sub_route}, **{field: 1 for field in metadata})},
+            {'$project': sub_routes_projection(['route_number'] + list(fields), metadata)}]
+
+
+# Aggregation stage keeping only sub routes that are not completed, with all their fields, and given metadata fields
+def not_completed_stage(metadata=()):
+    sub_routes = {'$filter': {'input': '$sub_routes', 'as': 'route', 'cond': {'$eq': ['$$route.completed', False]}}}
+    return {'$project': dict({'schema_version': 1, 'sub_routes': sub_routes}, **{field: 1 for field in metadata})}
+
+
+# Aggregation expression of sub routes ordered by route_number, for documents of both versions
+# Sub routes of old version are the fields holding objects, route numbers of a document go from 0 without gaps
+def sub_routes_expression():
+    old_sub_routes = {'$map': {'input': {'$filter': {'input': {'$objectToArray': '$$ROOT'},
+                                                     'as': 'field',
+                                                     'cond': {'$eq': [{'$type': '$$field.v'}, 'object']}}},
+                               'as': 'field',
+                               'in': '$$field.v'}}
+    by_route_number = {'$map': {'input': {'$range': [0, {'$size': '$$routes'}]},
+                                'as': 'number',
+                                'in': {'$arrayElemAt': [{'$filter': {'input': '$$routes',
+                                                                     'as': 'route',
+                                                                     'cond': {'$eq': ['$$route.route_number', '$$number']}}}, 0]}}}
+    return {'$cond': [{'$eq': ['$schema_version', SCHEMA_VERSION]},
+                      '$sub_routes',
+                      {'$let': {'vars': {'routes': old_sub_routes}, 'in': by_route_number}}]}
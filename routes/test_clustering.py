@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from routes import clustering, geometry, tsp
+
+DAYS = 4
+
+
+# Random locations around Poznan, KMeans clusters of them break 85 km limit
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(5)
+    return np.array([(52.30 + rng.random() * 0.4, 16.70 + rng.random() * 0.5) for _ in range(40)])
+
+
+# Point 0 is the depot
+@pytest.fixture
+def cost_matrix(points):
+    return geometry.haversine_matrix([(52.40, 16.90)] + [tuple(point) for point in points])
+
+
+# Costs of routes ordered like local ordering engine orders them (depot -> locations -> depot)
+def route_costs(cost_matrix, labels):
+    costs = []
+    for label in range(DAYS):
+        indexes = [0] + [int(i) + 1 for i in np.flatnonzero(labels == label)] + [0]
+        sub_matrix = cost_matrix[np.ix_(indexes, indexes)]
+        costs.append(tsp.path_cost(sub_matrix, [0] + tsp.solve_path(sub_matrix, max_passes=20) + [len(indexes) - 1]))
+    return costs
+
+
+# Checks if repaired clusters fit in the limit, KMeans clusters do not
+def test_balance_labels_fits_limit(points, cost_matrix):
+    labels = clustering.kmeans_labels(points, DAYS, 101)
+
+    balanced = clustering.balance_labels(cost_matrix, labels, DAYS, 85, time_budget=10)
+
+    assert max(route_costs(cost_matrix, labels)) > 85
+    assert max(route_costs(cost_matrix, balanced)) <= 85
+    assert sorted(np.unique(balanced)) == list(range(DAYS))
+
+
+# Checks if the same seed gives the same clusters
+def test_balance_labels_repeatable(points, cost_matrix):
+    results = [clustering.balance_labels(cost_matrix, clustering.kmeans_labels(points, DAYS, 101), DAYS, 85, time_budget=10)
+               for _ in range(2)]
+
+    assert results[0].tolist() == results[1].tolist()
+
+
+# Checks if limit that can not be met stops the search, every cluster keeps its locations
+def test_balance_labels_infeasible(points, cost_matrix):
+    labels = clustering.kmeans_labels(points, DAYS, 101)
+
+    balanced = clustering.balance_labels(cost_matrix, labels, DAYS, 10, time_budget=10)
+
+    assert len(balanced) == len(points)
+    assert sorted(np.unique(balanced)) == list(range(DAYS))
+    assert max(route_costs(cost_matrix, balanced)) > 10
@@ -0,0 +1,60 @@
+import pytest
+
+from config import Config
+from routes.plan_cache import PlanCache
+
+
+@pytest.fixture
+def plan_cache():
+    return PlanCache(Config())
+
+
+@pytest.fixture
+def params():
+    return {"depot_address": "Nad Bogdanką 6a, 60-862 Poznań, Poland",
+            "semi_depot_addresses": ["Kwiatowa 43C, 66-400 Gorzów Wielkopolski, Poland"],
+            "addresses": ["Kassyusza 7, 60-549 Poznań, Poland",
+                          "Słowackiego 15, 60-822 Poznań, Poland",
+                          "Grunwaldzka 19, 60-782 Poznań, Poland"],
+            "priorities": [3, 2, 1],
+            "days": 2,
+            "distance_limit": 100.0,
+            "duration_limit": None,
+            "preferences": "distance",
+            "avoid_tolls": True,
+            "centroids": [[52.4, 16.9], [52.7, 15.2]]}
+
+
+# Checks if requests for the same plan have the same key: addresses in other order, other spelling, int limit, float noise
+def test_create_key_equivalent(plan_cache, params):
+    equivalent = dict(params,
+                      depot_address="nad bogdanką 6a ,60-862 Poznań,  Poland",
+                      addresses=list(reversed(params['addresses'])),
+                      priorities=list(reversed(params['priorities'])),
+                      distance_limit=100,
+                      centroids=[[52.4 + 1e-12, 16.9], [52.7, 15.2 - 1e-12]])
+
+    assert plan_cache.create_key(params) == plan_cache.create_key(equivalent)
+
+
+# Checks if every parameter that changes the plan changes the key
+@pytest.mark.parametrize('changes', [{"semi_depot_addresses": ["Kassyusza 7, 60-549 Poznań, Poland"]},
+                                     {"priorities": [2, 3, 1]},
+                                     {"days": 3},
+                                     {"distance_limit": 100.5},
+                                     {"duration_limit": 100.0},
+                                     {"preferences": "duration"},
+                                     {"avoid_tolls": False},
+                                     {"centroids": [[52.7, 15.2], [52.4, 16.9]]},
+                                     {"centroids": None}])
+def test_create_key_different(plan_cache, params, changes):
+    assert plan_cache.create_key(params) != plan_cache.create_key(dict(params, **changes))
+
+
+# Checks if order of semi depots changes the key, they are visited one after another
+def test_create_key_semi_depots_order(plan_cache, params):
+    params['semi_depot_addresses'] = ["Kwiatowa 43C, 66-400 Gorzów Wielkopolski, Poland", "Kassyusza 7, 60-549 Poznań, Poland"]
+
+    reversed_params = dict(params, semi_depot_addresses=list(reversed(params['semi_depot_addresses'])))
+
+    assert plan_cache.create_key(params) != plan_cache.create_key(reversed_params)
@@ -0,0 +1,246 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from config import Config
+from routes import clustering
+from routes.planner import RoutesPlanner
+
+
+@pytest.fixture
+def planner():
+    return RoutesPlanner(Config())
+
+
+@pytest.fixture
+def depot():
+    return {'lat': 52.40, 'lng': 16.90}
+
+
+# Locations around Poznan, two of them are geocoded to the same coordinates
+@pytest.fixture
+def addresses_coords():
+    coords = [{'lat': 52.40 + 0.02 * (i % 4), 'lng': 16.90 + 0.03 * (i // 4)} for i in range(10)]
+    coords.append(dict(coords[5]))
+    return coords
+
+
+# Checks if addresses with the same coordinates stay separate locations in every candidate plan
+def test_candidates_same_coordinates(planner, depot, addresses_coords):
+    df_addresses = pd.DataFrame(addresses_coords)
+    df_addresses['priority'] = 2
+
+    candidates = planner.generate_candidates(df_addresses, 3, depot, [])
+
+    for df, _ in candidates:
+        assert sorted(df.index) == list(range(len(addresses_coords)))
+
+
+# Checks if plan does not lose or duplicate addresses with the same coordinates
+def test_choose_plan_same_coordinates(planner, depot, addresses_coords):
+    df = planner.choose_plan(addresses_coords, [2] * len(addresses_coords), 3, depot, [], None, None, 'distance')
+
+    assert sorted(df.index) == list(range(len(addresses_coords)))
+    assert sorted(df['label'].unique()) == [0, 1, 2]
+
+
+# Checks if distance matrix is split into requests within google limits and every element is asked exactly once
+@pytest.mark.parametrize('origins_count, destinations_count', [(3, 2), (30, 1), (8, 12), (30, 30), (4, 60)])
+def test_distance_matrix_parts(planner, origins_count, destinations_count):
+    origins = [(52.40, 16.90 + i * 0.01) for i in range(origins_count)]
+    destinations = [(52.50, 16.90 + i * 0.01) for i in range(destinations_count)]
+
+    parts = planner.distance_matrix_parts(origins, destinations)
+
+    asked = np.zeros((origins_count, destinations_count), dtype=int)
+    for first_row, last_row, first_column, last_column in parts:
+        assert last_row - first_row <= 25
+        assert last_column - first_column <= 25
+        assert (last_row - first_row) * (last_column - first_column) <= 100
+        asked[first_row:last_row, first_column:last_column] += 1
+    assert (asked == 1).all()
+
+
+# Checks if local ordering engine keeps start and end and visits points along the way
+def test_local_waypoints_order(planner):
+    depot = (52.40, 16.90)
+    addresses = [(52.50, 16.90), (52.41, 16.90), (52.45, 16.90)]
+
+    ordered_addresses = planner.set_waypoints_local(depot, addresses, depot)
+
+    assert ordered_addresses in ([(52.41, 16.90), (52.45, 16.90), (52.50, 16.90)],
+                                 [(52.50, 16.90), (52.45, 16.90), (52.41, 16.90)])
+
+
+# Checks if local ordering visits locations with higher priority first, even if it makes route longer
+def test_local_waypoints_priorities(planner):
+    depot = (52.40, 16.90)
+    addresses = [(52.41, 16.90), (52.50, 16.90), (52.45, 16.90)]
+
+    ordered_addresses = planner.set_waypoints_local(depot, addresses, depot, priorities=[1, 3, 2])
+
+    assert ordered_addresses == [(52.50, 16.90), (52.45, 16.90), (52.41, 16.90)]
+
+
+# Checks if with soft priorities order breaks priority when it saves more than PRIORITY_PENALTY km, hard priorities are never broken
+# Going to the end through location with priority 3 first makes route about 11 km longer
+@pytest.mark.parametrize('priority_mode, penalty, expected', [('hard', 5, [(52.50, 16.90), (52.45, 16.90)]),
+                                                              ('soft', 5, [(52.45, 16.90), (52.50, 16.90)]),
+                                                              ('soft', 100, [(52.50, 16.90), (52.45, 16.90)])])
+def test_local_waypoints_soft_priorities(planner, priority_mode, penalty, expected):
+    planner.config.PRIORITY_MODE = priority_mode
+    planner.config.PRIORITY_PENALTY = penalty
+
+    ordered_addresses = planner.set_waypoints_local((52.40, 16.90), [(52.45, 16.90), (52.50, 16.90)], (52.60, 16.90), priorities=[2, 3])
+
+    assert ordered_addresses == expected
+
+
+# Checks if the same request gives the same plan, candidates are scored with a fixed number of improvement passes
+# With distance limit clusters are repaired to fit it, with a fixed number of moves
+@pytest.mark.parametrize('distance_limit', [None, 90])
+def test_choose_plan_repeatable(planner, depot, distance_limit):
+    rng = np.random.default_rng(3)
+    addresses_coords = [{'lat': 52.30 + rng.random() * 0.4, 'lng': 16.70 + rng.random() * 0.5} for _ in range(80)]
+    priorities = [int(priority) for priority in rng.integers(1, 4, len(addresses_coords))]
+
+    plans = [planner.choose_plan(addresses_coords, priorities, 4, depot, [], distance_limit, None, 'distance') for _ in range(2)]
+
+    assert plans[0]['label'].tolist() == plans[1]['label'].tolist()
+
+
+# Saved route from depot through given points back to depot, every location has priority 2
+def saved_route(points, distance_km):
+    coords = [(52.40, 16.90)] + points + [(52.40, 16.90)]
+    return {'coords': [{'latitude': lat,
+                        'longitude': lng,
+                        'priority': None if i in (0, len(coords) - 1) else 2,
+                        'visited': None,
+                        'isDepot': i in (0, len(coords) - 1)} for i, (lat, lng) in enumerate(coords)],
+            'distance_km': distance_km,
+            'duration_hours': 1.0}
+
+
+@pytest.fixture
+def saved_routes():
+    return {0: saved_route([(52.50, 16.90), (52.60, 16.90)], 45.0),
+            1: saved_route([(52.40, 17.20), (52.40, 17.30)], 55.0)}
+
+
+# Checks if the cheapest position is first, location lies between 2 locations of route 0
+def test_insertion_positions_ranking(planner, saved_routes):
+    location = {'latitude': 52.55, 'longitude': 16.90, 'priority': 2}
+
+    positions = planner.find_insertion_positions(saved_routes, location, None, None)
+
+    assert positions[0][:2] == (0, 2)
+    assert [extra_km for _, _, extra_km in positions] == sorted(extra_km for _, _, extra_km in positions)
+    assert {key for key, _, _ in positions} == {0, 1}
+
+
+# Checks if location is not inserted before locations that are already marked
+def test_insertion_positions_after_visited(planner, saved_routes):
+    saved_routes[0]['coords'][1]['visited'] = True
+    saved_routes[0]['coords'][2]['visited'] = False
+    location = {'latitude': 52.55, 'longitude': 16.90, 'priority': 2}
+
+    positions = planner.find_insertion_positions(saved_routes, location, None, None)
+
+    assert [index for key, index, _ in positions if key == 0] == [3]
+
+
+# Checks if location with higher priority goes before other locations and positions breaking limits are skipped
+def test_insertion_positions_priority_and_limit(planner, saved_routes):
+    location = {'latitude': 52.55, 'longitude': 16.90, 'priority': 3}
+
+    positions = planner.find_insertion_positions(saved_routes, location, 60, None)
+
+    assert [(key, index) for key, index, _ in positions] == [(0, 1)]
+
+
+# Checks if days split between regions sum to days and every region gets between 1 day and number of its locations
+@pytest.mark.parametrize('sizes, days', [([10, 10], 10), ([50, 3, 7], 12), ([1, 1, 40], 20), ([9, 8, 8, 5], 30)])
+def test_split_days(sizes, days):
+    region_days = clustering.split_days(sizes, days)
+
+    assert region_days.sum() == days
+    assert (region_days >= 1).all()
+    assert (region_days <= np.asarray(sizes)).all()
+
+
+# Checks if plan longer than REGION_DAYS is split into regions without losing or duplicating addresses
+def test_choose_plan_regions(planner, depot, addresses_coords):
+    rng = np.random.default_rng(11)
+    addresses_coords = addresses_coords + [{'lat': 52.00 + rng.random() * 1.0, 'lng': 16.40 + rng.random() * 1.2} for _ in range(60)]
+    days = planner.config.REGION_DAYS + 3
+
+    df = planner.choose_plan(addresses_coords, [2] * len(addresses_coords), days, depot, [], None, None, 'distance')
+
+    assert sorted(df.index) == list(range(len(addresses_coords)))
+    assert sorted(df['label'].unique()) == list(range(days))
+    assert df[['lat', 'lng']].to_dict('records') == addresses_coords
+
+
+# Checks if planners of the process (e.g. of main and of route repository) share one executor bounded by PLANNER_MAX_WORKERS
+def test_planners_share_executor(planner):
+    other_planner = RoutesPlanner(Config())
+
+    assert other_planner.executor is planner.executor
+    assert planner.executor._max_workers == planner.config.PLANNER_MAX_WORKERS
+
+
+# computeRoutes response with legs of given distances, fuel is given only for whole route
+def compute_routes_response(distances, fuel_microliters=None):
+    route = {'legs': [{'distanceMeters': distance, 'duration': '60s', 'polyline': {'encodedPolyline': '_p~iF~ps|U_ulLnnqC'}} for distance in distances]}
+    if fuel_microliters is not None:
+        route['travelAdvisory'] = {'fuelConsumptionMicroliters': str(fuel_microliters)}
+    return {'routes': [route]}
+
+
+# Checks if fuel of route is shared between legs by distance and legs sum to fuel of route
+def test_parse_route_legs_fuel(planner):
+    legs = planner.parse_route_legs(compute_routes_response([1000, 3000, 2000], 600001))
+
+    assert [leg['fuel_microliters'] for leg in legs] == [100000, 300001, 200000]
+    assert planner.metrics_from_legs(legs)['fuel_liters'] == 0.600001
+
+
+# Checks if fuel is estimated from distance when google does not return it
+def test_parse_route_legs_no_fuel(planner):
+    legs = planner.parse_route_legs(compute_routes_response([10000, 30000]))
+
+    fuel_liters = planner.metrics_from_legs(legs)['fuel_liters']
+
+    assert fuel_liters == pytest.approx(40 * planner.config.FUEL_LITERS_PER_KM)
+    assert legs[1]['fuel_microliters'] == 3 * legs[0]['fuel_microliters']
+
+
+# Candidate plan with one route of given distance
+def candidate(label, distance_km):
+    return pd.DataFrame({'label': [label]}), {0: [[], distance_km, 60.0, 5.0, None, None]}
+
+
+# Checks if warm started candidate (first) is kept unless other candidate is better by more than WARM_START_MARGIN
+@pytest.mark.parametrize('other_distance, chosen', [(97.0, 'warm'), (90.0, 'other')])
+def test_choose_candidate_warm_start(planner, other_distance, chosen):
+    planner.config.WARM_START_MARGIN = 0.05
+    candidates = [candidate('warm', 100.0), candidate('other', other_distance)]
+
+    df = planner.choose_candidate(candidates, None, None, 'distance', warm_start=True)
+
+    assert df['label'][0] == chosen
+    assert planner.choose_candidate(candidates, None, None, 'distance')['label'][0] == 'other'
+
+
+# Checks if regenerated plan with 2 more addresses keeps routes of previous plan
+def test_choose_plan_keeps_previous_routes(planner, depot):
+    rng = np.random.default_rng(1)
+    addresses_coords = [{'lat': 52.30 + rng.random() * 0.4, 'lng': 16.70 + rng.random() * 0.5} for _ in range(40)]
+    previous = planner.choose_plan(addresses_coords[:-2], [2] * 38, 4, depot, [], None, None, 'distance')
+    centroids = [list(previous[previous['label'] == label][['lat', 'lng']].mean()) for label in range(4)]
+
+    df = planner.choose_plan(addresses_coords, [2] * 40, 4, depot, [], None, None, 'distance', centroids)
+
+    previous_routes = sorted(sorted(previous.index[previous['label'] == label]) for label in range(4))
+    routes = sorted(sorted(index for index in df.index[df['label'] == label] if index < 38) for label in range(4))
+    assert routes == previous_routes
@@ -0,0 +1,31 @@
+from routes import route_schema
+
+
+# Routes document saved before schema_version, sub routes are under numeric string keys
+def old_document():
+    return {'_id': 1,
+            'user_firebase_id': 'uid',
+            'name': 'routes',
+            'days': 2,
+            '1': {'route_number': 1, 'coords': [], 'completed': False},
+            '0': {'route_number': 0, 'coords': [], 'completed': True}}
+
+
+# Checks if old document gets sub routes array ordered by route_number and keeps its metadata
+def test_to_current_old_document():
+    document = old_document()
+
+    current = route_schema.to_current(document)
+
+    assert current['schema_version'] == route_schema.SCHEMA_VERSION
+    assert [route['route_number'] for route in current['sub_routes']] == [0, 1]
+    assert route_schema.get_metadata(current) == dict(route_schema.get_metadata(document), schema_version=route_schema.SCHEMA_VERSION)
+    assert '0' not in current and '1' not in current
+
+
+# Checks if current document is returned as it is
+def test_to_current_current_document():
+    document = route_schema.to_current(old_document())
+
+    assert route_schema.to_current(document) is document
+    assert route_schema.is_current(document)
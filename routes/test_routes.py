@@ -1,8 +1,13 @@
+import json
+import time
+from datetime import datetime, timedelta
 from urllib import response
 
 import pytest
+from bson import ObjectId
 from fastapi.testclient import TestClient
-from main import app, routes_planner, routes_repo
+from main import app, jobs_repo, routes_planner, routes_repo
+from routes import route_schema
 
 
 # Fixtury dla testow integracyjnych
@@ -168,6 +173,37 @@ def test_rename_routes(client, auth_header):
     assert all_response.json()['routes'][0]['name'] == "test"
 
 
+# Checks if two routes of a user can not have the same name
+def test_rename_routes_duplicated_name(client, auth_header):
+    all_response = client.get("/routes", headers=auth_header)
+    routes_id = all_response.json()['routes'][1]['routes_id']
+
+    params = {
+        "routes_id": routes_id,
+        "name": "test"
+    }
+
+    response = client.post("/routes/rename", json=params, headers=auth_header)
+
+    assert response.json()['error'] == "Routes with that name already exists"
+
+
+# Checks if info about route that is not in routes returns error
+def test_waypoint_info_wrong_route(client, auth_header):
+    all_response = client.get("/routes", headers=auth_header)
+    routes_id = all_response.json()['routes'][0]['routes_id']
+
+    params = {
+        "routes_id": routes_id,
+        "route_number": 100
+    }
+
+    response = client.post("/routes/waypoint/info", json=params, headers=auth_header)
+
+    assert response.status_code == 400
+    assert response.json()['error'] == "Route with that number not found"
+
+
 def test_regenerate_routes(client, auth_header):
     all_response = client.get("/routes", headers=auth_header)
     routes_id = all_response.json()['routes'][1]['routes_id']
@@ -203,3 +239,156 @@ def test_del_user_routes(client, auth_header):
     response = client.delete("/routes", headers=auth_header)
 
     assert response.json()['deleted_routes'] >= 1
+
+
+# Checks if routes generated as a job can be polled until they are done
+def test_routes_job(client, auth_header):
+    routes = {
+        "depot_address": "Nad Bogdanką 6a, 60-862 Poznań, Poland",
+        "semi_depot_addresses": [],
+        "addresses": ["Kassyusza 7, 60-549 Poznań, Poland",
+            "Słowackiego 15, 60-822 Poznań, Poland"],
+        "priorities": [3,2],
+        "days": 1,
+        "distance_limit":  None,
+        "duration_limit": None,
+        "preferences": "duration",
+        "avoid_tolls": True
+    }
+
+    response = client.post("/routes", json=routes, headers=auth_header, params={"as_job": True})
+
+    assert response.status_code == 202
+    job_id = response.json()['job_id']
+
+    for _ in range(60):
+        job = client.get(f"/routes/jobs/{job_id}", headers=auth_header).json()
+        if job['status'] in ('done', 'failed'):
+            break
+        time.sleep(1)
+
+    assert job['status'] == 'done'
+    assert len(job['result']['routes'][0]['subRoutes']) == 1
+
+
+# Checks if job of a replica that stopped refreshing its heartbeat (e.g. restarted) is reported as failed
+def test_stale_job_failed(client, auth_header):
+    routes = {
+        "depot_address": "Nad Bogdanką 6a, 60-862 Poznań, Poland",
+        "semi_depot_addresses": [],
+        "addresses": ["Kassyusza 7, 60-549 Poznań, Poland"],
+        "priorities": [2],
+        "days": 1,
+        "distance_limit":  None,
+        "duration_limit": None,
+        "preferences": "distance",
+        "avoid_tolls": True
+    }
+    response = client.post("/routes", json=routes, headers=auth_header, params={"as_job": True})
+    uid = jobs_repo.jobs_collection.find_one({"_id": ObjectId(response.json()['job_id'])})['user_firebase_id']
+
+    # Job that no worker runs, with heartbeat older than JOB_STALE_AFTER
+    job_id = jobs_repo.create_job(uid, routes)
+    stale_heartbeat = datetime.utcnow() - timedelta(seconds=jobs_repo.config.JOB_STALE_AFTER + 60)
+    jobs_repo.jobs_collection.update_one({"_id": ObjectId(job_id)}, {"$set": {"heartbeat_at": stale_heartbeat}})
+
+    job = client.get(f"/routes/jobs/{job_id}", headers=auth_header).json()
+
+    assert job['status'] == 'failed'
+    assert job['error'] == "Job was interrupted, generate routes again"
+
+
+# Checks if progress of routes generation is streamed and ends with generated routes
+def test_routes_stream(client, auth_header):
+    routes = {
+        "depot_address": "Nad Bogdanką 6a, 60-862 Poznań, Poland",
+        "semi_depot_addresses": [],
+        "addresses": ["Kassyusza 7, 60-549 Poznań, Poland",
+            "Słowackiego 15, 60-822 Poznań, Poland"],
+        "priorities": [3,2],
+        "days": 1,
+        "distance_limit":  None,
+        "duration_limit": None,
+        "preferences": "distance",
+        "avoid_tolls": False
+    }
+
+    response = client.post("/routes/stream", json=routes, headers=auth_header)
+    events = [json.loads(line) for line in response.iter_lines() if line]
+
+    assert response.status_code == 200
+    assert events[0]['stage'] == 'queued'
+    assert events[-2]['stage'] == 'persisted'
+    assert events[-1]['stage'] == 'done'
+    assert len(events[-1]['result']['routes'][0]['subRoutes']) == 1
+
+
+# Checks if kept location is inserted into other active route, locations are renumbered and centroid is moved
+def test_reinsert_kept_waypoint(client, auth_header):
+    routes = {
+        "depot_address": "Nad Bogdanką 6a, 60-862 Poznań, Poland",
+        "semi_depot_addresses": [],
+        "addresses": ["Kassyusza 7, 60-549 Poznań, Poland",
+            "Słowackiego 15, 60-822 Poznań, Poland",
+            "Grunwaldzka 19, 60-782 Poznań, Poland"],
+        "priorities": [2,2,2],
+        "days": 2,
+        "distance_limit":  None,
+        "duration_limit": None,
+        "preferences": "distance",
+        "avoid_tolls": True
+    }
+
+    response = client.post("/routes", json=routes, headers=auth_header)
+    routes_id = response.json()['routes']['routes_id']
+
+    waypoint = {
+        "routes_id": routes_id,
+        "route_number": 0,
+        "location_number": 1,
+        "visited": False
+    }
+    response = client.post("routes/waypoint", json=waypoint, headers=auth_header, params={"should_keep": True, "reinsert": True})
+
+    assert response.json()['reinserted'] is True
+
+    document = routes_repo.routes_collection.find_one({"_id": ObjectId(routes_id)})
+    skipped_route, other_route = route_schema.get_sub_routes(document)
+    kept_name = skipped_route['coords'][1]['name']
+
+    assert kept_name in [item['name'] for item in other_route['coords']]
+    assert [item['location_number'] for item in other_route['coords']] == list(range(len(other_route['coords'])))
+    assert other_route['centroid'] == routes_repo.get_centroid(other_route['coords'])
+
+
+# Checks if old routes documents are migrated and a document changed after it was read is skipped and reported
+def test_migrate_routes_skips_changed_document(monkeypatch):
+    old_routes = {"user_firebase_id": "routes_migration_test",
+                  "0": {"route_number": 0, "coords": [], "completed": False}}
+    changed_id = routes_repo.routes_collection.insert_one(dict(old_routes, name="changed")).inserted_id
+    unchanged_id = routes_repo.routes_collection.insert_one(dict(old_routes, name="unchanged")).inserted_id
+
+    # Document is changed between reading and replacing it, like by a request handled at the same time
+    to_current = route_schema.to_current
+
+    def to_current_changing_document(document):
+        if document['_id'] == changed_id:
+            routes_repo.routes_collection.update_one({"_id": changed_id}, {"$set": {"days": 3}})
+        return to_current(document)
+
+    monkeypatch.setattr(route_schema, "to_current", to_current_changing_document)
+    result = routes_repo.migrate_routes()
+    changed = routes_repo.routes_collection.find_one({"_id": changed_id})
+    unchanged = routes_repo.routes_collection.find_one({"_id": unchanged_id})
+
+    monkeypatch.undo()
+    next_result = routes_repo.migrate_routes()
+    migrated = routes_repo.routes_collection.find_one({"_id": changed_id})
+    routes_repo.routes_collection.delete_many({"user_firebase_id": "routes_migration_test"})
+
+    assert result['skipped'] >= 1
+    assert 'schema_version' not in changed and changed['days'] == 3
+    assert unchanged['schema_version'] == route_schema.SCHEMA_VERSION
+    assert unchanged['sub_routes'][0]['route_number'] == 0
+    assert next_result['migrated'] >= 1
+    assert migrated['schema_version'] == route_schema.SCHEMA_VERSION and migrated['days'] == 3
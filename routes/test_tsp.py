@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from routes import geometry, tsp
+
+
+# Cost matrix of a path from depot through random locations back to depot
+@pytest.fixture
+def cost_matrix():
+    rng = np.random.default_rng(7)
+    points = [(52.30 + rng.random() * 0.4, 16.70 + rng.random() * 0.5) for _ in range(150)]
+    return geometry.haversine_matrix([(52.40, 16.90)] + points + [(52.40, 16.90)])
+
+
+# Checks if every location is visited exactly once
+def test_solve_path_visits_every_point(cost_matrix):
+    path = tsp.solve_path(cost_matrix, max_passes=5)
+
+    assert sorted(path) == list(range(1, len(cost_matrix) - 1))
+
+
+# Checks if the same input gives the same order, time budget is only a safety limit
+def test_solve_path_repeatable(cost_matrix):
+    paths = [tsp.solve_path(cost_matrix, time_budget=60, max_passes=5) for _ in range(3)]
+
+    assert paths[0] == paths[1] == paths[2]
+
+
+# Checks if improvement passes do not make path longer than nearest neighbour path
+def test_solve_path_improves(cost_matrix):
+    path = tsp.solve_path(cost_matrix, max_passes=5)
+    nearest_neighbour_path = tsp.nearest_neighbour(cost_matrix)
+
+    assert tsp.path_cost(cost_matrix, [0] + path + [len(cost_matrix) - 1]) < tsp.path_cost(cost_matrix, nearest_neighbour_path)
@@ -0,0 +1,140 @@
+import time
+
+import numpy as np
+
+# Improvement has to be bigger than that, otherwise float errors could make search loop forever
+EPSILON = 1e-9
+
+
+# Function builds path with nearest neighbour heuristic
+# Path always starts with point 0 and ends with last point of cost matrix
+# With ranks next point is chosen only from unvisited points with the highest rank, so path keeps precedence
+def nearest_neighbour(cost_matrix, ranks=None):
+    size = len(cost_matrix)
+    end = size - 1
+    unvisited = np.ones(size, dtype=bool)
+    unvisited[0] = False
+    unvisited[end] = False
+
+    path = [0]
+    current = 0
+    for _ in range(size - 2):
+        allowed = unvisited
+        if ranks is not None:
+            allowed = unvisited & (ranks == ranks[unvisited].max())
+        costs = np.where(allowed, cost_matrix[current], np.inf)
+        current = int(np.argmin(costs))
+        unvisited[current] = False
+        path.append(current)
+    path.append(end)
+
+    return path
+
+
+# Function returns cost of a path
+def path_cost(cost_matrix, path):
+    return float(sum(cost_matrix[path[i], path[i + 1]] for i in range(len(path) - 1)))
+
+
+# Function adds penalty to every arc going back to a point with higher rank
+# Without penalty the constraint is hard, penalty is bigger than cost of any path
+# With penalty (cost units per rank) a path can go back to higher rank if it saves more than that
+def precedence_matrix(cost_matrix, ranks, penalty=None):
+    upward = np.clip(ranks[None, :] - ranks[:, None], 0, None)
+    if penalty is None:
+        return cost_matrix + np.where(upward > 0, cost_matrix.sum() + 1, 0)
+    return cost_matrix + upward * penalty
+
+
+# Prefix sums of arcs cost in both directions, they let us price reversing a segment in O(1)
+# Cost matrix does not have to be symmetric (e.g. distances from google distance matrix)
+def prefix_costs(cost_matrix, path):
+    points = np.asarray(path)
+    forward = np.concatenate(([0.0], np.cumsum(cost_matrix[points[:-1], points[1:]])))
+    backward = np.concatenate(([0.0], np.cumsum(cost_matrix[points[1:], points[:-1]])))
+    return forward, backward
+
+
+# Function makes one pass of 2-opt, for every start of a segment the best reversal is applied if it improves path
+# Returns True if path was improved
+def two_opt(cost_matrix, path, deadline):
+    improved = False
+    points = np.asarray(path)
+    forward, backward = prefix_costs(cost_matrix, path)
+    for i in range(1, len(path) - 2):
+        if time.monotonic() > deadline:
+            break
+        a, b = points[i - 1], points[i]
+        j = np.arange(i + 1, len(path) - 1)
+        c, d = points[j], points[j + 1]
+        delta = (cost_matrix[a, c] + cost_matrix[b, d] - cost_matrix[a, b] - cost_matrix[c, d]
+                 + (backward[j] - backward[i]) - (forward[j] - forward[i]))
+        best = int(np.argmin(delta))
+        if delta[best] < -EPSILON:
+            path[i:j[best] + 1] = path[i:j[best] + 1][::-1]
+            points = np.asarray(path)
+            forward, backward = prefix_costs(cost_matrix, path)
+            improved = True
+    return improved
+
+
+# Function makes one pass of or-opt, every segment of 1 to 3 points is moved into the best other place of path if it improves path
+# Returns True if path was improved
+def or_opt(cost_matrix, path, deadline):
+    improved = False
+    for length in range(1, 4):
+        for i in range(1, len(path) - length):
+            if time.monotonic() > deadline:
+                return improved
+            points = np.asarray(path)
+            first, last = points[i], points[i + length - 1]
+            before, after = points[i - 1], points[i + length]
+            removed = cost_matrix[before, first] + cost_matrix[last, after] - cost_matrix[before, after]
+            k = np.concatenate((np.arange(0, i - 1), np.arange(i + length, len(path) - 1)))
+            if len(k) == 0:
+                continue
+            added = cost_matrix[points[k], first] + cost_matrix[last, points[k + 1]] - cost_matrix[points[k], points[k + 1]]
+            best = int(np.argmin(added))
+            if added[best] - removed < -EPSILON:
+                k = int(k[best])
+                segment = path[i:i + length]
+                rest = path[:i] + path[i + length:]
+                position = k + 1 if k < i else k + 1 - length
+                path[:] = rest[:position] + segment + rest[position:]
+                improved = True
+    return improved
+
+
+def solve_path(cost_matrix, time_budget=0.5, ranks=None, penalty=None, max_passes=None):
+    '''
+    Function orders points of a path with fixed start and end
+    Params:
+    - cost_matrix - square matrix of costs between points, row 0 is the start and the last row is the end (numpy array)
+    - time_budget - maximum number of seconds spent on improving the path, safety limit for very big inputs (float)
+    - ranks - optional rank of every point, points with higher rank are visited first (list of numbers)
+    - penalty - cost of going back to higher rank, per rank; None means ranks are hard constraint (float)
+    - max_passes - maximum number of improvement passes (2-opt and or-opt), None means until no pass improves the path (int)
+    The same input gives the same path, unless time budget runs out first
+    Returns indexes of points between start and end in visiting order (list of ints from 1 to n-2)
+    '''
+
+    cost_matrix = np.asarray(cost_matrix, dtype=np.float64)
+    if len(cost_matrix) <= 3:
+        return list(range(1, len(cost_matrix) - 1))
+
+    deadline = time.monotonic() + time_budget
+    if ranks is None:
+        path = nearest_neighbour(cost_matrix)
+    else:
+        ranks = np.asarray(ranks, dtype=np.float64)
+        path = nearest_neighbour(cost_matrix, ranks)
+        cost_matrix = precedence_matrix(cost_matrix, ranks, penalty)
+
+    passes = 0
+    improved = True
+    while improved and (max_passes is None or passes < max_passes) and time.monotonic() < deadline:
+        improved = two_opt(cost_matrix, path, deadline)
+        improved = or_opt(cost_matrix, path, deadline) or improved
+        passes += 1
+
+    return path[1:-1]
@@ -1,7 +1,6 @@
 from datetime import datetime
 from typing import Optional
 
-import requests
 from loguru import logger
 from pydantic import BaseModel
 from pymongo import MongoClient
@@ -14,6 +13,7 @@ from passlib.context import CryptContext
 from firebase_admin import credentials, auth
 import json
 import config
+from http_client import http_client
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -45,7 +45,7 @@ class UserRepository:
             'password': body['password'],
             "returnSecureToken": True
         })
-        r = requests.post(firebase_request_url, data=payload)
+        r = http_client.post(firebase_request_url, 'firebase verifyPassword', data=payload)
         response = r.json()
         idToken = response['idToken']
 
@@ -53,9 +53,9 @@ class UserRepository:
         rest_api_url = "https://identitytoolkit.googleapis.com/v1/accounts:sendOobCode"
         data = {"requestType": "VERIFY_EMAIL", "email": body['email'], "idToken": idToken}
 
-        r = requests.post(rest_api_url,
-                          params={'key': config.Config.FIREBASE_API_KEY},
-                          data=data)
+        r = http_client.post(rest_api_url, 'firebase sendOobCode',
+                             params={'key': config.Config.FIREBASE_API_KEY},
+                             data=data)
 
         resp = {
             "email": firebase_user.email,
@@ -78,7 +78,7 @@ class UserRepository:
             "returnSecureToken": True
         })
 
-        r = requests.post(firebase_request_url, data=payload)
+        r = http_client.post(firebase_request_url, 'firebase verifyPassword', data=payload)
 
         response = r.json()
 
@@ -122,9 +122,9 @@ class UserRepository:
         rest_api_url = "https://identitytoolkit.googleapis.com/v1/accounts:sendOobCode"
         data = {"requestType": "PASSWORD_RESET", "email": body['email']}
 
-        r = requests.post(rest_api_url,
-                          params={'key': config.Config.FIREBASE_API_KEY},
-                          data=data)
+        r = http_client.post(rest_api_url, 'firebase sendOobCode',
+                             params={'key': config.Config.FIREBASE_API_KEY},
+                             data=data)
 
         response = r.json()
 